@@ -0,0 +1,150 @@
+"""Compare the HtmlConverter engines: BeautifulSoup with markdownify, and lxml with utils.html_markdown.
+
+Each page is converted from disk by both engines. The script reports throughput (MB/s over
+all pages) and the median and p95 time per page, and counts the pages whose Markdown
+differs after MarkdownConverter's normalization. By default it converts generated
+Wikipedia-like pages of a few sizes. Pass files or directories to use a real corpus.
+
+Usage:
+    python benchmarks/html_engine.py
+    python benchmarks/html_engine.py --sizes 10K 100K 1M 5M
+    python benchmarks/html_engine.py saved_pages/ --show-diffs 3
+"""
+import argparse
+import difflib
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils.mdconvert import HtmlConverter  # noqa: E402
+
+ENGINES = ("html.parser", "lxml")
+_UNITS = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+
+
+def parse_size(value: str) -> int:
+    if value[-1].upper() in _UNITS:
+        return int(float(value[:-1]) * _UNITS[value[-1].upper()])
+    return int(value)
+
+
+def make_page(size: int, seed: int = 0) -> str:
+    # Navigation, scripts, sections of prose and lists, and one large table, like a Wikipedia article
+    rng = random.Random(seed)
+    inline = ["alpha", "beta_gamma", "<b>bold</b>", "<i>it</i>", '<a href="/wiki/X">link</a>', "&amp;", "*star*", "<code>x_y</code>"]
+
+    def words(n: int) -> str:
+        return " ".join(rng.choice(inline) for _ in range(n))
+
+    parts = [
+        "<!DOCTYPE html>\n<html>\n<head>\n<title>Generated &amp; page</title>\n<style>.a { color: red }</style>\n",
+        '<script>var x = "<p>not markup</p>";</script>\n</head>\n<body>\n<div id="nav">\n<ul>\n',
+        "".join(f'  <li><a href="/n{i}">nav {i}</a></li>\n' for i in range(50)),
+        '</ul>\n</div>\n<div id="mw-content-text">\n<h1>Heading</h1>\n',
+    ]
+    length = sum(len(p) for p in parts)
+    section = 0
+    while length < size // 2:
+        part = (
+            f"<h2>Section {section}</h2>\n<p>{words(60)}<br>{words(10)}</p>\n"
+            f"<ul>\n<li>{words(5)}</li>\n<li>{words(5)}\n<ol><li>{words(3)}</li><li>{words(3)}</li></ol>\n</li>\n</ul>\n"
+            f"<pre>code_block  {section}\n    indented *line*</pre>\n<blockquote><p>{words(8)}</p></blockquote>\n"
+            f"<script>track({section})</script>\n"
+        )
+        parts.append(part)
+        length += len(part)
+        section += 1
+    parts.append('<table class="wikitable">\n<tr><th>A</th><th>B</th><th colspan="2">C</th></tr>\n')
+    row = 0
+    while length < size:
+        part = f'<tr><td>{row}</td><td>{words(3)}</td><td><a href="/r{row}">r{row}</a></td><td><img src="i.png" alt="i"></td></tr>\n'
+        parts.append(part)
+        length += len(part)
+        row += 1
+    parts.append("</table>\n</div>\n</body>\n</html>\n")
+    return "".join(parts)
+
+
+def normalize(text: str) -> str:
+    # What MarkdownConverter._convert does to every result
+    text = "\n".join([line.rstrip() for line in re.split(r"\r?\n", text)])
+    return re.sub(r"\n{3,}", "\n\n", text)
+
+
+def corpus_files(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, n) for n in sorted(names) if n.lower().endswith((".html", ".htm")))
+        else:
+            files.append(path)
+    return files
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def convert(engine: str, path: str) -> Tuple[float, str]:
+    converter = HtmlConverter()
+    converter.html_engine = engine
+    start = time.perf_counter()
+    result = converter.convert(path, file_extension=".html")
+    return time.perf_counter() - start, normalize(result.text_content)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*", help="HTML files or directories, generated pages are used when empty")
+    parser.add_argument("--sizes", nargs="+", default=["10K", "100K", "1M"], help="Sizes of the generated pages")
+    parser.add_argument("--pages", type=int, default=5, help="Generated pages per size")
+    parser.add_argument("--show-diffs", type=int, default=0, help="Print the diff of this many differing pages")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = corpus_files(args.paths)
+        if len(files) == 0:
+            for label in args.sizes:
+                for seed in range(args.pages):
+                    path = os.path.join(tmp, f"{label}_{seed}.html")
+                    with open(path, "w", encoding="utf-8") as fh:
+                        fh.write(make_page(parse_size(label), seed))
+                    files.append(path)
+
+        times = {engine: [] for engine in ENGINES}
+        total_bytes = 0
+        differing = 0
+        for path in files:
+            total_bytes += os.path.getsize(path)
+            outputs = {}
+            for engine in ENGINES:
+                seconds, outputs[engine] = convert(engine, path)
+                times[engine].append(seconds)
+            if outputs["html.parser"] != outputs["lxml"]:
+                differing += 1
+                if differing <= args.show_diffs:
+                    print(f"--- {path}")
+                    diff = difflib.unified_diff(outputs["html.parser"].splitlines(True), outputs["lxml"].splitlines(True), n=1)
+                    print("".join(list(diff)[:40]))
+
+    megabytes = total_bytes / (1024 * 1024)
+    print(f"{len(files)} pages, {megabytes:.1f} MB, {differing} with differing output")
+    print(f"{'engine':>12} {'MB/s':>8} {'p50_ms':>10} {'p95_ms':>10} {'total_s':>9}")
+    for engine in ENGINES:
+        total = sum(times[engine])
+        print(
+            f"{engine:>12} {megabytes / max(total, 1e-9):>8.2f} {1000 * percentile(times[engine], 0.5):>10.1f} "
+            f"{1000 * percentile(times[engine], 0.95):>10.1f} {total:>9.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
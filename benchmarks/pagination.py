@@ -0,0 +1,98 @@
+"""Compare the old eager character-walking pagination with the lazy regex ViewportPages.
+
+For each page size it times setting the content and reading page 1 (what most visits do),
+and splitting the whole page (what `len()` and find_on_page need).
+
+Usage:
+    python benchmarks/pagination.py
+    python benchmarks/pagination.py --sizes 1K 1M 100M --viewport 16384 --no-legacy
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils.browser_utils import ViewportPages  # noqa: E402
+
+_UNITS = {"K": 1024, "M": 1024 * 1024, "G": 1024 * 1024 * 1024}
+
+
+def parse_size(value: str) -> int:
+    if value[-1].upper() in _UNITS:
+        return int(float(value[:-1]) * _UNITS[value[-1].upper()])
+    return int(value)
+
+
+def legacy_split(content: str, viewport_size: int) -> List[Tuple[int, int]]:
+    """The pagination SimpleTextBrowser used before ViewportPages."""
+    if len(content) == 0:
+        return [(0, 0)]
+    pages = []
+    start_idx = 0
+    while start_idx < len(content):
+        end_idx = min(start_idx + viewport_size, len(content))
+        while end_idx < len(content) and content[end_idx - 1] not in [" ", "\t", "\r", "\n"]:
+            end_idx += 1
+        pages.append((start_idx, end_idx))
+        start_idx = end_idx
+    return pages
+
+
+def make_page(size: int, seed: int = 0) -> str:
+    # Words of 1 to 40 characters with the odd newline, like converted PDFs and CSV dumps
+    rng = random.Random(seed)
+    words = ["".join(rng.choice("abcdefghij0123456789,.") for _ in range(rng.randint(1, 40))) for _ in range(4096)]
+    parts = []
+    length = 0
+    while length < size:
+        word = rng.choice(words)
+        parts.append(word)
+        parts.append("\n" if rng.random() < 0.05 else " ")
+        length += len(word) + 1
+    return "".join(parts)[:size]
+
+
+def timed(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", default=["1K", "10K", "100K", "1M", "10M", "100M"])
+    parser.add_argument("--viewport", type=int, default=1024 * 16)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-legacy", action="store_true", help="Skip the old implementation, it is slow on 100M")
+    args = parser.parse_args()
+
+    print(f"{'size':>8} {'pages':>8} {'legacy_all_ms':>14} {'lazy_first_ms':>14} {'lazy_all_ms':>12} {'lazy_MB/s':>10}")
+    for label in args.sizes:
+        size = parse_size(label)
+        content = make_page(size)
+
+        lazy_first = timed(lambda: ViewportPages(content, args.viewport)[0], args.repeat)
+        lazy_all = timed(lambda: len(ViewportPages(content, args.viewport)), args.repeat)
+        pages = ViewportPages(content, args.viewport)
+        legacy_all = None
+        if not args.no_legacy:
+            legacy_all = timed(lambda: legacy_split(content, args.viewport), args.repeat)
+            assert list(pages) == legacy_split(content, args.viewport), "viewport bounds differ"
+
+        print(
+            f"{label:>8} {len(pages):>8} "
+            f"{'-' if legacy_all is None else f'{1000 * legacy_all:.3f}':>14} "
+            f"{1000 * lazy_first:>14.3f} {1000 * lazy_all:>12.3f} "
+            f"{size / (1024 * 1024) / max(lazy_all, 1e-9):>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Compare the old PptxConverter, which sent every table through BeautifulSoup and markdownify, with the current one.
+
+For each deck size it writes a deck whose slides have a title, a text box, a table and
+notes, then converts it in a fresh process with the old converter, the current converter
+on one process, and the current converter with the slide pool. It reports the wall time and
+the peak resident memory of the converting process (the pool's workers are not counted).
+The old converter only runs up to --legacy-max-slides.
+
+Usage:
+    python benchmarks/pptx_render.py
+    python benchmarks/pptx_render.py --slides 100 1000 --table-rows 40
+"""
+import argparse
+import html
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+PATHS = ("legacy", "serial", "parallel")
+
+
+def make_deck(path: str, slides: int, table_rows: int, table_columns: int) -> None:
+    from pptx import Presentation
+    from pptx.util import Inches
+
+    presentation = Presentation()
+    for s in range(slides):
+        slide = presentation.slides.add_slide(presentation.slide_layouts[5])
+        slide.shapes.title.text = f"Slide {s}"
+        box = slide.shapes.add_textbox(Inches(1), Inches(1), Inches(4), Inches(1))
+        box.text_frame.text = f"Findings for slide {s}: *growth* in segment_{s % 7}"
+        table = slide.shapes.add_table(table_rows, table_columns, Inches(1), Inches(2), Inches(8), Inches(4)).table
+        for r in range(table_rows):
+            for c in range(table_columns):
+                table.cell(r, c).text = f"header {c}" if r == 0 else f"{r * c} <units>"
+        slide.notes_slide.notes_text_frame.text = f"Speaker notes for slide {s}"
+    presentation.save(path)
+
+
+def legacy_convert(path: str) -> str:
+    """PptxConverter.convert before tables were written directly, with its string concatenation."""
+    from pptx import Presentation
+
+    from utils.mdconvert import HtmlConverter, PptxConverter
+
+    converter = PptxConverter()
+    md_content = ""
+    presentation = Presentation(path)
+    slide_num = 0
+    for slide in presentation.slides:
+        slide_num += 1
+        md_content += f"\n\n<!-- Slide number: {slide_num} -->\n"
+        title = slide.shapes.title
+        for shape in slide.shapes:
+            if converter._is_picture(shape):
+                md_content += "\n![" + shape.name + "](" + re.sub(r"\W", "", shape.name) + ".jpg)\n"
+            if converter._is_table(shape):
+                html_table = "<html><body><table>"
+                first_row = True
+                for row in shape.table.rows:
+                    html_table += "<tr>"
+                    for cell in row.cells:
+                        tag = "th" if first_row else "td"
+                        html_table += f"<{tag}>" + html.escape(cell.text) + f"</{tag}>"
+                    html_table += "</tr>"
+                    first_row = False
+                html_table += "</table></body></html>"
+                md_content += "\n" + HtmlConverter()._convert(html_table).text_content.strip() + "\n"
+            elif shape.has_text_frame:
+                if shape == title:
+                    md_content += "# " + shape.text.lstrip() + " "
+                else:
+                    md_content += shape.text + " "
+        md_content = md_content.strip()
+        if slide.has_notes_slide:
+            md_content += "\n\n### Notes:\n"
+            notes_frame = slide.notes_slide.notes_text_frame
+            if notes_frame is not None:
+                md_content += notes_frame.text
+            md_content = md_content.strip()
+    return md_content.strip()
+
+
+def run_child(path_name: str, path: str) -> None:
+    from utils.mdconvert import PptxConverter
+
+    start = time.perf_counter()
+    if path_name == "legacy":
+        text = legacy_convert(path)
+    else:
+        text = PptxConverter().convert(path, file_extension=".pptx", parallel_slides=path_name == "parallel").text_content
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"seconds": seconds, "peak_mb": peak_mb, "chars": len(text)}))
+
+
+def measure(path_name: str, path: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", path_name, path],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--slides", nargs="+", type=int, default=[50, 300, 1000])
+    parser.add_argument("--table-rows", type=int, default=20)
+    parser.add_argument("--table-columns", type=int, default=6)
+    parser.add_argument("--legacy-max-slides", type=int, default=300)
+    parser.add_argument("--child", nargs=2, metavar=("PATH_NAME", "FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(*args.child)
+        return
+
+    print(f"{'slides':>7} {'file_MB':>8}" + "".join(f" {name + '_s':>11} {name + '_MB':>12}" for name in PATHS) + f" {'md_chars':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for slides in args.slides:
+            path = os.path.join(tmp, f"{slides}.pptx")
+            make_deck(path, slides, args.table_rows, args.table_columns)
+            results = {
+                name: measure(name, path) if name != "legacy" or slides <= args.legacy_max_slides else None for name in PATHS
+            }
+            line = f"{slides:>7} {os.path.getsize(path) / (1024 * 1024):>8.1f}"
+            for name in PATHS:
+                result = results[name]
+                line += f" {'-' if result is None else format(result['seconds'], '.2f'):>11}"
+                line += f" {'-' if result is None else format(result['peak_mb'], '.0f'):>12}"
+            print(line + f" {results['serial']['chars']:>9}")
+
+
+if __name__ == "__main__":
+    main()
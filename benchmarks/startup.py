@@ -0,0 +1,86 @@
+"""Measure how long a Sibyl actor takes to import and build its browser, and the memory it holds.
+
+Usage:
+    python benchmarks/startup.py --actors 16
+    python benchmarks/startup.py --actors 4 --no-ray   # fresh subprocesses instead of Ray actors
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+
+def measure_startup() -> dict:
+    start = time.perf_counter()
+    from utils.browser_utils import SimpleTextBrowser
+    import_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    SimpleTextBrowser(viewport_size=1024 * 16, downloads_folder="coding")
+    init_time = time.perf_counter() - start
+
+    from utils.mdconvert import BACKEND_IMPORT_TIMES
+
+    return {
+        "pid": os.getpid(),
+        "import_s": round(import_time, 3),
+        "browser_init_s": round(init_time, 3),
+        "peak_rss_mb": round(rss_mb(), 1),
+        "backends_loaded": sorted(BACKEND_IMPORT_TIMES),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--actors", type=int, default=4)
+    parser.add_argument("--no-ray", action="store_true", help="Start plain subprocesses instead of Ray actors")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_startup()))
+        return
+
+    wall_start = time.perf_counter()
+    if args.no_ray:
+        procs = [
+            subprocess.Popen([sys.executable, __file__, "--child"], stdout=subprocess.PIPE, text=True)
+            for _ in range(args.actors)
+        ]
+        results = [json.loads(proc.communicate()[0]) for proc in procs]
+    else:
+        import ray
+
+        ray.init()
+
+        @ray.remote
+        class StartupProbe:
+            def measure(self):
+                return measure_startup()
+
+        probes = [StartupProbe.remote() for _ in range(args.actors)]
+        results = ray.get([probe.measure.remote() for probe in probes])
+    wall_time = time.perf_counter() - wall_start
+
+    for result in results:
+        print(result)
+    print(
+        f"{args.actors} actors ready in {wall_time:.2f}s, "
+        f"mean import {sum(r['import_s'] for r in results) / len(results):.2f}s, "
+        f"mean peak RSS {sum(r['peak_rss_mb'] for r in results) / len(results):.0f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Compare the old pandas/to_html/markdownify XLSX conversion with the streaming XlsxConverter.
+
+For each row count it writes a workbook of mixed columns (int, float, text, date), then
+converts it with both paths in a fresh process each. It reports the wall time and the
+peak resident memory of that process. The legacy path gets slow quickly, so it only runs
+up to --legacy-max-rows.
+
+Usage:
+    python benchmarks/xlsx_render.py
+    python benchmarks/xlsx_render.py --rows 10K 50K --legacy-max-rows 50K
+"""
+import argparse
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+_UNITS = {"K": 1000, "M": 1000 * 1000}
+
+
+def parse_count(value: str) -> int:
+    if value[-1].upper() in _UNITS:
+        return int(float(value[:-1]) * _UNITS[value[-1].upper()])
+    return int(value)
+
+
+def make_workbook(path: str, rows: int, columns: int) -> None:
+    import openpyxl
+
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Data")
+    sheet.append([f"column_{c}" for c in range(columns)])
+    start = datetime.datetime(2020, 1, 1)
+    for r in range(rows):
+        row = []
+        for c in range(columns):
+            kind = c % 4
+            if kind == 0:
+                row.append(r)
+            elif kind == 1:
+                row.append(r * 0.25)
+            elif kind == 2:
+                row.append(f"item {r % 997} of group {c}")
+            else:
+                row.append(start + datetime.timedelta(hours=r))
+        sheet.append(row)
+    workbook.save(path)
+
+
+def legacy_convert(path: str) -> str:
+    """The XlsxConverter before streaming: pandas, to_html, then BeautifulSoup and markdownify."""
+    import pandas as pd
+
+    from utils.mdconvert import HtmlConverter
+
+    sheets = pd.read_excel(path, sheet_name=None)
+    md_content = ""
+    for s in sheets:
+        md_content += f"## {s}\n"
+        html_content = sheets[s].to_html(index=False)
+        md_content += HtmlConverter()._convert(html_content).text_content.strip() + "\n\n"
+    return md_content.strip()
+
+
+def streaming_convert(path: str) -> str:
+    from utils.mdconvert import XlsxConverter
+
+    return XlsxConverter().convert(path, file_extension=".xlsx").text_content
+
+
+def run_child(path_name: str, path: str) -> None:
+    convert = legacy_convert if path_name == "legacy" else streaming_convert
+    start = time.perf_counter()
+    text = convert(path)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"seconds": seconds, "peak_mb": peak_mb, "chars": len(text)}))
+
+
+def measure(path_name: str, path: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--child", path_name, path],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", nargs="+", default=["10K", "100K", "1M"])
+    parser.add_argument("--columns", type=int, default=8)
+    parser.add_argument("--legacy-max-rows", default="10K", help="Skip the legacy path above this many rows, it takes minutes at 100K")
+    parser.add_argument("--child", nargs=2, metavar=("PATH_NAME", "FILE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(*args.child)
+        return
+
+    legacy_max_rows = parse_count(args.legacy_max_rows)
+    print(f"{'rows':>8} {'file_MB':>8} {'legacy_s':>9} {'legacy_MB':>10} {'stream_s':>9} {'stream_MB':>10} {'md_chars':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for label in args.rows:
+            rows = parse_count(label)
+            path = os.path.join(tmp, f"{label}.xlsx")
+            make_workbook(path, rows, args.columns)
+
+            legacy = measure("legacy", path) if rows <= legacy_max_rows else None
+            streaming = measure("streaming", path)
+            print(
+                f"{label:>8} {os.path.getsize(path) / (1024 * 1024):>8.1f} "
+                f"{'-' if legacy is None else format(legacy['seconds'], '.2f'):>9} "
+                f"{'-' if legacy is None else format(legacy['peak_mb'], '.0f'):>10} "
+                f"{streaming['seconds']:>9.2f} {streaming['peak_mb']:>10.0f} {streaming['chars']:>9}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 import os
-from typing import Tuple, Any, List
+from typing import Tuple, Any, List, Dict
 import re
-import sqlite3
+import json
+import time
+import argparse
+import asyncio
+import functools
+import copy
+from concurrent.futures import ThreadPoolExecutor
 
 from langchain_core.outputs import LLMResult
 import ray
@@ -16,9 +22,9 @@ from rich import box
 
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
-from langchain_core.output_parsers import JsonOutputParser, StrOutputParser
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.exceptions import OutputParserException
 from langchain_openai import ChatOpenAI
-from langchain_community.cache import SQLiteCache
 from langchain_core.callbacks import BaseCallbackHandler
 
 from autogen.code_utils import execute_code
@@ -27,6 +33,19 @@ from autogen.agentchat.contrib.society_of_mind_agent import SocietyOfMindAgent
 
 from utils.score import question_scorer
 from utils.browser_utils import SimpleTextBrowser
+from utils.http_session import get_session
+from utils.http_cache import get_http_cache
+from utils.conversion_cache import get_conversion_cache
+from utils.mdconvert import conversion_stats
+from utils.search_providers import get_local_search_provider
+from utils.prefetch import get_prefetcher
+from utils.downloads import get_download_store
+from utils.pdf_pages import get_pdf_extractor
+from utils.qa_cache import QACache, hash_prompts
+from utils.llm_cache import TwoTierLLMCache
+from utils.tool_calling import RepairingJsonOutputParser, IncrementalJsonObjectParser, tool_schema, parse_tool_call
+from utils.rate_limiter import get_rate_limiter, rate_limited_http_clients, llm_stage
+from utils.model_services import get_asr_service, get_ocr_service
 
 MODEL='gpt-4o'
 DATA_NAME = '2023_level1'
@@ -34,14 +53,40 @@ SPLIT = 'validation'
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_API_BASE = os.getenv('OPENAI_API_BASE')
 BING_API_KEY = os.getenv('BING_API_KEY')
+# Number of Sibyl actors, and how many questions each actor drives at once.
+# Questions spend most of their time waiting on the network, so a few actors
+# with many questions in flight each replace one heavyweight actor per question.
+NUM_ACTORS = 4
+MAX_CONCURRENT_QUESTIONS_PER_ACTOR = 16
+# Provider limits, enforced across the whole pool by the shared rate limiter
+LLM_REQUESTS_PER_MINUTE = 500
+LLM_TOKENS_PER_MINUTE = 300000
+# Choose tools through the model's native function calling instead of a JSON answer
+TOOL_CALLING = True
+# Without native tool calling, stream the JSON answer and start the tool as soon as
+# `tool` and `tool_args` are complete. Streamed calls do not go through the LLM cache.
+STREAM_TOOL_CHOICE = False
 
-os.makedirs(f".cache/qa_cache/{SPLIT}", exist_ok=True)
-qa_cache_db = sqlite3.connect(f".cache/qa_cache/{SPLIT}/{DATA_NAME}.db")
-qa_cache_db.execute('''CREATE TABLE IF NOT EXISTS qa_cache
-        (question TEXT PRIMARY KEY     NOT NULL,
-        answer           TEXT    NOT NULL);''')
-qa_cache_db.commit()
-qa_cache_db.close()
+EXP_NAME = "babyagi_with_som_answer"
+# One JSON line per finished question, appended as results come in
+CHECKPOINT_PATH = f'results/{SPLIT}/{DATA_NAME}_{EXP_NAME}.checkpoint.jsonl'
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--resume', action='store_true', help='Skip questions already recorded in the checkpoint')
+parser.add_argument('--offline', action='store_true', help='Serve web pages only from the HTTP cache, never from the network')
+parser.add_argument('--search', choices=['bing', 'local'], default='bing', help='Answer web searches with Bing or with BM25 over LOCAL_SEARCH_CORPUS')
+cli_args = parser.parse_args()
+
+QA_CACHE_PATH = f".cache/qa_cache/{SPLIT}/{DATA_NAME}.db"
+LLM_CACHE_DIR = ".cache/llm"
+HTTP_CACHE_DIR = ".cache/http"
+# Downloads are kept here once per content hash, the downloads folder gets a clone or copy of each
+DOWNLOAD_STORE_DIR = ".cache/downloads"
+# Documents searched by --search local: .txt/.md/.html files, or .jsonl records of {"url", "title", "text"}
+LOCAL_SEARCH_CORPUS = "data/search_corpus"
+LOCAL_SEARCH_INDEX_DIR = ".cache/bm25"
+# Result pages fetched and converted in the background after every search, see prefetch hit_rate in the stats
+PREFETCH_TOP_K = 3
 
 class LLMCallbackHandler(BaseCallbackHandler):
 
@@ -61,6 +106,21 @@ class ToolChoice(BaseModel):
     tool: str = Field(description="The tool to use")
     tool_args: dict = Field(description="The arguments to pass to the tool")
 
+class StreamingToolChoice(BaseModel):
+    # The tool fields come first so the tool can start while the reasoning is still generating
+    tool: str = Field(description="The tool to use")
+    tool_args: dict = Field(description="The arguments to pass to the tool")
+    reason: str = Field(description="Step by step reasoning")
+
+TOOL_NAMES = ['informational_web_search', 'navigational_web_search', 'visit_page', 'page_up', 'page_down', 'download_file', 'find_on_page_ctrl_f', 'find_next', 'computer_terminal', 'None']
+
+def is_valid_tool_choice(tool_choice: dict) -> bool:
+    if tool_choice.get('tool') not in TOOL_NAMES or not isinstance(tool_choice.get('tool_args'), dict):
+        return False
+    if tool_choice['tool'] == 'computer_terminal' and tool_choice['tool_args'].get('code', '') == '':
+        return False
+    return True
+
 class ImproveCode(BaseModel):
     reason: str = Field(description="Step by step reasoning on how to improve the code")
     improved_code: str = Field(description="The improved code")
@@ -77,24 +137,77 @@ with open('prompts/summarize_step.txt') as f:
 with open('prompts/improve_code.txt') as f:
     IMPROVE_CODE_PROMPT_TEMPLATE = f.read()
 
+TOOL_CALLING_FORMAT_INSTRUCTIONS = "Answer by calling exactly one of the provided functions."
+
+ACTOR_SYSTEM_MESSAGE = '''You are a helpful assistant.  When answering a question, you must explain your thought process step by step before answering the question. When others make suggestions about your answers, think carefully about whether or not to adopt the opinions of others.
+If you are unable to solve the question, make a well-informed EDUCATED GUESS based on the information we have provided. Your EDUCATED GUESS should be a number OR as few words as possible OR a comma separated list of numbers and/or strings. DO NOT OUTPUT 'I don't know', 'Unable to determine', etc.'''
+
+CRITIC_SYSTEM_MESSAGE = '''You are a helpful assistant.You want to help others spot logical or intellectual errors. When and only when you can't find a logical flaw in the other person's reasoning, you should say "TERMINATE" to end the conversation.'''
+
+# Everything besides the question that shapes an answer: the prompts, the agents' system
+# messages, the format instructions and the tool choice modes they are rendered for
+with open("prompts/format_answer.txt") as f1, open('prompts/choose_tool.txt') as f2, open('prompts/summarize_step.txt') as f3:
+    PROMPT_HASH = hash_prompts(
+        f1.read(), f2.read(), f3.read(), IMPROVE_CODE_PROMPT_TEMPLATE,
+        ACTOR_SYSTEM_MESSAGE, CRITIC_SYSTEM_MESSAGE,
+        TOOL_CALLING_FORMAT_INSTRUCTIONS if TOOL_CALLING else RepairingJsonOutputParser(pydantic_object=ToolChoice).get_format_instructions(),
+        RepairingJsonOutputParser(pydantic_object=StreamingToolChoice).get_format_instructions(),
+        RepairingJsonOutputParser(pydantic_object=ImproveCode).get_format_instructions(),
+        f"TOOL_CALLING={TOOL_CALLING}", f"STREAM_TOOL_CHOICE={STREAM_TOOL_CHOICE}",
+    )
+
 @ray.remote
 class Sibyl:
     def __init__(self):
-        cache = SQLiteCache("llm_cache.sqlite")
-        self.llm = ChatOpenAI(model=MODEL, temperature=0, streaming=False, max_retries=5, api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE, cache=cache)
-        self.llm_without_cache = ChatOpenAI(model=MODEL, temperature=0.1, streaming=False, max_retries=5, api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE)
+        # Answers are keyed on the model and prompts too, so prompt edits never serve stale answers
+        self.qa_cache = QACache(QA_CACHE_PATH, model=MODEL, prompt_hash=PROMPT_HASH)
+
+        # Every request to the provider waits for a slot from the pool-wide rate limiter
+        self.http_client, self.http_async_client = rate_limited_http_clients(get_rate_limiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE))
+
+        self.llm_cache = TwoTierLLMCache(LLM_CACHE_DIR)
+        # Every browser of this actor fetches pages through the shared on-disk HTTP cache
+        self.http_cache = get_http_cache(directory=HTTP_CACHE_DIR, offline=cli_args.offline)
+        self.download_store = get_download_store(directory=DOWNLOAD_STORE_DIR)
+        self.llm = ChatOpenAI(model=MODEL, temperature=0, streaming=False, max_retries=5, api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE, cache=self.llm_cache, http_client=self.http_client, http_async_client=self.http_async_client)
+        self.llm_without_cache = ChatOpenAI(model=MODEL, temperature=0.1, streaming=False, max_retries=5, api_key=OPENAI_API_KEY, base_url=OPENAI_API_BASE, http_client=self.http_client, http_async_client=self.http_async_client)
         self.format_answer_chain = FORMAT_ANSWER_PROMPT | self.llm | StrOutputParser()
 
-        self.tool_choice_output_parser = JsonOutputParser(pydantic_object=ToolChoice)
-        choose_tool_prompt = PromptTemplate(
+        self.tool_choice_output_parser = RepairingJsonOutputParser(pydantic_object=ToolChoice)
+        if TOOL_CALLING:
+            # Schemas come from the tool signatures, "None" ends the loop
+            tools = [
+                tool_schema(tool) for tool in [
+                    self.informational_web_search, self.navigational_web_search, self.visit_page, self.page_up, self.page_down,
+                    self.download_file, self.find_on_page_ctrl_f, self.find_next, self.computer_terminal,
+                ]
+            ] + [tool_schema(self.finish, name="None")]
+            choose_tool_prompt = PromptTemplate(
+                template=CHOOSE_TOOL_PROMPT_TEMPLATE, 
+                input_variables=['steps', 'question'], 
+                partial_variables={"format_instructions": TOOL_CALLING_FORMAT_INSTRUCTIONS}
+            )
+            self.choose_tool_chain = choose_tool_prompt | self.llm.bind_tools(tools, tool_choice="required") | parse_tool_call
+            self.choose_tool_chain_without_cache = choose_tool_prompt | self.llm_without_cache.bind_tools(tools, tool_choice="required") | parse_tool_call
+        else:
+            choose_tool_prompt = PromptTemplate(
+                template=CHOOSE_TOOL_PROMPT_TEMPLATE, 
+                input_variables=['steps', 'question'], 
+                partial_variables={"format_instructions": self.tool_choice_output_parser.get_format_instructions()}
+            )
+            self.choose_tool_chain = choose_tool_prompt | self.llm | self.tool_choice_output_parser
+            self.choose_tool_chain_without_cache = choose_tool_prompt | self.llm_without_cache | self.tool_choice_output_parser
+
+        streaming_tool_choice_parser = RepairingJsonOutputParser(pydantic_object=StreamingToolChoice)
+        choose_tool_streaming_prompt = PromptTemplate(
             template=CHOOSE_TOOL_PROMPT_TEMPLATE, 
             input_variables=['steps', 'question'], 
-            partial_variables={"format_instructions": self.tool_choice_output_parser.get_format_instructions()}
+            partial_variables={"format_instructions": streaming_tool_choice_parser.get_format_instructions()}
         )
-        self.choose_tool_chain = choose_tool_prompt | self.llm | self.tool_choice_output_parser
-        self.choose_tool_chain_without_cache = choose_tool_prompt | self.llm_without_cache | self.tool_choice_output_parser
+        self.choose_tool_streaming_chain = choose_tool_streaming_prompt | self.llm
+        self.choose_tool_streaming_chain_without_cache = choose_tool_streaming_prompt | self.llm_without_cache
 
-        self.improve_code_output_parser = JsonOutputParser(pydantic_object=ImproveCode)
+        self.improve_code_output_parser = RepairingJsonOutputParser(pydantic_object=ImproveCode)
         improve_code_prompt = PromptTemplate(
             template=IMPROVE_CODE_PROMPT_TEMPLATE, 
             input_variables=['steps', 'question', 'code'],
@@ -105,29 +218,37 @@ class Sibyl:
 
         self.summarize_tool_chain = SUMMARIZE_STEP_PROMPT_TEMPLATE | self.llm | StrOutputParser()
 
-        browser_config={
+        # Every question in flight gets its own browser (the viewport is per question),
+        # so only the config is kept on the actor
+        self.browser_config={
             "bing_api_key": BING_API_KEY,
             "viewport_size": 1024 * 16,
             "downloads_folder": "coding",
+            "prefetch_top_k": PREFETCH_TOP_K,
             "request_kwargs": {
                 "headers": {"User-Agent":  "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36 Edg/119.0.0.0"},
             },
         }
-        self.browser = SimpleTextBrowser(**browser_config)
+        # Searches go to Bing unless a local, network-free index was asked for
+        self.search_provider = get_local_search_provider(LOCAL_SEARCH_CORPUS, LOCAL_SEARCH_INDEX_DIR) if cli_args.search == 'local' else None
         self.llm_callback_handler = LLMCallbackHandler()
 
+        # Browser, terminal and autogen calls are blocking, run them off the event loop
+        self.tool_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_QUESTIONS_PER_ACTOR)
+
+    def _build_society_of_mind(self) -> Tuple[autogen.UserProxyAgent, SocietyOfMindAgent]:
+        # The group chat keeps its messages on the agents, so each question needs its own set
         agent1 = autogen.ConversableAgent(
             name="Actor",
-            system_message='''You are a helpful assistant.  When answering a question, you must explain your thought process step by step before answering the question. When others make suggestions about your answers, think carefully about whether or not to adopt the opinions of others.
-If you are unable to solve the question, make a well-informed EDUCATED GUESS based on the information we have provided. Your EDUCATED GUESS should be a number OR as few words as possible OR a comma separated list of numbers and/or strings. DO NOT OUTPUT 'I don't know', 'Unable to determine', etc.''',
-            llm_config={"config_list": [{"model": MODEL, "temperature": 0.1, "api_key": OPENAI_API_KEY, "base_url": OPENAI_API_BASE}]},
+            system_message=ACTOR_SYSTEM_MESSAGE,
+            llm_config={"config_list": [{"model": MODEL, "temperature": 0.1, "api_key": OPENAI_API_KEY, "base_url": OPENAI_API_BASE, "http_client": self.http_client}]},
             is_termination_msg=lambda x: x.get("content", "").find("TERMINATE") >= 0,
         )
 
         agent2 = autogen.ConversableAgent(
             name="Critic",
-            system_message='''You are a helpful assistant.You want to help others spot logical or intellectual errors. When and only when you can't find a logical flaw in the other person's reasoning, you should say "TERMINATE" to end the conversation.''',
-            llm_config={"config_list": [{"model": MODEL, "temperature": 0, "api_key": OPENAI_API_KEY, "base_url": OPENAI_API_BASE}]},
+            system_message=CRITIC_SYSTEM_MESSAGE,
+            llm_config={"config_list": [{"model": MODEL, "temperature": 0, "api_key": OPENAI_API_KEY, "base_url": OPENAI_API_BASE, "http_client": self.http_client}]},
         )
 
         groupchat = autogen.GroupChat(
@@ -141,73 +262,96 @@ If you are unable to solve the question, make a well-informed EDUCATED GUESS bas
         manager = autogen.GroupChatManager(
             groupchat=groupchat,
             is_termination_msg=lambda x: x.get("content", "").find("TERMINATE") >= 0,
-            llm_config={"config_list": [{"model": MODEL, "temperature": 0.0, "api_key": OPENAI_API_KEY, "base_url": OPENAI_API_BASE}]},
+            llm_config={"config_list": [{"model": MODEL, "temperature": 0.0, "api_key": OPENAI_API_KEY, "base_url": OPENAI_API_BASE, "http_client": self.http_client}]},
         )
 
-        self.society_of_mind_agent = SocietyOfMindAgent(
+        society_of_mind_agent = SocietyOfMindAgent(
             "society_of_mind",
             chat_manager=manager,
-            llm_config={"config_list": [{"model": MODEL, "temperature": 0.0, "api_key": OPENAI_API_KEY, "base_url": OPENAI_API_BASE}]}
+            llm_config={"config_list": [{"model": MODEL, "temperature": 0.0, "api_key": OPENAI_API_KEY, "base_url": OPENAI_API_BASE, "http_client": self.http_client}]}
         )
 
-        self.user_proxy = autogen.UserProxyAgent(
+        user_proxy = autogen.UserProxyAgent(
             "user_proxy",
             human_input_mode="NEVER",
             code_execution_config=False,
             default_auto_reply="",
             is_termination_msg=lambda x: True,
         )
-
-    def browser_state(self) -> Tuple[str, str]:
-        header = f"Address: {self.browser.address}\n"
-        if self.browser.page_title is not None:
-            header += f"Title: {self.browser.page_title}\n"
-
-        current_page = self.browser.viewport_current_page
-        total_pages = len(self.browser.viewport_pages)
-
-        header += f"Viewport position: Showing page {current_page+1} of {total_pages}.\n"
-        return (header, self.browser.viewport)
+        return user_proxy, society_of_mind_agent
+
+    def society_of_mind_answer(self, message: str) -> str:
+        user_proxy, society_of_mind_agent = self._build_society_of_mind()
+        with llm_stage("answer"):
+            return user_proxy.initiate_chat(society_of_mind_agent, message=message).summary
+
+    async def run_blocking(self, func, *args, **kwargs) -> Any:
+        """Run a blocking tool call on the tool executor without stalling the other questions."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.tool_executor, functools.partial(func, *args, **kwargs))
+
+    def browser_state(self, browser: SimpleTextBrowser) -> Tuple[str, str]:
+        header = f"Address: {browser.address}\n"
+        if browser.page_title is not None:
+            header += f"Title: {browser.page_title}\n"
+
+        # Read first, it takes in the pages of a PDF extracted so far
+        viewport = browser.viewport
+        current_page = browser.viewport_current_page
+        total_pages = len(browser.viewport_pages)
+
+        if browser.page_streaming:
+            header += f"Viewport position: Showing page {current_page+1} of {total_pages} so far, more pages are still being extracted.\n"
+        else:
+            header += f"Viewport position: Showing page {current_page+1} of {total_pages}.\n"
+        return (header, viewport)
     
-    def informational_web_search(self, query: str) -> str:
-        self.browser.visit_page(f"bing: {query}")
-        header, content = self.browser_state()
+    def informational_web_search(self, browser: SimpleTextBrowser, query: str) -> str:
+        """Perform an INFORMATIONAL web search query and return the search results."""
+        browser.visit_page(f"bing: {query}")
+        header, content = self.browser_state(browser)
         return header.strip() + "\n=======================\n" + content
     
-    def navigational_web_search(self, query: str) -> str:
-        self.browser.visit_page(f"bing: {query}")
-        # Extract the first linl
-        m = re.search(r"\[.*?\]\((http.*?)\)", self.browser.page_content)
+    def navigational_web_search(self, browser: SimpleTextBrowser, query: str) -> str:
+        """Perform a NAVIGATIONAL web search query and immediately navigate to the top result. Useful, for example, to navigate to a particular Wikipedia article or other known destination. Equivalent to Google's "I'm Feeling Lucky" button."""
+        browser.visit_page(f"bing: {query}")
+        # Extract the first link, local search results are file:// URLs
+        m = re.search(r"\[.*?\]\(((?:https?|file)://.*?)\)", browser.page_content)
         if m:
-            self.browser.visit_page(m.group(1))
+            browser.visit_page(m.group(1))
 
         # Return where we ended up
-        header, content = self.browser_state()
+        header, content = self.browser_state(browser)
         return header.strip() + "\n=======================\n" + content
 
-    def visit_page(self, url: str) -> str:
-        self.browser.visit_page(url)
-        header, content = self.browser_state()
+    def visit_page(self, browser: SimpleTextBrowser, url: str) -> str:
+        """Visit a webpage at a given URL and return its text."""
+        browser.visit_page(url)
+        header, content = self.browser_state(browser)
         return header.strip() + "\n=======================\n" + content
 
-    def page_up(self) -> str:
-        self.browser.page_up()
-        header, content = self.browser_state()
+    def page_up(self, browser: SimpleTextBrowser) -> str:
+        """Scroll the viewport UP one page-length in the current webpage and return the new viewport content."""
+        browser.page_up()
+        header, content = self.browser_state(browser)
         return header.strip() + "\n=======================\n" + content
 
-    def page_down(self) -> str:
-        self.browser.page_down()
-        header, content = self.browser_state()
+    def page_down(self, browser: SimpleTextBrowser) -> str:
+        """Scroll the viewport DOWN one page-length in the current webpage and return the new viewport content."""
+        browser.page_down()
+        header, content = self.browser_state(browser)
         return header.strip() + "\n=======================\n" + content
 
-    def download_file(self, url: str) -> str:
-        self.browser.visit_page(url)
-        header, content = self.browser_state()
+    def download_file(self, browser: SimpleTextBrowser, url: str) -> str:
+        """Download a file at a given URL and, if possible, return its text."""
+        browser.visit_page(url)
+        header, content = self.browser_state(browser)
         return header.strip() + "\n=======================\n" + content
 
-    def find_on_page_ctrl_f(self, search_string: str) -> str:
-        find_result = self.browser.find_on_page(search_string)
-        header, content = self.browser_state()
+    def find_on_page_ctrl_f(self, browser: SimpleTextBrowser, search_string: str) -> str:
+        """Scroll the viewport to the first occurrence of the search string. This is equivalent to Ctrl+F. The search string supports wildcards like '*'."""
+        find_result = browser.find_on_page(search_string)
+        header, content = self.browser_state(browser)
 
         if find_result is None:
             return (
@@ -219,36 +363,118 @@ If you are unable to solve the question, make a well-informed EDUCATED GUESS bas
         else:
             return header.strip() + "\n=======================\n" + content
 
-    def find_next(self) -> str:
-        find_result = self.browser.find_next()
-        header, content = self.browser_state()
+    def find_next(self, browser: SimpleTextBrowser) -> str:
+        """Scroll the viewport to the next occurrence of the search string."""
+        find_result = browser.find_next()
+        header, content = self.browser_state(browser)
 
         if find_result is None:
             return header.strip() + "\n=======================\nThe search string was not found on this page."
         else:
             return header.strip() + "\n=======================\n" + content
         
+    def finish(self) -> None:
+        """No tool is needed, the question can be answered with the information in the step history."""
+
     def computer_terminal(self, code: str) -> str:
+        """Run Python code and return its output. Use print() to output the result."""
         status_code, stdout, _ = execute_code(code, work_dir='coding', use_docker=False, timeout=20)
         return {
             "status_code": status_code,
             "stdout": stdout,
         }
 
-    def ask(self, raw_question: str, attachment_name: str = None) -> str:
-        cache_db = sqlite3.connect(f".cache/qa_cache/{SPLIT}/{DATA_NAME}.db")
-        cursor = cache_db.cursor()
-        cursor.execute(f"SELECT answer FROM qa_cache WHERE question = ?", (raw_question,))
-        row = cursor.fetchone()
-        cache_db.close()
+    def flush_caches(self) -> None:
+        self.qa_cache.flush()
+
+    def cache_stats(self) -> dict:
+        return {"qa_cache": self.qa_cache.stats(), "llm_cache": self.llm_cache.stats(), "http": get_session().stats(), "http_cache": self.http_cache.stats(), "conversions": get_conversion_cache().stats(), "pdf_pages": get_pdf_extractor().stats(), "converters": conversion_stats(), "prefetch": get_prefetcher().stats(), "downloads": self.download_store.stats()}
+
+    async def choose_tool_streaming(self, browser: SimpleTextBrowser, question: str, steps: List[str], retries: dict, use_cache: bool = True) -> Tuple[dict, Any]:
+        """Stream the tool choice, starting the tool as soon as `tool` and `tool_args` are complete.
 
-        if row is not None:
+        Returns the full tool choice and the task running the tool, if it was started.
+        """
+        chain = self.choose_tool_streaming_chain if use_cache else self.choose_tool_streaming_chain_without_cache
+        parser = IncrementalJsonObjectParser()
+        tool_task = None
+        early_choice = None
+        try:
+            async for chunk in chain.astream({'question': question, 'steps': '\n\n'.join(steps)}):
+                parser.feed(chunk.content)
+                if tool_task is None and is_valid_tool_choice(parser.values):
+                    early_choice = dict(parser.values)
+                    tool_task = asyncio.ensure_future(self.call_tool(browser, question, steps, early_choice['tool'], early_choice['tool_args'], retries))
+        except Exception as e:
+            if tool_task is None:
+                raise
+            # The tool is already running, only the reasoning tail was lost
+            print(f"Ignoring error: {e} after the tool choice was complete")
+
+        if tool_task is None:
+            return self.tool_choice_output_parser.parse(parser.text), None
+        try:
+            tool_choice = self.tool_choice_output_parser.parse(parser.text)
+        except OutputParserException:
+            tool_choice = {'reason': parser.values.get('reason', '')}
+        # The running tool is the one that counts
+        return {**tool_choice, 'tool': early_choice['tool'], 'tool_args': early_choice['tool_args']}, tool_task
+
+    async def call_tool(self, browser: SimpleTextBrowser, question: str, steps: List[str], tool: str, args: dict, retries: dict) -> Any:
+        tool_result = None
+        if tool == "informational_web_search":
+            tool_result = await self.run_blocking(self.informational_web_search, browser, **args)
+        elif tool == "navigational_web_search":
+            tool_result = await self.run_blocking(self.navigational_web_search, browser, **args)
+        elif tool == "visit_page":
+            tool_result = await self.run_blocking(self.visit_page, browser, **args)
+        elif tool == "page_up":
+            tool_result = await self.run_blocking(self.page_up, browser)
+        elif tool == "page_down":
+            tool_result = await self.run_blocking(self.page_down, browser)
+        elif tool == "download_file":
+            tool_result = await self.run_blocking(self.download_file, browser, **args)
+        elif tool == "find_on_page_ctrl_f":
+            tool_result = await self.run_blocking(self.find_on_page_ctrl_f, browser, **args)
+        elif tool == "find_next":
+            tool_result = await self.run_blocking(self.find_next, browser)
+        elif tool == 'computer_terminal':
+            improve_error = False
+            for _ in range(10):
+                try:
+                    origin_code = args['code']
+                    with llm_stage("improve_code"):
+                        if improve_error:
+                            improved_code = (await self.improve_code_chain_without_cache.ainvoke({'question': question, 'steps': '\n\n'.join(steps), 'code': origin_code}))['improved_code']
+                        else:
+                            improved_code = (await self.improve_code_chain.ainvoke({'question': question, 'steps': '\n\n'.join(steps), 'code': origin_code}))['improved_code']
+                    tool_result = await self.run_blocking(self.computer_terminal, improved_code)
+                    break
+                except Exception as e:
+                    print(f"Error: {e}")
+                    improve_error = True
+                    retries["improve_code"] += 1
+                    continue
+        elif tool == 'None':
+            tool_result = None
+        else:
+            print(f"Unknown tool: {tool}")
+            tool_result = None
+        return tool_result
+
+    async def ask(self, raw_question: str, attachment_name: str = None) -> Dict[str, Any]:
+        """Answer a question. Returns the answer with the step count, retries and wall time it took."""
+        start_time = time.time()
+        retries = {"choose_tool": 0, "improve_code": 0}
+        cached_answer = self.qa_cache.get(raw_question, attachment_name)
+        if cached_answer is not None:
             print(f"Cache hit for question: {raw_question}")
-            return row[0]
+            return {"answer": cached_answer, "steps": 0, "retries": retries, "wall_time": time.time() - start_time, "cached": True}
         else:
             print(f"Cache miss for question: {raw_question}")
 
         steps = []
+        browser = await self.run_blocking(SimpleTextBrowser, search_provider=self.search_provider, **copy.deepcopy(self.browser_config))
 
         if attachment_name is not None and attachment_name.strip() != "":
             question = f"{raw_question}\nAttachment: file:///Users/long/workspace/GAIA/2023/{SPLIT}/{attachment_name}"
@@ -258,112 +484,154 @@ If you are unable to solve the question, make a well-informed EDUCATED GUESS bas
 
         for _ in range(20):
             has_error = False
+            tool_task = None
             for _ in range(30):
                 try:
-                    if has_error:
-                        tool_choice = self.choose_tool_chain_without_cache.invoke({'question': question, 'steps': '\n\n'.join(steps)})
-                    else:
-                        tool_choice = self.choose_tool_chain.invoke({'question': question, 'steps': '\n\n'.join(steps)})
-                    if tool_choice['tool'] == 'computer_terminal' and tool_choice['tool_args'].get('code', '') == '':
-                        has_error = True
-                        continue
-                    elif tool_choice['tool'] not in ['informational_web_search', 'navigational_web_search', 'visit_page', 'page_up', 'page_down', 'download_file', 'find_on_page_ctrl_f', 'find_next', 'computer_terminal', 'None']:
+                    with llm_stage("choose_tool"):
+                        if STREAM_TOOL_CHOICE and not TOOL_CALLING:
+                            tool_choice, tool_task = await self.choose_tool_streaming(browser, question, steps, retries, use_cache=not has_error)
+                        elif has_error:
+                            tool_choice = await self.choose_tool_chain_without_cache.ainvoke({'question': question, 'steps': '\n\n'.join(steps)})
+                        else:
+                            tool_choice = await self.choose_tool_chain.ainvoke({'question': question, 'steps': '\n\n'.join(steps)})
+                    if not is_valid_tool_choice(tool_choice):
                         has_error = True
+                        retries["choose_tool"] += 1
                         continue
                     else:
                         break
                 except Exception as e:
                     print(f"Error: {e}")
                     has_error = True
+                    retries["choose_tool"] += 1
                     continue
             tool = tool_choice['tool']
             args = tool_choice['tool_args']
             pp(f"Tool: {tool}, Args: {args}")
-            if tool == "informational_web_search":
-                tool_result = self.informational_web_search(**args)
-            elif tool == "navigational_web_search":
-                tool_result = self.navigational_web_search(**args)
-            elif tool == "visit_page":
-                tool_result = self.visit_page(**args)
-            elif tool == "page_up":
-                tool_result = self.page_up()
-            elif tool == "page_down":
-                tool_result = self.page_down()
-            elif tool == "download_file":
-                tool_result = self.download_file(**args)
-            elif tool == "find_on_page_ctrl_f":
-                tool_result = self.find_on_page_ctrl_f(**args)
-            elif tool == "find_next":
-                tool_result = self.find_next()
-            elif tool == 'computer_terminal':
-                improve_error = False
-                for _ in range(10):
-                    try:
-                        origin_code = args['code']
-                        if improve_error:
-                            improved_code = self.improve_code_chain_without_cache.invoke({'question': question, 'steps': '\n\n'.join(steps), 'code': origin_code})['improved_code']
-                        else:
-                            improved_code = self.improve_code_chain.invoke({'question': question, 'steps': '\n\n'.join(steps), 'code': origin_code})['improved_code']
-                        tool_result = self.computer_terminal(improved_code)
-                        break
-                    except Exception as e:
-                        print(f"Error: {e}")
-                        improve_error = True
-                        continue
-            elif tool == 'None':
-                tool_result = None
+            if tool_task is not None:
+                # Already started while the rest of the choice was streaming
+                tool_result = await tool_task
             else:
-                print(f"Unknown tool: {tool}")
-                tool_result = None
-            
+                tool_result = await self.call_tool(browser, question, steps, tool, args, retries)
+
             if tool == 'None':
                 print(f"No tool chosen, break")
                 break
 
-            step_note = self.summarize_tool_chain.invoke({'question': question, 'steps': '\n\n'.join(steps), 'tool_result': tool_result, 'tool': tool, 'args': args})
+            with llm_stage("summarize"):
+                step_note = await self.summarize_tool_chain.ainvoke({'question': question, 'steps': '\n\n'.join(steps), 'tool_result': tool_result, 'tool': tool, 'args': args})
             print(f"Step note: \n{step_note}")
             steps.append(f"Step:{len(steps)+1}\nTool: {tool}, Args: {args}\n{step_note}\n\n")
 
+        print(f"Retries for question: {retries}")
+
         if len(steps) == 0:
-            answer = self.user_proxy.initiate_chat(
-                self.society_of_mind_agent, 
-                message=f"""{question}\nIf you are unable to solve the question, make a well-informed EDUCATED GUESS based on the information we have provided.
-Your EDUCATED GUESS should be a number OR as few words as possible OR a comma separated list of numbers and/or strings. DO NOT OUTPUT 'I don't know', 'Unable to determine', etc.""").summary
+            answer = await self.run_blocking(
+                self.society_of_mind_answer,
+                f"""{question}\nIf you are unable to solve the question, make a well-informed EDUCATED GUESS based on the information we have provided.
+Your EDUCATED GUESS should be a number OR as few words as possible OR a comma separated list of numbers and/or strings. DO NOT OUTPUT 'I don't know', 'Unable to determine', etc.""")
         else:
             steps_prompt = '\n'.join(steps)
-            answer = self.user_proxy.initiate_chat(
-                self.society_of_mind_agent, 
-                message=f"""{question}\nTo answer the above question, I did the following:
+            answer = await self.run_blocking(
+                self.society_of_mind_answer,
+                f"""{question}\nTo answer the above question, I did the following:
 {steps_prompt}
 
 Referring to the information I have obtained (which may not be accurate), what do you think is the answer to the question?
 If you are unable to solve the question, make a well-informed EDUCATED GUESS based on the information we have provided.
-Your EDUCATED GUESS should be a number OR as few words as possible OR a comma separated list of numbers and/or strings. DO NOT OUTPUT 'I don't know', 'Unable to determine', etc.""").summary
-        formatted_answer = self.format_answer_chain.invoke({'question': question, 'answer': answer})#.answer
+Your EDUCATED GUESS should be a number OR as few words as possible OR a comma separated list of numbers and/or strings. DO NOT OUTPUT 'I don't know', 'Unable to determine', etc.""")
+        with llm_stage("format_answer"):
+            formatted_answer = await self.format_answer_chain.ainvoke({'question': question, 'answer': answer})#.answer
 
-        try:
-            cache_db = sqlite3.connect(f".cache/qa_cache/{SPLIT}/{DATA_NAME}.db")
-            cursor = cache_db.cursor()
-            cursor.execute("INSERT INTO qa_cache (question, answer) VALUES (?, ?)", (raw_question, formatted_answer))
-            cache_db.commit()
-            cache_db.close()
-        except Exception as e:
-            print(f"Ignoring error: {e} when inserting question: {question}")
+        self.qa_cache.put(raw_question, attachment_name, formatted_answer)
+
+        return {"answer": formatted_answer, "steps": len(steps), "retries": retries, "wall_time": time.time() - start_time, "cached": False}
+
+
+# Import responses cached by earlier runs in the old single-file SQLiteCache
+print(f"Imported {TwoTierLLMCache(LLM_CACHE_DIR).warm_from_sqlite('llm_cache.sqlite')} cached LLM responses")
 
-        return formatted_answer
+# Build the local search index once, before the actors load it
+if cli_args.search == 'local':
+    get_local_search_provider(LOCAL_SEARCH_CORPUS, LOCAL_SEARCH_INDEX_DIR)
 
+# Shared model services, created by the driver so they outlive any single agent
+rate_limiter = get_rate_limiter(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+asr_service = get_asr_service()
+ocr_service = get_ocr_service()
+
+# Sibyl.ask is a coroutine, so each actor runs up to MAX_CONCURRENT_QUESTIONS_PER_ACTOR questions at once
+agents = [Sibyl.options(max_concurrency=MAX_CONCURRENT_QUESTIONS_PER_ACTOR).remote() for _ in range(NUM_ACTORS)]
+
+def load_checkpoint(path: str) -> Dict[str, dict]:
+    """Read the finished questions recorded in a checkpoint, keyed by task_id."""
+    records = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash can leave the last line half written
+                    continue
+                records[record['task_id']] = record
+    return records
 
-agent_pool = ray.util.ActorPool([Sibyl.remote() for _ in range(16)])
 
 dataset = load_dataset("gaia-benchmark/GAIA", DATA_NAME)
 # ds = [dataset[SPLIT][i] for i in range(len(dataset[SPLIT]))]
 ds = [dataset[SPLIT][i] for i in range(10)]
 
-answers = list(agent_pool.map(lambda agent, row: agent.ask.remote(row['Question'], row['file_name']), ds))
-scores = [question_scorer(answer, row['Final answer']) for answer, row in zip(answers, ds)]
-
-EXP_NAME = "babyagi_with_som_answer"
 os.makedirs(f'results/{SPLIT}', exist_ok=True)
+if cli_args.resume:
+    finished = load_checkpoint(CHECKPOINT_PATH)
+    print(f"Resuming, {len(finished)} questions already finished")
+else:
+    finished = {}
+    open(CHECKPOINT_PATH, 'w').close()
+
+# Results are handled in completion order and appended to the checkpoint, so a crash only loses the questions in flight
+pending = {}
+for i, row in enumerate(row for row in ds if row['task_id'] not in finished):
+    pending[agents[i % len(agents)].ask.remote(row['Question'], row['file_name'])] = row
+with open(CHECKPOINT_PATH, 'a') as checkpoint_file:
+    while len(pending) > 0:
+        done, _ = ray.wait(list(pending), num_returns=1)
+        row = pending.pop(done[0])
+        try:
+            result = ray.get(done[0])
+        except Exception as e:
+            print(f"Question {row['task_id']} failed, it will be retried on --resume: {e}")
+            continue
+        score = question_scorer(result['answer'], row['Final answer'])
+        record = {
+            "task_id": row['task_id'],
+            "answer": result['answer'],
+            "score": score,
+            "steps": result['steps'],
+            "wall_time": result['wall_time'],
+            "retries": result['retries'],
+            "cached": result['cached'],
+        }
+        checkpoint_file.write(json.dumps(record) + "\n")
+        checkpoint_file.flush()
+        finished[row['task_id']] = record
+        pp(f"[{len(finished)}/{len(ds)}] {row['task_id']}: {'✅' if score else '❌'} {result['answer']!r} ({result['steps']} steps, {result['wall_time']:.0f}s)")
+
+ray.get([agent.flush_caches.remote() for agent in agents])
+for i, agent_stats in enumerate(ray.get([agent.cache_stats.remote() for agent in agents])):
+    pp(f"Agent {i} caches: {agent_stats}")
+pp(f"LLM rate limiter: {ray.get(rate_limiter.stats.remote())}")
+pp(f"ASR service: {ray.get(asr_service.stats.remote())}")
+pp(f"OCR service: {ray.get(ocr_service.stats.remote())}")
+
+# The report is built from the checkpoint, so it covers resumed runs as well
+records = load_checkpoint(CHECKPOINT_PATH)
+ds = [row for row in ds if row['task_id'] in records]
+answers = [records[row['task_id']]['answer'] for row in ds]
+scores = [records[row['task_id']]['score'] for row in ds]
+pp(f"Retries: {sum(records[row['task_id']]['retries']['choose_tool'] for row in ds)} choose_tool, {sum(records[row['task_id']]['retries']['improve_code'] for row in ds)} improve_code over {len(ds)} questions")
+
 with open(f'results/{SPLIT}/{DATA_NAME}_{EXP_NAME}.txt', 'wt') as report_file:
     table = Table(title="Results", box=box.SQUARE_DOUBLE_HEAD, show_lines=True)
     table.add_column("Index", width=10)
@@ -374,7 +642,7 @@ with open(f'results/{SPLIT}/{DATA_NAME}_{EXP_NAME}.txt', 'wt') as report_file:
     for i in range(len(ds)):
         table.add_row(str(i), ds[i]['Question'], ds[i]['Final answer'], answers[i], "✅" if scores[i] else "❌")
     console = Console(file=report_file)
-    console.print(f"Final score: {sum(scores)}/{len(scores)} = {sum(scores)/len(scores):.2f}")
+    console.print(f"Final score: {sum(scores)}/{len(scores)} = {sum(scores)/max(len(scores), 1):.2f}")
     console.print(table)
 
 
@@ -3,6 +3,7 @@
 # https://github.com/microsoft/autogen/blob/gaia_multiagent_v01_march_1st/autogen/browser_utils.py
 
 # ruff: noqa: E722
+import bisect
 import json
 import os
 import requests
@@ -15,10 +16,199 @@ import pathlib
 import pathvalidate
 from urllib.parse import urljoin, urlparse, unquote, parse_qs
 from urllib.request import url2pathname
-from typing import Any, Dict, List, Optional, Union, Tuple
-from .mdconvert import MarkdownConverter, UnsupportedFormatException, FileConversionException
+from typing import Any, Dict, List, Optional, Sequence, Union, Tuple
+from .mdconvert import MarkdownConverter, StreamingConverterResult, UnsupportedFormatException, FileConversionException
+from .http_session import get_session
+from .resilience import CircuitOpenError
+from .http_cache import BodyTooLarge, HTTPCache, get_http_cache
+from .search_providers import BingSearchProvider, SearchProvider
+from .prefetch import LimitedReader, get_prefetcher
+from .downloads import DownloadLimitExceeded, DownloadStore, get_download_store
+
+from array import array
+
+# A viewport may only end right after one of these characters
+_VIEWPORT_BREAK = re.compile(r"[ \t\r\n]")
+
+_WORD = re.compile(r"\w+")
+
+# A find gives up after this many seconds, even on adversarial wildcard queries
+FIND_TIME_LIMIT = 2.0
+
+
+class ViewportPages(Sequence):
+    """(start, end) bounds of the viewports of a page, found only as far as they are read.
+
+    Each viewport spans at least `viewport_size` characters and is extended to end right
+    after the next whitespace, so every boundary costs one regex search instead of a
+    Python loop over characters. `len()` finds all of them.
+    """
+
+    def __init__(self, content: str, viewport_size: int):
+        self._content = content
+        self._viewport_size = max(1, viewport_size)
+        self._bounds: List[Tuple[int, int]] = []
+        self._starts: List[int] = []
+        self._complete = len(content) == 0
+        if self._complete:
+            self._bounds.append((0, 0))
+            self._starts.append(0)
+
+    def _extend_to(self, index: int) -> None:
+        content = self._content
+        start = self._bounds[-1][1] if len(self._bounds) > 0 else 0
+        while not self._complete and (index < 0 or len(self._bounds) <= index):
+            end = start + self._viewport_size
+            if end >= len(content):
+                end = len(content)
+            else:
+                m = _VIEWPORT_BREAK.search(content, end - 1)
+                end = len(content) if m is None else m.end()
+            self._bounds.append((start, end))
+            self._starts.append(start)
+            start = end
+            self._complete = end >= len(content)
+
+    def index_of(self, offset: int) -> int:
+        """Return the index of the viewport holding the character at `offset`."""
+        while not self._complete and (len(self._bounds) == 0 or self._bounds[-1][1] <= offset):
+            self._extend_to(len(self._bounds))
+        return max(0, bisect.bisect_right(self._starts, offset) - 1)
+
+    def has_page(self, index: int) -> bool:
+        if index < 0:
+            return False
+        self._extend_to(index)
+        return index < len(self._bounds)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) or index < 0:
+            self._extend_to(-1)
+        else:
+            self._extend_to(index)
+        return self._bounds[index]
+
+    def __len__(self) -> int:
+        self._extend_to(-1)
+        return len(self._bounds)
+
+
+class PageSearchIndex:
+    """The words of a page, lowercased and joined by single spaces, with their offsets in the page.
+
+    find_on_page matches its normalized query against this text once per page instead of
+    re-normalizing every viewport on every search. Queries are literal apart from `*`
+    wildcards, which match at most `max_gap` characters and are resolved by bounded
+    substring searches instead of a backtracking regex.
+    """
+
+    def __init__(self, content: str):
+        parts: List[str] = [" "]
+        # Where each word starts in the normalized text, and where it starts and ends in the page
+        self.norm_starts = array("q")
+        self.starts = array("q")
+        self.ends = array("q")
+        position = 1
+        for m in _WORD.finditer(content):
+            word = m.group().lower()
+            parts.append(word)
+            parts.append(" ")
+            self.norm_starts.append(position)
+            self.starts.append(m.start())
+            self.ends.append(m.end())
+            position += len(word) + 1
+        if len(parts) == 1:
+            parts.append(" ")
+        self.text = "".join(parts)
+
+    @staticmethod
+    def parse_query(query: str) -> List[str]:
+        """Normalize a find query the way the page is normalized, split on its wildcards."""
+        nquery = re.sub(r"\*", "__STAR__", query)
+        nquery = " " + (" ".join(re.split(r"\W+", nquery))).strip() + " "
+        nquery = nquery.replace(" __STAR__ ", "__STAR__ ")  # Merge isolated stars with prior word
+        segments = nquery.lower().split("__star__")
+        # Only wildcards, like the regex ".*" this matches anywhere
+        if len(segments) > 1 and "".join(segments).strip() == "":
+            return [""]
+        # A leading wildcard only drops the word boundary before the first word
+        while len(segments) > 1 and segments[0].strip() == "":
+            segments = segments[1:]
+        segments = [segment for segment in segments if segment != ""]
+        # A trailing one drops the boundary after the last word, unless the query already ends
+        # that word (as in "word **"), then another word has to follow
+        if len(segments) > 1 and segments[-1] == " " and not segments[-2].endswith(" "):
+            segments = segments[:-1]
+        return segments
+
+    def _match_from(self, segments: List[str], k: int, position: int, max_gap: int, deadline: float) -> Optional[int]:
+        # Try every occurrence of segment k within max_gap of position, return the end of the match
+        segment = segments[k]
+        limit = position + max_gap + len(segment)
+        found = self.text.find(segment, position, limit)
+        while found >= 0:
+            if time.perf_counter() > deadline:
+                raise TimeoutError()
+            end = found + len(segment)
+            if k + 1 == len(segments):
+                return end
+            match_end = self._match_from(segments, k + 1, end, max_gap, deadline)
+            if match_end is not None:
+                return match_end
+            found = self.text.find(segment, found + 1, limit)
+        return None
+
+    def _page_span(self, norm_start: int, norm_end: int) -> Tuple[int, int]:
+        # A match starts on a word, or on the space right before one
+        first = bisect.bisect_right(self.norm_starts, norm_start) - 1
+        if first < 0 or self.text[norm_start] == " ":
+            first += 1
+        last = max(first, bisect.bisect_right(self.norm_starts, norm_end - 1) - 1)
+        first = min(first, len(self.starts) - 1)
+        last = min(last, len(self.ends) - 1)
+        return self.starts[first], self.ends[last]
+
+    def _norm_position(self, offset: int) -> int:
+        # The space before the first word that starts at or after `offset`
+        i = bisect.bisect_left(self.starts, offset)
+        return len(self.text) if i >= len(self.norm_starts) else self.norm_starts[i] - 1
+
+    def iter_matches(self, query: str, max_gap: int, start_offset: int = 0):
+        """Yield the (start, end) page offsets of non-overlapping matches at or after `start_offset`."""
+        segments = self.parse_query(query)
+        if segments == [""]:
+            # A wildcard-only query matches the empty string where the search starts, even on an empty page
+            yield start_offset, start_offset
+            return
+        if len(segments) == 0 or len(self.starts) == 0:
+            return
+        deadline = time.perf_counter() + FIND_TIME_LIMIT
+        position = self._norm_position(start_offset)
+        while True:
+            found = self.text.find(segments[0], position)
+            if found < 0:
+                return
+            try:
+                if len(segments) == 1:
+                    end = found + len(segments[0])
+                else:
+                    end = self._match_from(segments, 1, found + len(segments[0]), max_gap, deadline)
+            except TimeoutError:
+                print(f"Find for '{query}' stopped after {FIND_TIME_LIMIT} seconds")
+                return
+            if end is None:
+                position = found + 1
+                continue
+            yield self._page_span(found, end)
+            # Matches usually end on the space that starts the next one
+            position = end - 1 if end > found + 1 and self.text[end - 1] == " " else end
+
+
+def _is_text_response(response: requests.Response) -> bool:
+    """Whether the browser renders a response as a page, everything else is a download."""
+    return "text/" in response.headers.get("content-type", "").lower()
+
 
-import diskcache as dc
 class SimpleTextBrowser:
     """(In preview) An extremely simple text-based web browser comparable to Lynx. Suitable for Agentic use."""
 
@@ -29,6 +219,11 @@ class SimpleTextBrowser:
         downloads_folder: Optional[Union[str, None]] = None,
         bing_api_key: Optional[Union[str, None]] = None,
         request_kwargs: Optional[Union[Dict[str, Any], None]] = None,
+        session: Optional[requests.Session] = None,
+        http_cache: Optional[HTTPCache] = None,
+        search_provider: Optional[SearchProvider] = None,
+        prefetch_top_k: int = 0,
+        download_store: Optional[DownloadStore] = None,
     ):
         self.start_page: str = start_page if start_page else "about:blank"
         self.viewport_size = viewport_size  # Applies only to the standard uri types
@@ -36,17 +231,34 @@ class SimpleTextBrowser:
         self.history: List[Tuple[str, float]] = list()
         self.page_title: Optional[str] = None
         self.viewport_current_page = 0
-        self.viewport_pages: List[Tuple[int, int]] = list()
+        self.viewport_pages: Sequence[Tuple[int, int]] = list()
+        # A PDF whose remaining pages are still being extracted into page_content
+        self._streaming: Optional[StreamingConverterResult] = None
         self.set_address(self.start_page)
         self.bing_api_key = bing_api_key
         self.request_kwargs = request_kwargs
-        self._mdconvert = MarkdownConverter()
+        # Pages, downloads and searches share the pooled session of this process
+        self._session = session if session is not None else get_session()
+        self._mdconvert = MarkdownConverter(requests_session=self._session)
+        # Page fetches go through the on-disk HTTP cache shared by all actors
+        self._http_cache = http_cache if http_cache is not None else get_http_cache()
         self._page_content: str = ""
 
         self._find_on_page_query: Union[str, None] = None
+        self._search_index: Optional[PageSearchIndex] = None
         self._find_on_page_last_result: Union[int, None] = None  # Location of the last result
 
-        self.bing_cache = dc.Cache(f".cache/bing")
+        # bing: URIs are answered by the live Bing API unless another provider is given
+        if search_provider is None:
+            search_provider = BingSearchProvider(bing_api_key, session=self._session, request_kwargs=request_kwargs)
+        self.search_provider = search_provider
+
+        # Fetch and convert the first prefetch_top_k results of every search in the background
+        self.prefetch_top_k = prefetch_top_k
+        self._prefetcher = get_prefetcher()
+
+        # Downloads are stored once per content hash, downloads_folder gets a copy-on-write clone of each
+        self._download_store = download_store if download_store is not None else get_download_store()
 
     @property
     def address(self) -> str:
@@ -82,29 +294,74 @@ class SimpleTextBrowser:
     @property
     def viewport(self) -> str:
         """Return the content of the current viewport."""
+        self._take_streamed_content()
         bounds = self.viewport_pages[self.viewport_current_page]
         return self.page_content[bounds[0] : bounds[1]]
 
     @property
     def page_content(self) -> str:
         """Return the full contents of the current page."""
+        self._take_streamed_content()
         return self._page_content
 
-    def _set_page_content(self, content: str) -> None:
+    @property
+    def page_streaming(self) -> bool:
+        """Whether more of the current page is still being extracted."""
+        return self._streaming is not None and not self._streaming.complete
+
+    def _set_page_content(self, content: str, streaming: Optional[StreamingConverterResult] = None) -> None:
         """Sets the text content of the current page."""
+        if self._streaming is not None and self._streaming is not streaming:
+            self._streaming.pages.cancel()
+        self._streaming = streaming
         self._page_content = content
+        self._search_index = None
         self._split_pages()
-        if self.viewport_current_page >= len(self.viewport_pages):
+        if not self.viewport_pages.has_page(self.viewport_current_page):
             self.viewport_current_page = len(self.viewport_pages) - 1
 
+    def _set_converted_content(self, res) -> None:
+        self.page_title = res.title
+        self._set_page_content(res.text_content, res if isinstance(res, StreamingConverterResult) else None)
+
+    def _take_streamed_content(self, wait: bool = False) -> bool:
+        """Append the pages extracted since the last call, waiting for the next ones if `wait`.
+
+        Returns False once the page is complete and nothing was added.
+        """
+        streaming = self._streaming
+        if streaming is None:
+            return False
+        if streaming.complete:
+            wait = False
+        changed = streaming.refresh(wait=wait)
+        if changed:
+            self._page_content = streaming.text_content
+            self._search_index = None
+            self._split_pages()
+        if streaming.complete:
+            self._streaming = None
+        return changed or self._streaming is not None
+
+    def _has_viewport(self, index: int) -> bool:
+        """Whether viewport `index` exists, waiting for a streaming page to reach it."""
+        while not self.viewport_pages.has_page(index):
+            if not self._take_streamed_content(wait=True):
+                return False
+        return True
+
     def page_down(self) -> None:
-        self.viewport_current_page = min(self.viewport_current_page + 1, len(self.viewport_pages) - 1)
+        if self._has_viewport(self.viewport_current_page + 1):
+            self.viewport_current_page += 1
 
     def page_up(self) -> None:
         self.viewport_current_page = max(self.viewport_current_page - 1, 0)
 
     def find_on_page(self, query: str) -> Union[str, None]:
-        """Searches for the query from the current viewport forward, looping back to the start if necessary."""
+        """Searches for the query from the current viewport forward, looping back to the start if necessary.
+
+        A query of only wildcards (like "*" or "** **") matches the current viewport, even one without words.
+        """
 
         # Did we get here via a previous find_on_page search with the same query?
         # If so, map to find_next
@@ -133,7 +390,7 @@ class SimpleTextBrowser:
             starting_viewport = 0
         else:
             starting_viewport += 1
-            if starting_viewport >= len(self.viewport_pages):
+            if not self._has_viewport(starting_viewport):
                 starting_viewport = 0
 
         viewport_match = self._find_next_viewport(self._find_on_page_query, starting_viewport)
@@ -145,33 +402,41 @@ class SimpleTextBrowser:
             self._find_on_page_last_result = viewport_match
             return self.viewport
 
+    @property
+    def search_index(self) -> PageSearchIndex:
+        """The normalized word index of the current page, built on the first find."""
+        if self._search_index is None:
+            self._search_index = PageSearchIndex(self._page_content)
+        return self._search_index
+
+    def find_all(self, query: str) -> List[Tuple[int, int, int]]:
+        """Return (viewport, start, end) for every match of the query, with offsets into page_content."""
+        if query is None:
+            return []
+        while self._take_streamed_content(wait=True):
+            pass
+        return [
+            (self.viewport_pages.index_of(start), start, end)
+            for start, end in self.search_index.iter_matches(query, self.viewport_size)  # type: ignore[arg-type]
+        ]
+
     def _find_next_viewport(self, query: str, starting_viewport: int) -> Union[int, None]:
         """Search for matches between the starting viewport looping when reaching the end."""
 
         if query is None:
             return None
 
-        # Normalize the query, and convert to a regular expression
-        nquery = re.sub(r"\*", "__STAR__", query)
-        nquery = " " + (" ".join(re.split(r"\W+", nquery))).strip() + " "
-        nquery = nquery.replace(" __STAR__ ", "__STAR__ ")  # Merge isolated stars with prior word
-        nquery = nquery.replace("__STAR__", ".*").lower()
-
-        if nquery.strip() == "":
-            return None
-
-        idxs = list()
-        idxs.extend(range(starting_viewport, len(self.viewport_pages)))
-        idxs.extend(range(0, starting_viewport))
-
-        for i in idxs:
-            bounds = self.viewport_pages[i]
-            content = self.page_content[bounds[0] : bounds[1]]
-
-            # TODO: Remove markdown links and images
-            ncontent = " " + (" ".join(re.split(r"\W+", content))).strip().lower() + " "
-            if re.search(nquery, ncontent):
-                return i
+        # TODO: Remove markdown links and images
+        start_offset = self.viewport_pages[starting_viewport][0]
+        # Pages still being extracted are searched as they come in, the first match ends the wait
+        while True:
+            for start, _ in self.search_index.iter_matches(query, self.viewport_size, start_offset):  # type: ignore[arg-type]
+                return self.viewport_pages.index_of(start)
+            if not self._take_streamed_content(wait=True):
+                break
+        if start_offset > 0:
+            for start, _ in self.search_index.iter_matches(query, self.viewport_size, 0):  # type: ignore[arg-type]
+                return self.viewport_pages.index_of(start)
 
         return None
 
@@ -183,72 +448,23 @@ class SimpleTextBrowser:
     def _split_pages(self) -> None:
         # Do not split search results
         if self.address.startswith("bing:"):
-            self.viewport_pages = [(0, len(self._page_content))]
+            self.viewport_pages = ViewportPages(self._page_content, max(1, len(self._page_content)))
             return
 
-        # Handle empty pages
-        if len(self._page_content) == 0:
-            self.viewport_pages = [(0, 0)]
-            return
-
-        # Break the viewport into pages
-        self.viewport_pages = []
-        start_idx = 0
-        while start_idx < len(self._page_content):
-            end_idx = min(start_idx + self.viewport_size, len(self._page_content))  # type: ignore[operator]
-            # Adjust to end on a space
-            while end_idx < len(self._page_content) and self._page_content[end_idx - 1] not in [" ", "\t", "\r", "\n"]:
-                end_idx += 1
-            self.viewport_pages.append((start_idx, end_idx))
-            start_idx = end_idx
-
-    def _bing_api_call(self, query: str) -> Dict[str, Dict[str, List[Dict[str, Union[str, Dict[str, str]]]]]]:
-        # Check the cache
-        if self.bing_cache is not None:
-            cached = self.bing_cache.get(query)
-            if cached is not None:
-                return cached
-        # Make sure the key was set
-        if self.bing_api_key is None:
-            raise ValueError("Missing Bing API key.")
-
-        # Prepare the request parameters
-        request_kwargs = self.request_kwargs.copy() if self.request_kwargs is not None else {}
-
-        if "headers" not in request_kwargs:
-            request_kwargs["headers"] = {}
-        request_kwargs["headers"]["Ocp-Apim-Subscription-Key"] = self.bing_api_key
-
-        if "params" not in request_kwargs:
-            request_kwargs["params"] = {}
-        request_kwargs["params"]["q"] = query
-        request_kwargs["params"]["textDecorations"] = False
-        request_kwargs["params"]["textFormat"] = "raw"
-
-        request_kwargs["stream"] = False
-
-        # Make the request
-        response = None
-        for _ in range(10):
-            try:
-                response = requests.get("https://api.bing.microsoft.com/v7.0/search", **request_kwargs)
-                response.raise_for_status()
-                break
-            except Exception:
-                pass
-            time.sleep(1)
-        if response is None:
-            raise requests.exceptions.RequestException("Failed to fetch Bing search results.")
-        results = response.json()
-
-        # Cache the results
-        if self.bing_cache is not None:
-            self.bing_cache.set(query, results)
-
-        return results  # type: ignore[no-any-return]
+        # Viewports are found on demand, most pages are only ever read from the top
+        self.viewport_pages = ViewportPages(self._page_content, self.viewport_size)  # type: ignore[arg-type]
 
     def _bing_search(self, query: str) -> None:
-        results = self._bing_api_call(query)
+        try:
+            results = self.search_provider.search(query)
+        except (requests.exceptions.RequestException, CircuitOpenError) as e:
+            # An error page, like _fetch_page renders, the agent can retry or search differently
+            print(f'Search failed: {e}')
+            self.page_title = f"{query} - Search"
+            status = e.response.status_code if getattr(e, "response", None) is not None else None
+            heading = "## Error" if status is None else f"## Error {status}"
+            self._set_page_content(f"{heading}\n\nThe search for '{query}' failed: {e}")
+            return
 
         def _prev_visit(url):
             for i in range(len(self.history) - 1, -1, -1):
@@ -258,6 +474,7 @@ class SimpleTextBrowser:
             return ""
 
         web_snippets: List[str] = list()
+        web_urls: List[str] = list()
         idx = 0
         if "webPages" in results:
             for page in results["webPages"]["value"]:
@@ -265,12 +482,14 @@ class SimpleTextBrowser:
                 web_snippets.append(
                     f"{idx}. [{page['name']}]({page['url']})\n{_prev_visit(page['url'])}{page['snippet']}"
                 )
+                web_urls.append(page["url"])
                 if "deepLinks" in page:
                     for dl in page["deepLinks"]:
                         idx += 1
                         web_snippets.append(
                             f"{idx}. [{dl['name']}]({dl['url']})\n{_prev_visit(dl['url'])}{dl['snippet'] if 'snippet' in dl else ''}"
                         )
+                        web_urls.append(dl["url"])
 
         news_snippets = list()
         if "news" in results:
@@ -309,68 +528,95 @@ class SimpleTextBrowser:
 
         self._set_page_content(content)
 
+        # The next step usually visits one of the first results
+        for url in web_urls[: self.prefetch_top_k]:
+            # Local search results are file:// URLs
+            if url.startswith("http:") or url.startswith("https:") or url.startswith("file://"):
+                self._prefetcher.submit(url, self._prefetch_page)
+
+    def _prefetch_page(self, url: str) -> Optional[Tuple[Optional[str], str]]:
+        """Fetch and convert a text page for the prefetcher, None when it is not worth prefetching."""
+        if url.startswith("file://"):
+            local_path = os.path.normcase(os.path.normpath(unquote(url[7:])))
+            if os.path.getsize(local_path) > self._prefetcher.max_bytes:
+                return None
+            res = self._mdconvert.convert_local(local_path)
+            return res.title, res.text_content
+
+        request_kwargs = self.request_kwargs.copy() if self.request_kwargs is not None else {}
+        request_kwargs["stream"] = True
+        try:
+            # The cache stops reading at max_bytes, or before reading when Content-Length is larger
+            response = self._http_cache.get(
+                self._session, url, cache_body=_is_text_response, max_bytes=self._prefetcher.max_bytes, **request_kwargs
+            )
+        except BodyTooLarge:
+            return None
+        # Downloads and error pages are left to visit_page
+        if response.status_code >= 400 or not _is_text_response(response):
+            response.close()
+            return None
+        # Bodies of unknown length that the cache did not store are still unread
+        response.raw = LimitedReader(response.raw, self._prefetcher.max_bytes)
+        res = self._mdconvert.convert_response(response)
+        return res.title, res.text_content
+
     def _fetch_page(self, url: str) -> None:
         download_path = ""
         response = None
         print(f'Fetching page: {url}')
         try:
+            # A prefetched page is used as is, one still in flight is waited for
+            prefetched = self._prefetcher.take(url) if self.prefetch_top_k > 0 else None
+            if prefetched is not None:
+                self.page_title, content = prefetched
+                self._set_page_content(content)
+                return
+
             if url.startswith("file://"):
                 download_path = os.path.normcase(os.path.normpath(unquote(url[7:])))
-                res = self._mdconvert.convert_local(download_path)
-                self.page_title = res.title
-                self._set_page_content(res.text_content)
+                res = self._mdconvert.convert_local(download_path, stream_pages=True)
+                self._set_converted_content(res)
             else:
                 # Prepare the request parameters
                 request_kwargs = self.request_kwargs.copy() if self.request_kwargs is not None else {}
                 request_kwargs["stream"] = True
 
-                # Send a HTTP request to the URL
-                response = requests.get(url, **request_kwargs)
+                # Send a HTTP request to the URL, downloads go to the download store and not to the HTTP cache too
+                response = self._http_cache.get(self._session, url, cache_body=_is_text_response, **request_kwargs)
                 response.raise_for_status()
 
                 # If the HTTP request was successful
                 content_type = response.headers.get("content-type", "")
 
                 # Text or HTML
-                if "text/" in content_type.lower():
+                if _is_text_response(response):
                     res = self._mdconvert.convert_response(response)
                     self.page_title = res.title
                     self._set_page_content(res.text_content)
                 # A download
                 else:
+                    # Stream it into the shared store once, hashing it on the way
+                    _, sha256 = self._download_store.put(response)
+
                     # Try producing a safe filename
-                    fname = None
-                    download_path = None
-                    try:
-                        fname = pathvalidate.sanitize_filename(os.path.basename(urlparse(url).path)).strip()
-                        download_path = os.path.abspath(os.path.join(self.downloads_folder, fname))
-
-                        suffix = 0
-                        while os.path.exists(download_path) and suffix < 1000:
-                            suffix += 1
-                            base, ext = os.path.splitext(fname)
-                            new_fname = f"{base}__{suffix}{ext}"
-                            download_path = os.path.abspath(os.path.join(self.downloads_folder, new_fname))
-
-                    except NameError:
-                        pass
+                    fname = pathvalidate.sanitize_filename(os.path.basename(urlparse(url).path)).strip()
 
                     # No suitable name, so make one
-                    if fname is None:
-                        extension = mimetypes.guess_extension(content_type)
+                    if fname == "":
+                        extension = mimetypes.guess_extension(content_type.split(";")[0].strip())
                         if extension is None:
                             extension = ".download"
-                        fname = str(uuid.uuid4()) + extension
-                        download_path = os.path.abspath(os.path.join(self.downloads_folder, fname))
+                        fname = sha256[:16] + extension
 
-                    # Open a file for writing
-                    with open(download_path, "wb") as fh:
-                        for chunk in response.iter_content(chunk_size=512):
-                            fh.write(chunk)
+                    # The agent sees the file under its own name in the downloads folder
+                    download_path = self._download_store.alias(sha256, self.downloads_folder, fname)
 
-                    # Render it
+                    # Render the file just written, the page address becomes its file:// URI
                     local_uri = pathlib.Path(download_path).as_uri()
-                    self.set_address(local_uri)
+                    self.history.append((local_uri, time.time()))
+                    res = self._mdconvert.convert_local(download_path, file_sha256=sha256, stream_pages=True)
+                    self._set_converted_content(res)
 
         except UnsupportedFormatException as e:
             print(f'Unsupported format: {e}')
@@ -380,6 +626,10 @@ class SimpleTextBrowser:
             print(f'File conversion error: {e}')
             self.page_title = ("Download complete.",)
             self._set_page_content(f"# Download complete\n\nSaved file to '{download_path}'")
+        except DownloadLimitExceeded as e:
+            print(f'Download stopped: {e}')
+            self.page_title = "Download stopped"
+            self._set_page_content(f"# Download stopped\n\n{e}")
         except FileNotFoundError:
             self.page_title = "Error 404"
             self._set_page_content(f"## Error 404\n\nFile not found: {download_path}")
@@ -0,0 +1,111 @@
+"""Cache of Markdown conversions keyed by the bytes that were converted.
+
+An entry is keyed on the sha256 of the file, the converter class and its `version`, and
+the kwargs the converter declares in `cache_kwargs`. The same attachment or page converts
+once per machine, whatever its path, URL or actor. Values are zlib-compressed JSON in a
+diskcache store that evicts the least recently used entries once it outgrows `size_limit`.
+"""
+import hashlib
+import json
+import threading
+from typing import Any, Dict, Optional
+
+import diskcache as dc
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _kwarg_key(value: Any) -> Any:
+    # Objects such as an mlm_client only matter by kind, not identity
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return type(value).__qualname__
+
+
+class ConversionCache:
+    """Compressed, size-bounded store of DocumentConverterResult fields."""
+
+    def __init__(
+        self,
+        directory: str = ".cache/conversions",
+        size_limit: int = 4 * 1024 * 1024 * 1024,
+        compress_level: int = 6,
+    ):
+        self._store = dc.Cache(
+            directory,
+            timeout=60,
+            size_limit=size_limit,
+            eviction_policy="least-recently-used",
+            disk=dc.JSONDisk,
+            disk_compress_level=compress_level,
+        )
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        # Conversion time that hits did not have to spend again
+        self.saved_seconds = 0.0
+
+    @staticmethod
+    def key(sha256: str, converter: Any, kwargs: Dict[str, Any]) -> str:
+        cls = type(converter)
+        relevant = {name: _kwarg_key(kwargs.get(name)) for name in getattr(converter, "cache_kwargs", ())}
+        raw = [sha256, f"{cls.__module__}.{cls.__qualname__}", getattr(converter, "version", 0), relevant]
+        attributes = {name: _kwarg_key(getattr(converter, name, None)) for name in getattr(converter, "cache_attributes", ())}
+        # Only appended when present, the keys of converters without any stay as they were
+        if attributes:
+            raw.append(attributes)
+        return hashlib.sha256(json.dumps(raw, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached title, text_content and conversion time, without counting a lookup."""
+        return self._store.get(key)
+
+    def record(self, hit: bool, saved_seconds: float = 0.0) -> None:
+        """Count one document lookup. A document is a hit when any converter's entry was found."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.saved_seconds += saved_seconds
+            else:
+                self.misses += 1
+
+    def put(self, key: str, title: Optional[str], text_content: str, seconds: float) -> None:
+        entry = {"title": None if title is None else str(title), "text_content": text_content, "seconds": seconds}
+        try:
+            self._store.set(key, entry)
+        except dc.Timeout as e:
+            print(f"Ignoring error: {e} when caching a conversion")
+            return
+        with self._lock:
+            self.writes += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "writes": self.writes,
+            "saved_seconds": self.saved_seconds,
+            "volume": self._store.volume(),
+        }
+
+
+_shared_cache: Optional[ConversionCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_conversion_cache(**kwargs: Any) -> ConversionCache:
+    """Return the cache shared by everything in this process, creating it with `kwargs` on first use."""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = ConversionCache(**kwargs)
+        return _shared_cache
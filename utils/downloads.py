@@ -0,0 +1,255 @@
+"""Single-pass streaming of response bodies to disk, and the content-addressed downloads store.
+
+A body is read once, in large chunks, and written and hashed as it arrives. The sha256
+goes with the file to the converter, whose conversion cache would otherwise have to
+read the file again to hash it. Downloads are cut off past `max_bytes` or `max_seconds`.
+"""
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import requests
+
+from .conversion_cache import file_sha256
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, aliases are always copies
+    fcntl = None
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_DOWNLOAD_BYTES = 2 * 1024 * 1024 * 1024
+MAX_DOWNLOAD_SECONDS = 600.0
+
+OBJECT_MODE = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+ALIAS_MODE = OBJECT_MODE | stat.S_IWUSR
+# ioctl(dest, FICLONE, src) shares the extents of src with dest (btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+
+
+class DownloadLimitExceeded(Exception):
+    """The body was larger, or took longer to arrive, than the download caps allow."""
+
+
+def stream_to_file(
+    response: requests.Response,
+    path: str,
+    max_bytes: int = MAX_DOWNLOAD_BYTES,
+    max_seconds: float = MAX_DOWNLOAD_SECONDS,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+) -> Tuple[str, int]:
+    """Write the body of `response` to `path`, returning its sha256 and size.
+
+    The partial file is removed when a cap is hit or the transfer fails.
+    """
+    declared = int(response.headers.get("content-length") or 0)
+    # Content-Length counts encoded bytes, a compressed body can still grow past it
+    if declared > max_bytes and "content-encoding" not in response.headers:
+        response.close()
+        raise DownloadLimitExceeded(f"{response.url} is {declared} bytes, the limit is {max_bytes}")
+
+    digest = hashlib.sha256()
+    size = 0
+    deadline = time.monotonic() + max_seconds
+    try:
+        with open(path, "wb") as fh:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise DownloadLimitExceeded(f"{response.url} is larger than {max_bytes} bytes")
+                if time.monotonic() > deadline:
+                    raise DownloadLimitExceeded(f"{response.url} took longer than {max_seconds}s to download")
+                digest.update(chunk)
+                fh.write(chunk)
+    except BaseException:
+        response.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        raise
+    return digest.hexdigest(), size
+
+
+class DownloadStore:
+    """Downloads kept once per sha256, shared by every actor, with readable aliases for the agent.
+
+    Objects live under `directory/objects`. A download is streamed to a temporary file in
+    the same directory and renamed into place, so readers never see a partial object, and
+    a second copy of the same bytes is simply dropped. Objects are read-only, their name
+    is their sha256. The agent gets its own file named after the URL, which it may change
+    freely: a copy-on-write clone of the object, or a plain copy on filesystems without
+    reflinks. A link would let agent code change the object under every other actor. The
+    name only gets the hash appended when another file already claimed it. `gc()` removes
+    the least recently used objects once the store outgrows `size_limit`.
+    """
+
+    def __init__(
+        self,
+        directory: str = ".cache/downloads",
+        size_limit: int = 32 * 1024 * 1024 * 1024,
+        gc_interval: float = 300.0,
+        min_age: float = 3600.0,
+    ):
+        self.objects_dir = os.path.join(directory, "objects")
+        self.tmp_dir = os.path.join(directory, "tmp")
+        os.makedirs(self.objects_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.size_limit = size_limit
+        self.gc_interval = gc_interval
+        # Objects used more recently than this are never collected, an agent may still read them
+        self.min_age = min_age
+        self._last_gc = 0.0
+        # Cleared the first time a clone fails, the store then copies
+        self._reflinks = fcntl is not None
+        self._lock = threading.Lock()
+        self.counts = {"downloads": 0, "deduplicated": 0, "bytes_written": 0, "collected": 0, "bytes_collected": 0}
+
+    def object_path(self, sha256: str) -> str:
+        return os.path.join(self.objects_dir, sha256[:2], sha256)
+
+    def put(self, response: requests.Response, **limits) -> Tuple[str, str]:
+        """Stream a response body into the store, returning the object path and its sha256."""
+        handle, temp_path = tempfile.mkstemp(dir=self.tmp_dir)
+        os.close(handle)
+        sha256, size = stream_to_file(response, temp_path, **limits)
+        path = self.object_path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        duplicate = os.path.exists(path)
+        if duplicate:
+            os.unlink(temp_path)
+            # Mark it as recently used for gc
+            os.utime(path)
+            os.chmod(path, OBJECT_MODE)
+        else:
+            # Agent code writing to its alias must not change the object under every other actor
+            os.chmod(temp_path, OBJECT_MODE)
+            os.replace(temp_path, path)
+        with self._lock:
+            self.counts["downloads"] += 1
+            self.counts["deduplicated" if duplicate else "bytes_written"] += 1 if duplicate else size
+        self.maybe_gc()
+        return path, sha256
+
+    @staticmethod
+    def _same_file(path: str, target: str, sha256: str) -> bool:
+        try:
+            if os.path.samefile(path, target):
+                return True
+            # A clone of the object, unless the agent has changed it since
+            return os.path.getsize(path) == os.path.getsize(target) and file_sha256(path) == sha256
+        except OSError:
+            return False
+
+    def _clone(self, target: str, alias_path: str) -> None:
+        # The clone is made under a temporary name, linking it into place fails instead of replacing another actor's file
+        handle, clone_path = tempfile.mkstemp(dir=os.path.dirname(alias_path), prefix=".clone-")
+        try:
+            with open(target, "rb") as src:
+                cloned = False
+                if self._reflinks:
+                    try:
+                        fcntl.ioctl(handle, FICLONE, src.fileno())
+                        cloned = True
+                    except OSError:
+                        # No reflinks on this filesystem, or across these two
+                        self._reflinks = False
+                if not cloned:
+                    with os.fdopen(os.dup(handle), "wb") as dst:
+                        shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+            os.fchmod(handle, ALIAS_MODE)
+            os.link(clone_path, alias_path)
+        finally:
+            os.close(handle)
+            os.unlink(clone_path)
+
+    def alias(self, sha256: str, folder: str, fname: str) -> str:
+        """Clone the object into `folder` as `fname`, or as `fname` with the hash appended if that name is taken."""
+        target = self.object_path(sha256)
+        os.makedirs(folder, exist_ok=True)
+        base, ext = os.path.splitext(fname)
+        for name in (fname, f"{base}__{sha256[:12]}{ext}", f"{base}__{sha256}{ext}"):
+            alias_path = os.path.abspath(os.path.join(folder, name))
+            if os.path.islink(alias_path) and not os.path.exists(alias_path):
+                # A link, as earlier versions made, to an object gc removed, the name is free again
+                try:
+                    os.unlink(alias_path)
+                except FileNotFoundError:
+                    pass
+            try:
+                self._clone(target, alias_path)
+                return alias_path
+            except FileExistsError:
+                if self._same_file(alias_path, target, sha256):
+                    return alias_path
+        raise FileExistsError(f"Could not find a free name for {fname} in {folder}")
+
+    def maybe_gc(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_gc < self.gc_interval:
+                return
+            self._last_gc = now
+        self.gc()
+
+    def gc(self) -> int:
+        """Remove least recently used objects until the store fits `size_limit`. Returns the bytes freed."""
+        objects = []
+        total = 0
+        for root, _, files in os.walk(self.objects_dir):
+            for fname in files:
+                path = os.path.join(root, fname)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                objects.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        freed = 0
+        cutoff = time.time() - self.min_age
+        for mtime, size, path in sorted(objects):
+            if total - freed <= self.size_limit or mtime > cutoff:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # Another actor collected it first
+                continue
+            freed += size
+            with self._lock:
+                self.counts["collected"] += 1
+                self.counts["bytes_collected"] += size
+
+        # Temporary files left behind by crashed downloads
+        for fname in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, fname)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+        return freed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.counts)
+
+
+_shared_store: Optional[DownloadStore] = None
+_shared_store_lock = threading.Lock()
+
+
+def get_download_store(**kwargs: Any) -> DownloadStore:
+    """Return the store shared by everything in this process, creating it with `kwargs` on first use."""
+    global _shared_store
+    with _shared_store_lock:
+        if _shared_store is None:
+            _shared_store = DownloadStore(**kwargs)
+        return _shared_store
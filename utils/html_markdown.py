@@ -0,0 +1,327 @@
+"""HTML to Markdown over an lxml tree, a faster engine for the HTML converters.
+
+The output follows markdownify 0.12.1 (the version pinned in requirements.txt) rule for
+rule, so pages convert the same as with BeautifulSoup and markdownify. Most of
+markdownify's time goes to `find_parent` calls on every text node and to building the
+BeautifulSoup tree. Here libxml2 parses the page, the pre/code ancestry is passed down
+while walking it, and script and style subtrees are skipped without being visited.
+
+Only documents that parse to the same tree with both parsers convert identically. For
+malformed markup, libxml2 repairs some things (unclosed <p> and <li>, blocks inside <p>)
+that html.parser leaves nested. Compare the two engines with benchmarks/html_engine.py.
+"""
+import re
+from typing import Any, List, Optional, Tuple
+
+from lxml import etree
+
+_convert_heading_re = re.compile(r"convert_h(\d+)")
+_line_beginning_re = re.compile(r"^", re.MULTILINE)
+_whitespace_re = re.compile(r"[\t ]+")
+_html_heading_re = re.compile(r"h[1-6]")
+
+# Subtrees that are never converted, the HTML converters remove them before converting
+PRUNED_TAGS = ("script", "style")
+
+_NESTED_TAGS = frozenset(["ol", "ul", "li", "table", "thead", "tbody", "tfoot", "tr", "td", "th"])
+_CODE_TAGS = frozenset(["pre", "code", "kbd", "samp"])
+_PRESERVE_WHITESPACE_TAGS = frozenset(["pre", "textarea"])
+_ASCII_SPACES = " \n\t\x0c\r"
+_INLINE_MARKUP = {"b": "**", "strong": "**", "em": "*", "i": "*", "del": "~~", "s": "~~", "sub": "", "sup": ""}
+
+SPACES = "spaces"
+BACKSLASH = "backslash"
+
+_PARSER = etree.HTMLParser(encoding="utf-8")
+
+
+def parse_html(html: str) -> Any:
+    """Parse a page into an lxml tree, returning its root element."""
+    # Parsed from bytes, lxml refuses str input that declares an encoding
+    return etree.fromstring(html.encode("utf-8"), _PARSER)
+
+
+def _name(node: Any) -> Optional[str]:
+    # The markdownify name of a child: the tag of elements, None for text and comments
+    if isinstance(node, str):
+        return None
+    return node.tag if isinstance(node.tag, str) else None
+
+
+def _present(node: Any) -> bool:
+    # Truthiness of a BeautifulSoup sibling, lxml elements are falsy when they have no children
+    return bool(node) if isinstance(node, str) else node is not None
+
+
+def _is_nested(node: Any) -> bool:
+    return _name(node) in _NESTED_TAGS
+
+
+def _collapse(text: str, preserve_whitespace: bool) -> str:
+    # BeautifulSoup stores whitespace-only strings as a single newline or space, outside of <pre> and <textarea>
+    if preserve_whitespace or text.strip(_ASCII_SPACES) != "":
+        return text
+    return "\n" if "\n" in text else " "
+
+
+def children(el: Any, preserve_whitespace: bool = False) -> List[Any]:
+    """The children of an element as BeautifulSoup sees them: text, elements and comments, minus PRUNED_TAGS."""
+    kids = [_collapse(el.text, preserve_whitespace)] if el.text else []
+    for child in el:
+        if child.tag not in PRUNED_TAGS:
+            kids.append(child)
+        # Text after a removed tag stays a separate string, as it does after Tag.extract()
+        if child.tail:
+            kids.append(_collapse(child.tail, preserve_whitespace))
+    return kids
+
+
+def string(el: Any) -> Optional[str]:
+    """Tag.string: the text of an element that holds a single string, possibly nested in single-child tags."""
+    kids = children(el)
+    if len(kids) != 1:
+        return None
+    if isinstance(kids[0], str):
+        return kids[0]
+    if not isinstance(kids[0].tag, str):
+        return kids[0].text
+    return string(kids[0])
+
+
+def find(root: Any, tag: str, **attrs: str) -> Optional[Any]:
+    """The first element below `root` (or `root` itself) with this tag and attribute values.
+
+    As in BeautifulSoup, a class matches any one of the element's classes.
+    """
+    for el in root.iter(tag):
+        for key, value in attrs.items():
+            actual = el.get(key)
+            if actual is None or (actual != value and not (key == "class" and value in actual.split())):
+                break
+        else:
+            return el
+    return None
+
+
+def _chomp(text: str) -> Tuple[str, str, str]:
+    prefix = " " if text and text[0] == " " else ""
+    suffix = " " if text and text[-1] == " " else ""
+    return prefix, suffix, text.strip()
+
+
+def _previous_sibling(el: Any) -> Any:
+    # For elements outside of the walk, whose siblings were never cleaned up
+    previous = el.getprevious()
+    if previous is not None:
+        return previous.tail or previous
+    parent = el.getparent()
+    return parent.text if parent is not None else None
+
+
+class LxmlMarkdownConverter:
+    """markdownify.MarkdownConverter with the default options, over lxml elements.
+
+    Only `newline_style` can be set, it is the one option the converters change.
+    """
+
+    def __init__(self, newline_style: str = SPACES):
+        self.newline_style = newline_style
+
+    def convert_tree(self, el: Any) -> str:
+        """Convert the children of `el`, like markdownify's convert_soup."""
+        in_pre = in_code = in_preserve = False
+        for ancestor in el.iterancestors():
+            in_pre = in_pre or ancestor.tag == "pre"
+            in_code = in_code or ancestor.tag in _CODE_TAGS
+            in_preserve = in_preserve or ancestor.tag in _PRESERVE_WHITESPACE_TAGS
+        return self._process(el, False, True, [], 0, in_pre, in_code, in_preserve)
+
+    def _process(self, el, convert_as_inline, children_only, frames, index, in_pre, in_code, in_preserve) -> str:
+        name = el.tag
+        in_preserve = in_preserve or name in _PRESERVE_WHITESPACE_TAGS
+        kids = children(el, in_preserve)
+
+        convert_children_as_inline = convert_as_inline
+        if not children_only and (_html_heading_re.match(name) is not None or name in ("td", "th")):
+            convert_children_as_inline = True
+
+        # Remove whitespace-only text in purely nested nodes
+        if name in _NESTED_TAGS:
+            i = 0
+            while i < len(kids):
+                kid = kids[i]
+                if (
+                    isinstance(kid, str)
+                    and kid.strip() == ""
+                    and (i == 0 or i == len(kids) - 1 or _is_nested(kids[i - 1]) or _is_nested(kids[i + 1]))
+                ):
+                    del kids[i]
+                # markdownify removes them while iterating the same list, so the child after a removed one is skipped
+                i += 1
+
+        in_pre = in_pre or name == "pre"
+        in_code = in_code or name in _CODE_TAGS
+        frames.append((el, kids, index))
+        parts = []
+        for i, kid in enumerate(kids):
+            if isinstance(kid, str):
+                if not in_pre:
+                    kid = _whitespace_re.sub(" ", kid)
+                if not in_code and kid:
+                    kid = kid.replace("*", r"\*").replace("_", r"\_")
+                if name == "li" and (i == len(kids) - 1 or _name(kids[i + 1]) in ("ul", "ol")):
+                    kid = kid.rstrip()
+                parts.append(kid)
+            elif isinstance(kid.tag, str):
+                parts.append(self._process(kid, convert_children_as_inline, False, frames, i, in_pre, in_code, in_preserve))
+        frames.pop()
+        text = "".join(parts)
+
+        if children_only:
+            return text
+        return self._convert(el, name, text, convert_as_inline, frames, index)
+
+    def _convert(self, el, name, text, convert_as_inline, frames, index) -> str:
+        parent, siblings, parent_index = frames[-1] if frames else (el.getparent(), None, None)
+
+        markup = _INLINE_MARKUP.get(name)
+        if markup is not None:
+            prefix, suffix, text = _chomp(text)
+            if not text:
+                return ""
+            return prefix + markup + text + markup + suffix
+
+        if name in ("code", "kbd", "samp"):
+            if parent is not None and parent.tag == "pre":
+                return text
+            prefix, suffix, text = _chomp(text)
+            if not text:
+                return ""
+            return prefix + "`" + text + "`" + suffix
+
+        m = _convert_heading_re.match("convert_" + name)
+        if m:
+            if convert_as_inline:
+                return text
+            n = int(m.group(1))
+            text = text.strip()
+            if n <= 2:
+                text = (text or "").rstrip()
+                return "%s\n%s\n\n" % (text, ("=" if n == 1 else "-") * len(text)) if text else ""
+            return "%s %s\n\n" % ("#" * n, text)
+
+        if name == "a":
+            prefix, suffix, text = _chomp(text)
+            if not text:
+                return ""
+            href = el.get("href")
+            title = el.get("title")
+            if text.replace(r"\_", "_") == href and not title:
+                return "<%s>" % href
+            title_part = ' "%s"' % title.replace('"', r"\"") if title else ""
+            return "%s[%s](%s%s)%s" % (prefix, text, href, title_part, suffix) if href else text
+
+        if name == "p":
+            if convert_as_inline:
+                return text
+            return "%s\n\n" % text if text else ""
+
+        if name == "br":
+            if convert_as_inline:
+                return ""
+            return "\\\n" if self.newline_style.lower() == BACKSLASH else "  \n"
+
+        if name in ("ul", "ol", "list"):
+            following = siblings[index + 1] if siblings is not None and index + 1 < len(siblings) else None
+            before_paragraph = _present(following) and _name(following) not in ("ul", "ol")
+            if any(True for _ in el.iterancestors("li")):
+                return "\n" + (_line_beginning_re.sub("\t", text) if text else "").rstrip()
+            return text + ("\n" if before_paragraph else "")
+
+        if name == "li":
+            if parent is not None and parent.tag == "ol":
+                start = int(parent.get("start")) if parent.get("start") else 1
+                bullet = "%s." % (start + index)
+            else:
+                depth = -1 + sum(1 for _ in el.iterancestors("ul"))
+                bullet = "*+-"[depth % 3]
+            return "%s %s\n" % (bullet, (text or "").strip())
+
+        if name in ("td", "th"):
+            colspan = int(el.get("colspan")) if "colspan" in el.attrib else 1
+            return " " + text.strip().replace("\n", " ") + " |" * colspan
+
+        if name == "tr":
+            return self._convert_tr(el, text, parent, siblings, index, frames, parent_index)
+
+        if name == "table":
+            return "\n\n" + text + "\n"
+
+        if name == "caption":
+            return text + "\n"
+
+        if name == "figcaption":
+            return "\n\n" + text + "\n\n"
+
+        if name == "blockquote":
+            if convert_as_inline:
+                return text
+            return "\n" + (_line_beginning_re.sub("> ", text.strip()) + "\n\n") if text else ""
+
+        if name == "pre":
+            if not text:
+                return ""
+            return "\n```%s\n%s\n```\n" % ("", text)
+
+        if name == "hr":
+            return "\n\n---\n\n"
+
+        if name == "img":
+            alt = el.get("alt") or ""
+            src = el.get("src") or ""
+            title = el.get("title") or ""
+            title_part = ' "%s"' % title.replace('"', r"\"") if title else ""
+            if convert_as_inline:
+                return alt
+            return "![%s](%s%s)" % (alt, src, title_part)
+
+        if name in PRUNED_TAGS:
+            return ""
+
+        return text
+
+    def _convert_tr(self, el, text, parent, siblings, index, frames, parent_index) -> str:
+        cells = list(el.iterdescendants("td", "th"))
+        if siblings is not None:
+            has_previous = index > 0 and _present(siblings[index - 1])
+        else:
+            has_previous = _present(_previous_sibling(el))
+        parent_name = parent.tag if parent is not None else None
+        is_headrow = (
+            all(cell.tag == "th" for cell in cells)
+            or (not has_previous and not parent_name == "tbody")
+            or (
+                not has_previous
+                and parent_name == "tbody"
+                and not any(True for _ in parent.getparent().iterdescendants("thead"))
+            )
+        )
+        overline = ""
+        underline = ""
+        if is_headrow and not has_previous:
+            full_colspan = 0
+            for cell in cells:
+                full_colspan += int(cell.get("colspan")) if "colspan" in cell.attrib else 1
+            underline += "| " + " | ".join(["---"] * full_colspan) + " |" + "\n"
+        elif not has_previous and (parent_name == "table" or (parent_name == "tbody" and not self._has_previous(parent, frames, parent_index))):
+            overline += "| " + " | ".join([""] * len(cells)) + " |" + "\n"
+            overline += "| " + " | ".join(["---"] * len(cells)) + " |" + "\n"
+        return overline + "|" + text + "\n" + underline
+
+    @staticmethod
+    def _has_previous(parent, frames, parent_index) -> bool:
+        # The tbody's own siblings were cleaned up by the walk when its parent is part of it
+        if len(frames) >= 2 and parent_index is not None:
+            grand_siblings = frames[-2][1]
+            return parent_index > 0 and _present(grand_siblings[parent_index - 1])
+        return _present(_previous_sibling(parent))
@@ -0,0 +1,342 @@
+"""On-disk HTTP response cache shared by every actor on the machine.
+
+Freshness follows Cache-Control, Expires and Last-Modified (RFC 9111). Stale entries
+are revalidated with If-None-Match / If-Modified-Since, so a 304 costs a round trip but
+no body. Bodies are stored once per sha256, no matter how many URLs serve them, and are
+evicted least recently used once the cache outgrows `size_limit`. Both tiers are
+diskcache sqlite stores, so any number of processes can read and write them at once.
+In offline mode nothing is sent and only cached responses are served.
+"""
+import email.utils
+import hashlib
+import http
+import io
+import itertools
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import diskcache as dc
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+# Statuses a cache may store without explicit freshness information
+CACHEABLE_STATUS = {200, 203, 300, 301, 308, 404, 410}
+
+# Heuristic freshness for responses that only carry Last-Modified is capped at a day
+HEURISTIC_MAX_AGE = 24 * 60 * 60
+
+# Hop-by-hop and body framing headers do not describe the cached (decoded) body
+_DROPPED_HEADERS = ("connection", "keep-alive", "transfer-encoding", "content-encoding", "content-length")
+
+
+class BodyTooLarge(Exception):
+    """The body is larger than the `max_bytes` a caller of HTTPCache.get asked for."""
+
+
+def _parse_cache_control(value: str) -> Dict[str, Optional[str]]:
+    directives: Dict[str, Optional[str]] = {}
+    for part in value.split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+
+def _http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return float(email.utils.mktime_tz(parsed))
+
+
+def _int_or_zero(value: Optional[str]) -> int:
+    try:
+        return max(0, int(value))  # type: ignore[arg-type]
+    except (TypeError, ValueError):
+        return 0
+
+
+def _freshness_lifetime(headers: Dict[str, str]) -> float:
+    cache_control = _parse_cache_control(headers.get("cache-control", ""))
+    if "no-cache" in cache_control:
+        return 0.0
+    if "max-age" in cache_control:
+        return float(_int_or_zero(cache_control["max-age"]))
+
+    date = _http_date(headers.get("date")) or time.time()
+    expires = headers.get("expires")
+    if expires is not None:
+        # An invalid Expires means already expired
+        expires_at = _http_date(expires)
+        return max(0.0, expires_at - date) if expires_at is not None else 0.0
+
+    last_modified = _http_date(headers.get("last-modified"))
+    if last_modified is not None:
+        return min(HEURISTIC_MAX_AGE, max(0.0, 0.1 * (date - last_modified)))
+    return 0.0
+
+
+class _ChunkReader(io.RawIOBase):
+    """File-like view over an iterator of byte chunks, used as Response.raw."""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self._chunks = chunks
+        # The current chunk and how far into it has been read, a cached body is one chunk of up to max_entry_size
+        self._chunk = memoryview(b"")
+        self._offset = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        parts = []
+        wanted = size
+        while size < 0 or wanted > 0:
+            if self._offset == len(self._chunk):
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._chunk = memoryview(chunk)
+                self._offset = 0
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + wanted)
+            parts.append(self._chunk[self._offset : end])
+            wanted -= end - self._offset
+            self._offset = end
+        return b"".join(parts)
+
+
+def _build_response(
+    status: int,
+    headers: Dict[str, str],
+    url: str,
+    chunks: Iterator[bytes],
+    template: Optional[requests.Response] = None,
+) -> requests.Response:
+    response = requests.Response()
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response.url = url
+    response.raw = _ChunkReader(chunks)
+    response.encoding = get_encoding_from_headers(response.headers)
+    try:
+        response.reason = http.HTTPStatus(status).phrase
+    except ValueError:
+        response.reason = ""
+    if template is not None:
+        response.reason = template.reason
+        response.history = template.history
+        response.request = template.request
+        response.elapsed = template.elapsed
+        response.cookies = template.cookies
+    return response
+
+
+class HTTPCache:
+    """Conditional-GET cache in front of a requests session."""
+
+    def __init__(
+        self,
+        directory: str = ".cache/http",
+        size_limit: int = 8 * 1024 * 1024 * 1024,
+        max_entry_size: int = 64 * 1024 * 1024,
+        offline: bool = False,
+    ):
+        self.max_entry_size = max_entry_size
+        self.offline = offline
+        # url -> status, headers, sha256 of the body and when it was stored
+        self._entries = dc.Cache(f"{directory}/entries", timeout=60, size_limit=size_limit // 64)
+        # sha256 -> body, large bodies are kept as plain files by diskcache
+        self._bodies = dc.Cache(
+            f"{directory}/bodies", timeout=60, size_limit=size_limit, eviction_policy="least-recently-used"
+        )
+
+        self._lock = threading.Lock()
+        self.counts = {"hits": 0, "revalidated": 0, "misses": 0, "stale_served": 0, "offline_misses": 0, "stored": 0}
+        self.bytes_served = 0
+
+    def _count(self, name: str, body_size: int = 0) -> None:
+        with self._lock:
+            self.counts[name] += 1
+            self.bytes_served += body_size
+
+    @staticmethod
+    def _request_headers(session: requests.Session, kwargs: Dict[str, Any]) -> CaseInsensitiveDict:
+        headers = CaseInsensitiveDict(session.headers)
+        headers.update(kwargs.get("headers") or {})
+        return headers
+
+    def _lookup(self, url: str, request_headers: CaseInsensitiveDict) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(url)
+        if entry is None:
+            return None
+        for name, value in entry["vary"].items():
+            if request_headers.get(name) != value:
+                return None
+        body = self._bodies.get(entry["sha256"])
+        if body is None:
+            # The body was evicted, the entry is useless without it
+            self._entries.delete(url)
+            return None
+        entry["body"] = body
+        return entry
+
+    def _store(
+        self, url: str, response: requests.Response, body: bytes, request_headers: CaseInsensitiveDict
+    ) -> None:
+        sha256 = hashlib.sha256(body).hexdigest()
+        headers = {k.lower(): v for k, v in response.headers.items() if k.lower() not in _DROPPED_HEADERS}
+        vary = [name.strip().lower() for name in headers.get("vary", "").split(",") if name.strip()]
+        self._bodies.add(sha256, body)
+        self._entries.set(
+            url,
+            {
+                "status": response.status_code,
+                "url": response.url,
+                "headers": headers,
+                "vary": {name: request_headers.get(name) for name in vary},
+                "sha256": sha256,
+                "stored_at": time.time(),
+            },
+        )
+        self._count("stored")
+
+    @staticmethod
+    def _is_fresh(entry: Dict[str, Any]) -> bool:
+        age = _int_or_zero(entry["headers"].get("age")) + time.time() - entry["stored_at"]
+        return age < _freshness_lifetime(entry["headers"])
+
+    def _serve(self, entry: Dict[str, Any], outcome: str, max_bytes: Optional[int] = None) -> requests.Response:
+        if max_bytes is not None and len(entry["body"]) > max_bytes:
+            raise BodyTooLarge(f"{entry['url']} is {len(entry['body'])} bytes, more than {max_bytes}")
+        self._count(outcome, len(entry["body"]))
+        return _build_response(entry["status"], entry["headers"], entry["url"], iter([entry["body"]]))
+
+    def _cacheable(self, response: requests.Response, request_headers: CaseInsensitiveDict) -> bool:
+        if response.status_code not in CACHEABLE_STATUS or "authorization" in request_headers:
+            return False
+        cache_control = _parse_cache_control(response.headers.get("cache-control", ""))
+        if "no-store" in cache_control or response.headers.get("vary", "").strip() == "*":
+            return False
+        return int(response.headers.get("content-length") or 0) <= self.max_entry_size
+
+    def get(
+        self,
+        session: requests.Session,
+        url: str,
+        cache_body: Optional[Callable[[requests.Response], bool]] = None,
+        max_bytes: Optional[int] = None,
+        **kwargs: Any,
+    ) -> requests.Response:
+        """GET `url` through the cache. The response body is always streamed (`stream=True`).
+
+        `cache_body(response)` can turn down storing a response, such as a download the
+        caller keeps elsewhere, so its body is not written to disk twice. With `max_bytes`,
+        BodyTooLarge is raised instead of reading more of a body than that. A declared
+        Content-Length is checked before any of the body is read. A body of unknown length
+        that is not stored is handed back unread, its reader has to stop on its own.
+        """
+        request_headers = self._request_headers(session, kwargs)
+        entry = None if "authorization" in request_headers else self._lookup(url, request_headers)
+
+        if self.offline:
+            if entry is None:
+                self._count("offline_misses")
+                raise requests.exceptions.ConnectionError(f"Offline and not cached: {url}")
+            return self._serve(entry, "hits", max_bytes)
+
+        if entry is not None and self._is_fresh(entry):
+            return self._serve(entry, "hits", max_bytes)
+
+        kwargs["stream"] = True
+        if entry is not None:
+            conditional = {}
+            if "etag" in entry["headers"]:
+                conditional["If-None-Match"] = entry["headers"]["etag"]
+            if "last-modified" in entry["headers"]:
+                conditional["If-Modified-Since"] = entry["headers"]["last-modified"]
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), **conditional}
+
+        try:
+            response = session.get(url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            # A stale copy beats no page, unless the origin forbade it
+            if entry is not None and "must-revalidate" not in _parse_cache_control(
+                entry["headers"].get("cache-control", "")
+            ):
+                return self._serve(entry, "stale_served", max_bytes)
+            raise
+
+        if entry is not None and response.status_code == 304:
+            response.close()
+            entry["headers"].update(
+                {k.lower(): v for k, v in response.headers.items() if k.lower() not in _DROPPED_HEADERS}
+            )
+            entry["stored_at"] = time.time()
+            body = entry.pop("body")
+            self._entries.set(url, entry)
+            entry["body"] = body
+            return self._serve(entry, "revalidated", max_bytes)
+
+        self._count("misses")
+        declared = _int_or_zero(response.headers.get("content-length"))
+        if max_bytes is not None and declared > max_bytes:
+            response.close()
+            raise BodyTooLarge(f"{url} is {declared} bytes, more than {max_bytes}")
+        if not self._cacheable(response, request_headers) or (cache_body is not None and not cache_body(response)):
+            return response
+
+        # Read up to max_entry_size. Larger bodies are handed back unstored, the bytes
+        # already read are replayed in front of the rest of the stream
+        chunks: List[bytes] = []
+        size = 0
+        stream = response.iter_content(chunk_size=1024 * 1024)
+        for chunk in stream:
+            chunks.append(chunk)
+            size += len(chunk)
+            if max_bytes is not None and size > max_bytes:
+                response.close()
+                raise BodyTooLarge(f"{url} is more than {max_bytes} bytes")
+            if size > self.max_entry_size:
+                headers = {k: v for k, v in response.headers.items() if k.lower() not in _DROPPED_HEADERS}
+                return _build_response(
+                    response.status_code, headers, response.url, itertools.chain(chunks, stream), response
+                )
+
+        body = b"".join(chunks)
+        try:
+            self._store(url, response, body, request_headers)
+        except dc.Timeout as e:
+            print(f"Ignoring error: {e} when caching {url}")
+        headers = {k: v for k, v in response.headers.items() if k.lower() not in _DROPPED_HEADERS}
+        return _build_response(response.status_code, headers, response.url, iter([body]), response)
+
+    def stats(self) -> Dict[str, Any]:
+        served = self.counts["hits"] + self.counts["revalidated"] + self.counts["stale_served"]
+        lookups = served + self.counts["misses"] + self.counts["offline_misses"]
+        return {
+            **self.counts,
+            "hit_rate": served / lookups if lookups else 0.0,
+            "bytes_served": self.bytes_served,
+            "volume": self._bodies.volume(),
+        }
+
+    def close(self) -> None:
+        self._entries.close()
+        self._bodies.close()
+
+
+_shared_cache: Optional[HTTPCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_http_cache(**kwargs: Any) -> HTTPCache:
+    """Return the cache shared by everything in this process, creating it with `kwargs` on first use."""
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = HTTPCache(**kwargs)
+        return _shared_cache
@@ -0,0 +1,132 @@
+"""A process-wide pooled requests session shared by the browser and the document converter.
+
+Connections are kept alive and reused across pages, the number of requests in flight to
+one host is capped, every request gets default connect and read timeouts, failures are
+retried and circuit-broken per host (see utils/resilience.py), and new versus reused
+connections are counted.
+"""
+import threading
+from typing import Any, Dict, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .resilience import ResilientCaller, RetryPolicy
+
+# (connect, read) seconds
+DEFAULT_TIMEOUT = (10, 60)
+
+
+class _ConnectionCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def count_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def count_connection(self) -> None:
+        with self._lock:
+            self.new_connections += 1
+
+
+def _counting_pool(base, counter: _ConnectionCounter):
+    class CountingConnectionPool(base):
+        def _new_conn(self):
+            counter.count_connection()
+            return super()._new_conn()
+
+    return CountingConnectionPool
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that counts the connections its pools open."""
+
+    def __init__(self, counter: _ConnectionCounter, **kwargs):
+        self._counter = counter
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool(HTTPConnectionPool, self._counter),
+            "https": _counting_pool(HTTPSConnectionPool, self._counter),
+        }
+
+    def send(self, request, **kwargs):
+        self._counter.count_request()
+        return super().send(request, **kwargs)
+
+
+class PooledSession(requests.Session):
+    """requests.Session with keep-alive pools, per-host concurrency caps and default timeouts."""
+
+    def __init__(
+        self,
+        pool_connections: int = 64,
+        max_per_host: int = 8,
+        timeout: Union[float, Tuple[float, float]] = DEFAULT_TIMEOUT,
+        retry_policy: Optional[RetryPolicy] = None,
+    ):
+        super().__init__()
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.resilience = ResilientCaller(retry_policy)
+        self._counter = _ConnectionCounter()
+        # pool_connections is the number of hosts kept alive, pool_maxsize the connections kept per host
+        adapter = PooledHTTPAdapter(self._counter, pool_connections=pool_connections, pool_maxsize=max_per_host)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+        self._host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._host_slots_lock = threading.Lock()
+
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._host_slots_lock:
+            slot = self._host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.max_per_host)
+                self._host_slots[host] = slot
+        return slot
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        slot = self._host_slot(url)
+
+        def send() -> requests.Response:
+            # The slot is held until the response headers arrive, streamed bodies are read
+            # and retries wait outside of it
+            with slot:
+                return super(PooledSession, self).request(method, url, **kwargs)
+
+        return self.resilience.call(method, urlparse(url).netloc, send)
+
+    def stats(self) -> Dict[str, Any]:
+        requests_sent = self._counter.requests
+        new_connections = self._counter.new_connections
+        return {
+            "requests": requests_sent,
+            "new_connections": new_connections,
+            "reused_connections": max(0, requests_sent - new_connections),
+            "reuse_rate": max(0, requests_sent - new_connections) / requests_sent if requests_sent else 0.0,
+            **self.resilience.stats(),
+        }
+
+
+_shared_session: Optional[PooledSession] = None
+_shared_session_lock = threading.Lock()
+
+
+def get_session(**kwargs: Any) -> PooledSession:
+    """Return the session shared by everything in this process, creating it with `kwargs` on first use."""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = PooledSession(**kwargs)
+        return _shared_session
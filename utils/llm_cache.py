@@ -0,0 +1,139 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import diskcache as dc
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+
+class TwoTierLLMCache(BaseCache):
+    """LLM response cache with a per-actor LRU in front of a sharded on-disk store.
+
+    The in-memory tier holds deserialized generations and evicts the least recently used
+    entries once `memory_limit` bytes of serialized responses are held. The shared tier is a
+    diskcache FanoutCache: writes are spread over `shards` sqlite files, so actors writing at
+    the same time rarely contend on the same lock.
+    """
+
+    def __init__(
+        self,
+        directory: str = ".cache/llm",
+        memory_limit: int = 256 * 1024 * 1024,
+        shards: int = 16,
+        size_limit: int = 16 * 1024 * 1024 * 1024,
+    ):
+        self.memory_limit = memory_limit
+        self._memory: "OrderedDict[str, Tuple[RETURN_VAL_TYPE, int]]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._store = dc.FanoutCache(directory, shards=shards, timeout=1, size_limit=size_limit)
+
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{prompt}\0{llm_string}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, generations: RETURN_VAL_TYPE, size: int) -> None:
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= self._memory.pop(key)[1]
+            self._memory[key] = (generations, size)
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_limit and len(self._memory) > 1:
+                _, (_, evicted_size) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_size
+
+    def _lookup_memory(self, key: str) -> Optional[RETURN_VAL_TYPE]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return entry[0]
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        key = self._key(prompt, llm_string)
+        generations = self._lookup_memory(key)
+        if generations is not None:
+            return generations
+
+        responses: Optional[List[str]] = self._store.get(key)
+        if responses is None:
+            self.misses += 1
+            return None
+        self.store_hits += 1
+        generations = [loads(response) for response in responses]
+        self._remember(key, generations, sum(len(response) for response in responses))
+        return generations
+
+    async def alookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        # Memory hits are answered on the event loop, only the disk tier goes to the executor
+        generations = self._lookup_memory(self._key(prompt, llm_string))
+        if generations is not None:
+            return generations
+        return await super().alookup(prompt, llm_string)
+
+    def update(self, prompt: str, llm_string: str, return_val: RETURN_VAL_TYPE) -> None:
+        key = self._key(prompt, llm_string)
+        responses = [dumps(generation) for generation in return_val]
+        self._store.set(key, responses)
+        self._remember(key, return_val, sum(len(response) for response in responses))
+
+    def clear(self, **kwargs: Any) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        self._store.clear()
+
+    def warm_from_sqlite(self, sqlite_path: str = "llm_cache.sqlite") -> int:
+        """Copy the entries of a langchain SQLiteCache file into the shared tier.
+
+        Returns the number of cache entries imported. A file is only imported once
+        for a given modification time.
+        """
+        if not os.path.exists(sqlite_path):
+            return 0
+        marker = ("warmed_from", os.path.abspath(sqlite_path), os.path.getmtime(sqlite_path))
+        if self._store.get(marker) is not None:
+            return 0
+
+        imported = 0
+        db = sqlite3.connect(f"file:{sqlite_path}?mode=ro", uri=True)
+        try:
+            rows = db.execute("SELECT prompt, llm, response FROM full_llm_cache ORDER BY prompt, llm, idx")
+            group: Optional[Tuple[str, str]] = None
+            responses: List[str] = []
+            for prompt, llm_string, response in rows:
+                if (prompt, llm_string) != group:
+                    if group is not None:
+                        self._store.set(self._key(*group), responses)
+                        imported += 1
+                    group, responses = (prompt, llm_string), []
+                responses.append(response)
+            if group is not None:
+                self._store.set(self._key(*group), responses)
+                imported += 1
+        finally:
+            db.close()
+
+        self._store.set(marker, imported)
+        return imported
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.memory_hits + self.store_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "store_hits": self.store_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.store_hits) / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+        }
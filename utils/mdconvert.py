@@ -11,50 +11,138 @@ import markdownify
 import io
 import uuid
 import mimetypes
-import html
 import pathlib
 import puremagic
 import tempfile
 import copy
-import mammoth
-import pptx
-import pydub
-import pandas as pd
-import speech_recognition as sr
+import csv
 import sys
+import time
 import traceback
+import importlib
+import importlib.util
+import functools
+import itertools
+import threading
+import multiprocessing
+import concurrent.futures
 
-import PIL
 import shutil
 import subprocess
-import easyocr
-import numpy as np
 
 import base64
 
 from urllib.parse import urljoin, urlparse, parse_qs
 from urllib.request import url2pathname
 from bs4 import BeautifulSoup
+from .http_session import get_session
+from .conversion_cache import ConversionCache, file_sha256, get_conversion_cache
+from .downloads import stream_to_file
+from .pdf_pages import get_pdf_extractor
+from .table_markdown import TABLE_MAX_COLUMNS, TABLE_MAX_ROWS, TABLE_PREVIEW_ROWS, TableWriter, markdown_table
 from typing import Any, Dict, List, Optional, Union, Tuple
 
+# Converter backends (pandas, pptx, mammoth, pdfminer, whisper, easyocr, ...) are imported on first use,
+# so an actor only pays for the formats its questions actually open.
+BACKEND_IMPORT_TIMES: Dict[str, float] = {}
+
+
+def _backend(module_name: str):
+    """Import a converter backend on first use, recording how long the import took."""
+    module = sys.modules.get(module_name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        BACKEND_IMPORT_TIMES[module_name] = time.perf_counter() - start
+    return module
+
+
+# Conversion attempts, counted over every MarkdownConverter of the process
+CONVERSION_STATS: Dict[str, Any] = {"documents": 0, "attempts": 0, "declined": 0, "errors": 0, "converters": {}}
+_conversion_stats_lock = threading.Lock()
+
+
+def _record_attempt(converter: "DocumentConverter", outcome: str, seconds: float) -> None:
+    with _conversion_stats_lock:
+        CONVERSION_STATS["attempts"] += 1
+        if outcome != "converted":
+            CONVERSION_STATS[outcome] += 1
+        stats = CONVERSION_STATS["converters"].setdefault(
+            type(converter).__name__, {"attempts": 0, "converted": 0, "declined": 0, "errors": 0, "seconds": 0.0}
+        )
+        stats["attempts"] += 1
+        stats[outcome] += 1
+        stats["seconds"] += seconds
+
+
+def conversion_stats() -> Dict[str, Any]:
+    with _conversion_stats_lock:
+        documents = CONVERSION_STATS["documents"]
+        return {
+            **copy.deepcopy(CONVERSION_STATS),
+            "attempts_per_document": CONVERSION_STATS["attempts"] / documents if documents else 0.0,
+        }
+
+
+class ParsedDocument:
+    """Parse trees of one document, shared by every converter that tries it."""
+
+    def __init__(self, local_path: str):
+        self.local_path = local_path
+        self._html = None
+        self._soup = None
+        self._tree = None
+
+    def html(self) -> str:
+        if self._html is None:
+            with open(self.local_path, "rt") as fh:
+                self._html = fh.read()
+        return self._html
+
+    def soup(self) -> BeautifulSoup:
+        if self._soup is None:
+            self._soup = BeautifulSoup(self.html(), "html.parser")
+        return self._soup
+
+    def tree(self):
+        """The lxml tree of the document, for the "lxml" HTML engine."""
+        if self._tree is None:
+            self._tree = _html_markdown().parse_html(self.html())
+        return self._tree
+
+
+def _parsed(local_path, kwargs) -> ParsedDocument:
+    # Converters run outside of MarkdownConverter parse the file themselves
+    document = kwargs.get("document")
+    return document if document is not None else ParsedDocument(local_path)
+
+
+def _html_markdown():
+    return _backend(f"{__package__}.html_markdown")
+
+
+def _effective_html_engine(html_engine: str) -> str:
+    # "lxml" falls back to BeautifulSoup and markdownify when lxml is not installed
+    return "lxml" if html_engine == "lxml" and IS_LXML_CAPABLE else "html.parser"
+
+
 # Optional PDF support
-IS_PDF_CAPABLE = False
-try:
-    import pdfminer
-    import pdfminer.high_level
+IS_PDF_CAPABLE = importlib.util.find_spec("pdfminer") is not None
 
-    IS_PDF_CAPABLE = True
-except ModuleNotFoundError:
-    pass
+# Optional faster HTML engine, see utils/html_markdown.py
+IS_LXML_CAPABLE = importlib.util.find_spec("lxml") is not None
+
+# html.parser puts everything in the root when a page has no <body>, libxml2 always adds one
+_BODY_TAG = re.compile(r"<body[\s>/]", re.IGNORECASE)
 
 # Optional YouTube transcription support
-IS_YOUTUBE_TRANSCRIPT_CAPABLE = False
-try:
-    from youtube_transcript_api import YouTubeTranscriptApi
+IS_YOUTUBE_TRANSCRIPT_CAPABLE = importlib.util.find_spec("youtube_transcript_api") is not None
 
-    IS_YOUTUBE_TRANSCRIPT_CAPABLE = True
-except ModuleNotFoundError:
-    pass
+
+def normalize_text(text: str) -> str:
+    """Strip trailing whitespace from every line and collapse runs of blank lines, as done to every result."""
+    text = "\n".join([line.rstrip() for line in re.split(r"\r?\n", text)])
+    return re.sub(r"\n{3,}", "\n\n", text)
 
 
 class DocumentConverterResult:
@@ -65,7 +153,39 @@ class DocumentConverterResult:
         self.text_content = text_content
 
 
+class StreamingConverterResult(DocumentConverterResult):
+    """A PDF whose pages are still being extracted, or that has pages with a placeholder. `text_content` holds the pages in so far."""
+
+    def __init__(self, title: Union[str, None], pages):
+        super().__init__(title, normalize_text(pages.text()))
+        self.pages = pages
+
+    @property
+    def complete(self) -> bool:
+        return self.pages.complete
+
+    def refresh(self, wait: bool = False) -> bool:
+        """Take in the pages extracted since the last call, waiting for the next chunk if `wait`. Returns whether text was added."""
+        if wait:
+            self.pages.wait(self.pages.ready_pages + 1)
+        text = normalize_text(self.pages.text())
+        if len(text) == len(self.text_content):
+            return False
+        self.text_content = text
+        return True
+
+
 class DocumentConverter:
+    # Results are cached by file content, bump `version` whenever a converter's output changes.
+    # `cache_kwargs` lists the kwargs, besides the file itself, that the output depends on,
+    # `cache_attributes` the attributes of the converter it depends on.
+    version = 1
+    cache_kwargs: Tuple[str, ...] = ("file_extension",)
+    cache_attributes: Tuple[str, ...] = ()
+    # MarkdownConverter only tries a converter for these extensions (None for any) and URLs
+    extensions: Optional[Tuple[str, ...]] = None
+    url_pattern: Optional[str] = None
+
     def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
         raise NotImplementedError()
 
@@ -98,24 +218,44 @@ class PlainTextConverter(DocumentConverter):
 class HtmlConverter(DocumentConverter):
     """Anything with content type text/html"""
 
+    version = 2
+    extensions = (".html", ".htm")
+    # "lxml" converts with utils.html_markdown when lxml is installed, "html.parser" with BeautifulSoup and markdownify
+    html_engine = "lxml"
+    cache_attributes = ("engine",)
+
+    @property
+    def engine(self) -> str:
+        """The engine that converts pages, so that the cache keeps the output of each apart."""
+        return _effective_html_engine(self.html_engine)
+
     def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
         # Bail if not html
         extension = kwargs.get("file_extension", "")
         if extension.lower() not in [".html", ".htm"]:
             return None
 
-        result = None
-        with open(local_path, "rt") as fh:
-            result = self._convert(fh.read())
+        document = _parsed(local_path, kwargs)
+        if self.engine == "lxml" and _BODY_TAG.search(document.html()):
+            html_markdown = _html_markdown()
+            root = document.tree()
+            body_elm = html_markdown.find(root, "body")
+            if body_elm is not None:
+                title_elm = html_markdown.find(root, "title")
+                return DocumentConverterResult(
+                    title=None if title_elm is None else html_markdown.string(title_elm),
+                    text_content=html_markdown.LxmlMarkdownConverter(newline_style="backslash").convert_tree(body_elm),
+                )
 
-        return result
+        return self._convert_soup(document.soup())
 
     def _convert(self, html_content) -> Union[None, DocumentConverterResult]:
         """Helper function that converts and HTML string."""
 
         # Parse the string
-        soup = BeautifulSoup(html_content, "html.parser")
+        return self._convert_soup(BeautifulSoup(html_content, "html.parser"))
 
+    def _convert_soup(self, soup) -> Union[None, DocumentConverterResult]:
         # Remove javascript and style blocks
         for script in soup(["script", "style"]):
             script.extract()
@@ -137,19 +277,33 @@ class HtmlConverter(DocumentConverter):
 class WikipediaConverter(DocumentConverter):
     """Handle Wikipedia pages separately, focusing only on the main document content."""
 
+    version = 2
+    cache_kwargs = ("file_extension", "url")
+    extensions = (".html", ".htm")
+    url_pattern = r"^https?:\/\/[a-zA-Z]{2,3}\.wikipedia.org\/"
+    html_engine = "lxml"
+    cache_attributes = ("engine",)
+
+    @property
+    def engine(self) -> str:
+        return _effective_html_engine(self.html_engine)
+
     def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
         # Bail if not Wikipedia
         extension = kwargs.get("file_extension", "")
         if extension.lower() not in [".html", ".htm"]:
             return None
         url = kwargs.get("url", "")
-        if not re.search(r"^https?:\/\/[a-zA-Z]{2,3}\.wikipedia.org\/", url):
+        if not re.search(self.url_pattern, url):
             return None
 
         # Parse the file
-        soup = None
-        with open(local_path, "rt") as fh:
-            soup = BeautifulSoup(fh.read(), "html.parser")
+        document = _parsed(local_path, kwargs)
+        if self.engine == "lxml":
+            result = self._convert_tree(document.tree())
+            if result is not None:
+                return result
+        soup = document.soup()
 
         # Remove javascript and style blocks
         for script in soup(["script", "style"]):
@@ -176,10 +330,36 @@ class WikipediaConverter(DocumentConverter):
             text_content=webpage_text,
         )
 
+    def _convert_tree(self, root) -> Union[None, DocumentConverterResult]:
+        """The main content with the lxml engine, None when the page has none."""
+        html_markdown = _html_markdown()
+        body_elm = html_markdown.find(root, "div", id="mw-content-text")
+        if body_elm is None:
+            return None
+        title_elm = html_markdown.find(root, "span", **{"class": "mw-page-title-main"})
+
+        # What's the title
+        page_title = html_markdown.string(html_markdown.find(root, "title"))
+        main_title = page_title
+        if title_elm is not None and len(html_markdown.children(title_elm)) > 0:
+            main_title = html_markdown.string(title_elm)
+
+        # Convert the page
+        webpage_text = "# " + main_title + "\n\n" + html_markdown.LxmlMarkdownConverter().convert_tree(body_elm)
+
+        return DocumentConverterResult(
+            title=page_title,
+            text_content=webpage_text,
+        )
+
 
 class YouTubeConverter(DocumentConverter):
     """Handle YouTube specially, focusing on the video title, description, and transcript."""
 
+    cache_kwargs = ("file_extension", "url")
+    extensions = (".html", ".htm")
+    url_pattern = r"^https://www\.youtube\.com/watch\?"
+
     def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
         # Bail if not YouTube
         extension = kwargs.get("file_extension", "")
@@ -190,9 +370,7 @@ class YouTubeConverter(DocumentConverter):
             return None
 
         # Parse the file
-        soup = None
-        with open(local_path, "rt") as fh:
-            soup = BeautifulSoup(fh.read(), "html.parser")
+        soup = _parsed(local_path, kwargs).soup()
 
         # Read the meta tags
         metadata = {"title": soup.title.string}
@@ -254,7 +432,7 @@ class YouTubeConverter(DocumentConverter):
                 video_id = params["v"][0]
                 try:
                     # Must be a single transcript.
-                    transcript = YouTubeTranscriptApi.get_transcript(video_id)
+                    transcript = _backend("youtube_transcript_api").YouTubeTranscriptApi.get_transcript(video_id)
                     transcript_text = " ".join([part["text"] for part in transcript])
                     # Alternative formatting:
                     # formatter = TextFormatter()
@@ -293,19 +471,44 @@ class YouTubeConverter(DocumentConverter):
 
 
 class PdfConverter(DocumentConverter):
+    """PDFs with pdfminer. With `stream_pages=True`, the pages are extracted in a process pool and a
+    StreamingConverterResult is returned once the first ones are in. Only pass it for files that stay
+    on disk, the pool keeps reading the file after convert returns."""
+
+    extensions = (".pdf",)
+
     def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
         # Bail if not a PDF
         extension = kwargs.get("file_extension", "")
         if extension.lower() != ".pdf":
             return None
 
+        if kwargs.get("stream_pages"):
+            sha256 = kwargs.get("file_sha256") or file_sha256(local_path)
+            extractor = get_pdf_extractor()
+            pages = extractor.extract(local_path, sha256)
+            pages.wait(extractor.first_pages)
+            if pages.error is not None and pages.extracted_pages == 0:
+                # Not a single page so far, this is only a document if some later page extracts
+                pages.wait(pages.num_pages)
+                if pages.extracted_pages == 0:
+                    raise pages.error
+            # Pages with a placeholder are tried again on the next visit, so their result is not cached
+            if not pages.complete or pages.error is not None:
+                return StreamingConverterResult(None, pages)
+            return DocumentConverterResult(title=None, text_content=pages.text())
+
         return DocumentConverterResult(
             title=None,
-            text_content=pdfminer.high_level.extract_text(local_path),
+            text_content=_backend("pdfminer.high_level").extract_text(local_path),
         )
 
 
 class DocxConverter(HtmlConverter):
+    extensions = (".docx",)
+    # Always converted with BeautifulSoup and markdownify, see HtmlConverter._convert
+    cache_attributes = ()
+
     def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
         # Bail if not a DOCX
         extension = kwargs.get("file_extension", "")
@@ -314,130 +517,209 @@ class DocxConverter(HtmlConverter):
 
         result = None
         with open(local_path, "rb") as docx_file:
-            result = mammoth.convert_to_html(docx_file)
+            result = _backend("mammoth").convert_to_html(docx_file)
             html_content = result.value
             result = self._convert(html_content)
 
         return result
 
 
-class XlsxConverter(HtmlConverter):
+class TableConverter(DocumentConverter):
+    """Base of the converters that write the rows of a sheet straight to a Markdown table, see utils/table_markdown.py."""
+
+    max_rows = TABLE_MAX_ROWS
+    max_columns = TABLE_MAX_COLUMNS
+    preview_rows = TABLE_PREVIEW_ROWS
+
+    def _table_writer(self, **kwargs) -> TableWriter:
+        return TableWriter(self.max_rows, self.max_columns, self.preview_rows, **kwargs)
+
+
+class XlsxConverter(TableConverter):
+    version = 2
+    extensions = (".xlsx",)
+
     def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
         # Bail if not a XLSX
         extension = kwargs.get("file_extension", "")
         if extension.lower() != ".xlsx":
             return None
 
-        sheets = pd.read_excel(local_path, sheet_name=None)
-        md_content = ""
-        for s in sheets:
-            md_content += f"## {s}\n"
-            html_content = sheets[s].to_html(index=False)
-            md_content += self._convert(html_content).text_content.strip() + "\n\n"
+        # Read-only mode streams the rows from the file instead of loading every cell
+        workbook = _backend("openpyxl").load_workbook(local_path, read_only=True, data_only=True)
+        try:
+            md_content = []
+            for sheet in workbook.worksheets:
+                writer = self._table_writer()
+                for row in sheet.iter_rows(values_only=True):
+                    writer.add(row)
+                md_content.append(f"## {sheet.title}\n" + writer.markdown())
+        finally:
+            workbook.close()
 
         return DocumentConverterResult(
             title=None,
-            text_content=md_content.strip(),
+            text_content="\n\n".join(md_content).strip(),
         )
 
 
-class PptxConverter(HtmlConverter):
+class CsvConverter(TableConverter):
+    extensions = (".csv",)
+
+    def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
+        # Bail if not a CSV
+        extension = kwargs.get("file_extension", "")
+        if extension.lower() != ".csv":
+            return None
+
+        # Every value is text, numbers are recognized for the column summary
+        writer = self._table_writer(parse_numbers=True)
+        with open(local_path, "rt", newline="") as fh:
+            sample = fh.read(64 * 1024)
+            fh.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+            except csv.Error:
+                dialect = csv.excel
+            for row in csv.reader(fh, dialect):
+                writer.add(row)
+
+        return DocumentConverterResult(
+            title=None,
+            text_content=writer.markdown(),
+        )
+
+
+# Decks with at least this many slides are split between this process and the workers of the slide pool
+PPTX_PARALLEL_MIN_SLIDES = 300
+# Every worker opens the whole deck again, so a single CPU gets no workers
+PPTX_WORKERS = max(0, min(4, (os.cpu_count() or 1) - 1))
+
+_slide_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_slide_pool_lock = threading.Lock()
+
+
+def _get_slide_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _slide_pool
+    with _slide_pool_lock:
+        if _slide_pool is None:
+            # Forking a process that runs threads (Ray actors, the tool executor) is unsafe
+            _slide_pool = concurrent.futures.ProcessPoolExecutor(
+                max(1, PPTX_WORKERS), mp_context=multiprocessing.get_context("spawn")
+            )
+        return _slide_pool
+
+
+def _pptx_slides(local_path: str, start: int, stop: int, presentation=None) -> List[str]:
+    """The Markdown of slides `start` to `stop` - 1 of a deck, also run in the workers of the slide pool."""
+    if presentation is None:
+        presentation = _backend("pptx").Presentation(local_path)
+    converter = PptxConverter()
+    # Slides.__getitem__ rebuilds the slide list on every call, islice walks it once
+    slides = itertools.islice(presentation.slides, start, stop)
+    return [converter._slide_markdown(slide, start + i + 1) for i, slide in enumerate(slides)]
+
+
+class PptxConverter(DocumentConverter):
+    version = 2
+    extensions = (".pptx",)
+    parallel_min_slides = PPTX_PARALLEL_MIN_SLIDES
+
     def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
         # Bail if not a PPTX
         extension = kwargs.get("file_extension", "")
         if extension.lower() != ".pptx":
             return None
 
-        md_content = ""
-
-        presentation = pptx.Presentation(local_path)
-        slide_num = 0
-        for slide in presentation.slides:
-            slide_num += 1
-
-            md_content += f"\n\n<!-- Slide number: {slide_num} -->\n"
-
-            title = slide.shapes.title
-            for shape in slide.shapes:
-                # Pictures
-                if self._is_picture(shape):
-                    # https://github.com/scanny/python-pptx/pull/512#issuecomment-1713100069
-                    alt_text = ""
-                    try:
-                        alt_text = shape._element._nvXxPr.cNvPr.attrib.get("descr", "")
-                    except:
-                        pass
-
-                    # A placeholder name
-                    filename = re.sub(r"\W", "", shape.name) + ".jpg"
-                    # try:
-                    #    filename = shape.image.filename
-                    # except:
-                    #    pass
-
-                    md_content += "\n![" + (alt_text if alt_text else shape.name) + "](" + filename + ")\n"
-
-                # Tables
-                if self._is_table(shape):
-                    html_table = "<html><body><table>"
-                    first_row = True
-                    for row in shape.table.rows:
-                        html_table += "<tr>"
-                        for cell in row.cells:
-                            if first_row:
-                                html_table += "<th>" + html.escape(cell.text) + "</th>"
-                            else:
-                                html_table += "<td>" + html.escape(cell.text) + "</td>"
-                        html_table += "</tr>"
-                        first_row = False
-                    html_table += "</table></body></html>"
-                    md_content += "\n" + self._convert(html_table).text_content.strip() + "\n"
-
-                # Text areas
-                elif shape.has_text_frame:
-                    if shape == title:
-                        md_content += "# " + shape.text.lstrip() + " "
-                    else:
-                        md_content += shape.text + " "
-
-            md_content = md_content.strip()
-
-            if slide.has_notes_slide:
-                md_content += "\n\n### Notes:\n"
-                notes_frame = slide.notes_slide.notes_text_frame
-                if notes_frame is not None:
-                    md_content += notes_frame.text
-                md_content = md_content.strip()
+        presentation = _backend("pptx").Presentation(local_path)
+        num_slides = len(presentation.slides)
+        # `parallel_slides` forces the slide pool on or off, by default large decks use it when there are workers
+        parallel = kwargs.get("parallel_slides")
+        if parallel is None:
+            parallel = PPTX_WORKERS > 0 and num_slides >= self.parallel_min_slides
+        if parallel:
+            # One range of slides per worker and one for this process, which has the deck open already
+            parts = max(1, PPTX_WORKERS) + 1
+            bounds = [num_slides * i // parts for i in range(parts + 1)]
+            pool = _get_slide_pool()
+            futures = [pool.submit(_pptx_slides, local_path, bounds[i], bounds[i + 1]) for i in range(1, parts)]
+            slides = _pptx_slides(local_path, bounds[0], bounds[1], presentation)
+            for future in futures:
+                slides.extend(future.result())
+        else:
+            slides = _pptx_slides(local_path, 0, num_slides, presentation)
 
         return DocumentConverterResult(
             title=None,
-            text_content=md_content.strip(),
+            text_content="\n\n".join(slides).strip(),
         )
 
+    def _slide_markdown(self, slide, slide_num: int) -> str:
+        md_content = [f"<!-- Slide number: {slide_num} -->\n"]
+
+        title = slide.shapes.title
+        for shape in slide.shapes:
+            # Pictures
+            if self._is_picture(shape):
+                # https://github.com/scanny/python-pptx/pull/512#issuecomment-1713100069
+                alt_text = ""
+                try:
+                    alt_text = shape._element._nvXxPr.cNvPr.attrib.get("descr", "")
+                except:
+                    pass
+
+                # A placeholder name
+                filename = re.sub(r"\W", "", shape.name) + ".jpg"
+                md_content.append("\n![" + (alt_text if alt_text else shape.name) + "](" + filename + ")\n")
+
+            # Tables, written straight to Markdown with the first row as the header
+            if self._is_table(shape):
+                rows = [[cell.text for cell in row.cells] for row in shape.table.rows]
+                md_content.append("\n" + markdown_table(rows) + "\n")
+
+            # Text areas
+            elif shape.has_text_frame:
+                if shape == title:
+                    md_content.append("# " + shape.text.lstrip() + " ")
+                else:
+                    md_content.append(shape.text + " ")
+
+        text = "".join(md_content).rstrip()
+
+        if slide.has_notes_slide:
+            notes_frame = slide.notes_slide.notes_text_frame
+            notes = notes_frame.text if notes_frame is not None else ""
+            text = (text + "\n\n### Notes:\n" + notes).rstrip()
+        return text
+
     def _is_picture(self, shape):
-        if shape.shape_type == pptx.enum.shapes.MSO_SHAPE_TYPE.PICTURE:
+        if shape.shape_type == _backend("pptx.enum.shapes").MSO_SHAPE_TYPE.PICTURE:
             return True
-        if shape.shape_type == pptx.enum.shapes.MSO_SHAPE_TYPE.PLACEHOLDER:
+        if shape.shape_type == _backend("pptx.enum.shapes").MSO_SHAPE_TYPE.PLACEHOLDER:
             if hasattr(shape, "image"):
                 return True
         return False
 
     def _is_table(self, shape):
-        if shape.shape_type == pptx.enum.shapes.MSO_SHAPE_TYPE.TABLE:
+        if shape.shape_type == _backend("pptx.enum.shapes").MSO_SHAPE_TYPE.TABLE:
             return True
         return False
 
-import whisper
-import joblib
-# cache asr function
-asr_cache = joblib.Memory(location=".cache/asr", verbose=0)
+@functools.lru_cache(maxsize=None)
+def _cached_asr():
+    # The whisper model lives in the shared ASR service, see utils/model_services.py
+    from .model_services import transcribe
+
+    # cache asr function
+    asr_cache = _backend("joblib").Memory(location=".cache/asr", verbose=0)
+    return asr_cache.cache(transcribe)
 
-@asr_cache.cache
 def asr(local_path):
-    whisper_model = whisper.load_model("large")
-    return whisper_model.transcribe(local_path)['text']
+    return _cached_asr()(local_path)
 
 class WavConverter(DocumentConverter):
+    extensions = (".wav",)
+
     def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
         # Bail if not a XLSX
         extension = kwargs.get("file_extension", "")
@@ -457,6 +739,8 @@ class WavConverter(DocumentConverter):
 
 
 class Mp3Converter(WavConverter):
+    extensions = (".mp3",)
+
     def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
         # Bail if not a MP3
         extension = kwargs.get("file_extension", "")
@@ -491,6 +775,9 @@ class Mp3Converter(WavConverter):
 
 
 class ImageConverter(DocumentConverter):
+    cache_kwargs = ("file_extension", "ocr_min_confidence", "mlm_client", "mlm_prompt")
+    extensions = (".jpg", ".jpeg", ".png")
+
     def convert(self, local_path, **kwargs) -> Union[None, DocumentConverterResult]:
         # Bail if not a XLSX
         extension = kwargs.get("file_extension", "")
@@ -526,19 +813,17 @@ class ImageConverter(DocumentConverter):
                 + "\n"
             )
 
-        image = PIL.Image.open(local_path)
-        # Remove transparency
-        if image.mode in ("RGBA", "P"):
-            image = image.convert("RGB")
+        # The OCR model lives in the shared OCR service, see utils/model_services.py
+        from .model_services import ocr_image
 
-        reader = easyocr.Reader(["en"])  # specify the language(s)
-        output = reader.readtext(np.array(image))  # local_path)
-        # The output is a list of tuples, each containing the coordinates of the text and the text itself.
+        with open(local_path, "rb") as fh:
+            output = ocr_image(fh.read())
+        # The output is a list of (text, confidence) tuples.
         # We join all the text pieces together to get the final text.
         ocr_text = " "
-        for item in output:
-            if item[2] >= ocr_min_confidence:
-                ocr_text += item[1] + " "
+        for text, confidence in output:
+            if confidence >= ocr_min_confidence:
+                ocr_text += text + " "
         ocr_text = ocr_text.strip()
 
         if len(ocr_text) > 0:
@@ -606,15 +891,20 @@ class MarkdownConverter:
         self,
         requests_session: Optional[requests.Session] = None,
         mlm_client: Optional[Any] = None,
+        conversion_cache: Optional[ConversionCache] = None,
     ):
         if requests_session is None:
-            self._requests_session = requests.Session()
+            self._requests_session = get_session()
         else:
             self._requests_session = requests_session
 
         self._mlm_client = mlm_client
+        self._conversion_cache = conversion_cache if conversion_cache is not None else get_conversion_cache()
 
         self._page_converters: List[DocumentConverter] = []
+        # Lowercase extension -> converters for it, in priority order. Converters for any
+        # extension are listed under None
+        self._dispatch: Dict[Optional[str], List[DocumentConverter]] = {}
 
         # Register converters for successful browsing operations
         # Later registrations are tried first / take higher priority than earlier registrations
@@ -625,6 +915,7 @@ class MarkdownConverter:
         self.register_page_converter(YouTubeConverter())
         self.register_page_converter(DocxConverter())
         self.register_page_converter(XlsxConverter())
+        self.register_page_converter(CsvConverter())
         self.register_page_converter(PptxConverter())
         self.register_page_converter(WavConverter())
         self.register_page_converter(Mp3Converter())
@@ -694,53 +985,81 @@ class MarkdownConverter:
 
         # Save the file locally to a temporary file. It will be deleted before this method exits
         handle, temp_path = tempfile.mkstemp()
-        fh = os.fdopen(handle, "wb")
+        os.close(handle)
         result = None
         try:
-            # Download the file
-            for chunk in response.iter_content(chunk_size=512):
-                fh.write(chunk)
-            fh.close()
+            # Download the file, hashing it on the way for the conversion cache
+            sha256, _ = stream_to_file(response, temp_path)
 
             # Use puremagic to check for more extension options
             self._append_ext(extensions, self._guess_ext_magic(temp_path))
 
             # Convert
-            result = self._convert(temp_path, extensions, url=response.url)
+            result = self._convert(temp_path, extensions, url=response.url, file_sha256=sha256)
 
         # Clean up
         finally:
             try:
-                fh.close()
-            except:
+                os.unlink(temp_path)
+            except OSError:
                 pass
-            os.unlink(temp_path)
 
         return result
 
     def _convert(self, local_path, extensions, **kwargs):
         print(f'_convert: {local_path}, {extensions}, {kwargs}')
         error_trace = ""
+        # The file is hashed once (or while it was downloaded), every converter's cache entry is keyed on it
+        sha256 = kwargs.pop("file_sha256", None)
+        if sha256 is None:
+            try:
+                sha256 = file_sha256(local_path)
+            except OSError:
+                sha256 = None
+        # Every HTML-family converter reuses the same parse tree
+        document = ParsedDocument(local_path)
+        url = kwargs.get("url") or ""
+        with _conversion_stats_lock:
+            CONVERSION_STATS["documents"] += 1
         for ext in extensions:
-            for converter in self._page_converters:
-                _kwargs = copy.deepcopy(kwargs)
+            for converter in self._candidates(ext, url):
+                _kwargs = dict(kwargs)
                 _kwargs.update({"file_extension": ext})
 
                 # Copy any additional global options
                 if "mlm_client" not in _kwargs and self._mlm_client is not None:
                     _kwargs["mlm_client"] = self._mlm_client
 
+                cache_key = None
+                if sha256 is not None:
+                    cache_key = self._conversion_cache.key(sha256, converter, _kwargs)
+                    cached = self._conversion_cache.get(cache_key)
+                    if cached is not None:
+                        self._conversion_cache.record(hit=True, saved_seconds=cached["seconds"])
+                        return DocumentConverterResult(title=cached["title"], text_content=cached["text_content"])
+
                 # If we hit an error log it and keep trying
                 res = None
+                start = time.perf_counter()
+                _kwargs["document"] = document
+                if sha256 is not None:
+                    _kwargs["file_sha256"] = sha256
                 try:
                     res = converter.convert(local_path, **_kwargs)
+                    outcome = "declined" if res is None else "converted"
                 except Exception as e:
                     error_trace = ("\n\n" + traceback.format_exc()).strip()
+                    outcome = "errors"
+                _record_attempt(converter, outcome, time.perf_counter() - start)
 
                 if res is not None:
                     # Normalize the content
-                    res.text_content = "\n".join([line.rstrip() for line in re.split(r"\r?\n", res.text_content)])
-                    res.text_content = re.sub(r"\n{3,}", "\n\n", res.text_content)
+                    res.text_content = normalize_text(res.text_content)
+
+                    # A document still being extracted is cached page by page instead
+                    if cache_key is not None and not isinstance(res, StreamingConverterResult):
+                        self._conversion_cache.record(hit=False)
+                        self._conversion_cache.put(cache_key, res.title, res.text_content, time.perf_counter() - start)
 
                     # Todo
                     return res
@@ -763,8 +1082,7 @@ class MarkdownConverter:
         ext = ext.strip()
         if ext == "":
             return
-        # if ext not in extensions:
-        if True:
+        if ext.lower() not in [e.lower() for e in extensions]:
             extensions.append(ext)
 
     def _guess_ext_magic(self, path):
@@ -789,3 +1107,17 @@ class MarkdownConverter:
     def register_page_converter(self, converter: DocumentConverter) -> None:
         """Register a page text converter."""
         self._page_converters.insert(0, converter)
+        for ext in converter.extensions if converter.extensions is not None else [None]:
+            self._dispatch.setdefault(ext, []).insert(0, converter)
+
+    def _candidates(self, ext: str, url: str) -> List[DocumentConverter]:
+        """The converters to try for one extension, in priority order."""
+        specific = self._dispatch.get(ext.lower(), [])
+        generic = self._dispatch.get(None, [])
+        if len(generic) > 0 and len(specific) > 0:
+            # Merge back into registration order
+            order = {id(c): i for i, c in enumerate(self._page_converters)}
+            candidates = sorted(specific + generic, key=lambda c: order[id(c)])
+        else:
+            candidates = specific or generic
+        return [c for c in candidates if c.url_pattern is None or re.search(c.url_pattern, url)]
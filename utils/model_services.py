@@ -0,0 +1,238 @@
+"""Long-lived model services shared by every Sibyl actor.
+
+Heavy models (Whisper, EasyOCR) are loaded once inside a named Ray actor and kept resident.
+Converters call the module level helpers, which talk to the shared actor when Ray is
+running and fall back to a per-process model otherwise.
+"""
+import asyncio
+import functools
+import hashlib
+import io
+import os
+import time
+from typing import Any, Dict, List, Tuple, Union
+
+import diskcache as dc
+import ray
+
+ASR_SERVICE_NAME = "sibyl_whisper_asr"
+ASR_MODEL = "large"
+OCR_SERVICE_NAME = "sibyl_easyocr"
+OCR_LANGUAGES = ("en",)
+# Larger images are downscaled before detection, text stays legible well below this
+OCR_MAX_IMAGE_SIDE = 2560
+# How long a converter waits on a shared service, the queue and the first model load included
+ASR_TIMEOUT = 1800.0
+OCR_TIMEOUT = 600.0
+
+
+class ModelServiceError(Exception):
+    """A shared model service did not answer in time, the converter fails instead of hanging."""
+
+
+def _get_result(ref: "ray.ObjectRef", timeout: float, what: str) -> Any:
+    try:
+        return ray.get(ref, timeout=timeout)
+    except ray.exceptions.GetTimeoutError:
+        ray.cancel(ref)
+        raise ModelServiceError(f"{what} did not finish within {timeout:.0f}s")
+
+
+class _BatchingService:
+    """Queue requests from many callers and hand them to `_process_batch` in batches."""
+
+    def __init__(self, max_batch_size: int = 8):
+        self.max_batch_size = max_batch_size
+        self.load_time: Union[float, None] = None
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_failed_batches = 0
+        self.busy_time = 0.0
+        self._queue: Union[asyncio.Queue, None] = None
+        self._worker: Union[asyncio.Task, None] = None
+
+    async def _submit(self, request: Any) -> Any:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self.num_requests += 1
+        await self._queue.put((request, future))
+        return await future
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            start = time.time()
+            try:
+                # The model call is blocking, keep the event loop free to accept new requests
+                results = await asyncio.to_thread(self._process_batch, [request for request, _ in batch])
+            except Exception as e:
+                # A failed model import or load fails this batch, the next batch tries again
+                print(f"{type(self).__name__} batch of {len(batch)} failed: {e}")
+                self.num_failed_batches += 1
+                results = [e] * len(batch)
+            self.busy_time += time.time() - start
+            self.num_batches += 1
+
+            for (_, future), result in zip(batch, results):
+                # The caller may have been cancelled meanwhile
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _process_batch(self, requests: List[Any]) -> List[Any]:
+        raise NotImplementedError()
+
+    async def stats(self) -> Dict[str, Any]:
+        return {
+            "load_time": self.load_time,
+            "queue_depth": 0 if self._queue is None else self._queue.qsize(),
+            "requests": self.num_requests,
+            "batches": self.num_batches,
+            "failed_batches": self.num_failed_batches,
+            "busy_time": self.busy_time,
+        }
+
+
+@ray.remote
+class WhisperASRService(_BatchingService):
+    """Whisper model loaded once and shared by all agents."""
+
+    def __init__(self, model_name: str = ASR_MODEL, max_batch_size: int = 8):
+        super().__init__(max_batch_size=max_batch_size)
+        self.model_name = model_name
+        self._model = None
+
+    async def transcribe(self, local_path: str) -> str:
+        return await self._submit(local_path)
+
+    def _process_batch(self, requests: List[str]) -> List[Union[str, Exception]]:
+        if self._model is None:
+            # Loaded on the first request so runs without audio never pay for it
+            import whisper
+
+            start = time.time()
+            self._model = whisper.load_model(self.model_name)
+            self.load_time = time.time() - start
+            print(f"Loaded whisper model '{self.model_name}' in {self.load_time:.1f}s")
+
+        # Whisper transcribes one file at a time; the batch shares the resident model and
+        # identical paths queued by different agents are transcribed once
+        transcripts: Dict[str, Union[str, Exception]] = {}
+        for local_path in requests:
+            if local_path in transcripts:
+                continue
+            try:
+                transcripts[local_path] = self._model.transcribe(local_path)["text"]
+            except Exception as e:
+                transcripts[local_path] = e
+        return [transcripts[local_path] for local_path in requests]
+
+
+def get_asr_service(**options):
+    """Return the shared ASR actor, creating it on first use."""
+    return WhisperASRService.options(name=ASR_SERVICE_NAME, get_if_exists=True, **options).remote()
+
+
+@ray.remote
+class EasyOCRService(_BatchingService):
+    """EasyOCR reader constructed once and shared by all agents."""
+
+    def __init__(self, languages: Tuple[str, ...] = OCR_LANGUAGES, max_image_side: int = OCR_MAX_IMAGE_SIDE, max_batch_size: int = 8):
+        super().__init__(max_batch_size=max_batch_size)
+        self.languages = list(languages)
+        self.max_image_side = max_image_side
+        self._reader = None
+
+    async def readtext(self, image_bytes: bytes, content_hash: str) -> List[Tuple[str, float]]:
+        return await self._submit((image_bytes, content_hash))
+
+    def _process_batch(self, requests: List[Tuple[bytes, str]]) -> List[Union[List[Tuple[str, float]], Exception]]:
+        if self._reader is None:
+            import easyocr
+
+            start = time.time()
+            self._reader = easyocr.Reader(self.languages)
+            self.load_time = time.time() - start
+            print(f"Loaded easyocr reader {self.languages} in {self.load_time:.1f}s")
+
+        results: Dict[str, Union[List[Tuple[str, float]], Exception]] = {}
+        for image_bytes, content_hash in requests:
+            if content_hash in results:
+                continue
+            try:
+                results[content_hash] = _readtext(self._reader, image_bytes, self.max_image_side)
+                _ocr_cache().set(content_hash, results[content_hash])
+            except Exception as e:
+                results[content_hash] = e
+        return [results[content_hash] for _, content_hash in requests]
+
+
+def get_ocr_service(**options):
+    """Return the shared OCR actor, creating it on first use."""
+    return EasyOCRService.options(name=OCR_SERVICE_NAME, get_if_exists=True, **options).remote()
+
+
+@functools.lru_cache(maxsize=None)
+def _ocr_cache() -> dc.Cache:
+    return dc.Cache(".cache/ocr")
+
+
+def _readtext(reader, image_bytes: bytes, max_image_side: int) -> List[Tuple[str, float]]:
+    import numpy as np
+    import PIL.Image
+
+    image = PIL.Image.open(io.BytesIO(image_bytes))
+    # Remove transparency
+    if image.mode in ("RGBA", "P"):
+        image = image.convert("RGB")
+    # Detection cost grows with the pixel count, shrink oversized images first
+    if max(image.size) > max_image_side:
+        image.thumbnail((max_image_side, max_image_side))
+
+    # readtext returns (bbox, text, confidence) tuples, only the text and confidence are kept
+    return [(item[1], float(item[2])) for item in reader.readtext(np.array(image))]
+
+
+@functools.lru_cache(maxsize=None)
+def _local_easyocr_reader(languages: Tuple[str, ...]):
+    import easyocr
+
+    return easyocr.Reader(list(languages))
+
+
+def ocr_image(image_bytes: bytes) -> List[Tuple[str, float]]:
+    """Return (text, confidence) pairs for an image, cached by content hash across actors and runs."""
+    content_hash = hashlib.sha256(image_bytes).hexdigest()
+    cached = _ocr_cache().get(content_hash)
+    if cached is not None:
+        return cached
+
+    if ray.is_initialized():
+        # The service only caches successful results
+        return _get_result(get_ocr_service().readtext.remote(image_bytes, content_hash), OCR_TIMEOUT, "OCR")
+
+    result = _readtext(_local_easyocr_reader(OCR_LANGUAGES), image_bytes, OCR_MAX_IMAGE_SIDE)
+    _ocr_cache().set(content_hash, result)
+    return result
+
+
+@functools.lru_cache(maxsize=None)
+def _local_whisper_model(model_name: str):
+    import whisper
+
+    return whisper.load_model(model_name)
+
+
+def transcribe(local_path: str) -> str:
+    """Transcribe an audio file with the shared ASR service, or a process-wide model outside of Ray."""
+    if ray.is_initialized():
+        return _get_result(get_asr_service().transcribe.remote(os.path.abspath(local_path)), ASR_TIMEOUT, f"Transcribing {local_path}")
+    return _local_whisper_model(ASR_MODEL).transcribe(local_path)["text"]
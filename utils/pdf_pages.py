@@ -0,0 +1,308 @@
+"""Page-parallel PDF text extraction, handed to the browser as the pages come in.
+
+`pdfminer.high_level.extract_text` lays out one page at a time and writes a form feed
+after each, so the text of a document is the concatenation of the text of its pages.
+`PdfExtractor` splits a document into a small first chunk and then larger chunks,
+extracts them in a process pool, and caches the text of every page on disk by the file's
+sha256. A `PdfPages` holds the pages extracted so far: the PDF converter returns as soon
+as the first chunk is in, and the browser appends the rest as the agent pages down or
+searches. Chunks wait in a priority queue and the pool only ever holds one per worker, so
+the first chunk of a document opened by another question goes ahead of the tail chunks of
+a large PDF already being extracted. A chunk that fails in the pool is extracted again in this process, one page
+at a time. Pages that fail again get a placeholder saying so, the text never just ends
+early.
+"""
+import functools
+import heapq
+import io
+import itertools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import diskcache as dc
+
+# The first chunk is kept small, it is what the agent waits for
+PDF_FIRST_PAGES = 2
+PDF_CHUNK_PAGES = 8
+
+
+def count_pages(local_path: str) -> int:
+    from pdfminer.pdfpage import PDFPage
+
+    with open(local_path, "rb") as fp:
+        return sum(1 for _ in PDFPage.get_pages(fp))
+
+
+def extract_pages(local_path: str, page_numbers: Sequence[int]) -> List[str]:
+    """The text of some pages of a PDF, as extract_text would produce it. Runs in the pool's worker processes."""
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+    from pdfminer.pdfpage import PDFPage
+
+    texts = []
+    with open(local_path, "rb") as fp, io.StringIO() as output:
+        rsrcmgr = PDFResourceManager(caching=True)
+        device = TextConverter(rsrcmgr, output, codec="utf-8", laparams=LAParams())
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        start = 0
+        for page in PDFPage.get_pages(fp, set(page_numbers)):
+            interpreter.process_page(page)
+            texts.append(output.getvalue()[start:])
+            start = output.tell()
+    return texts
+
+
+def _contiguous_runs(page_numbers: Sequence[int]) -> List[List[int]]:
+    runs: List[List[int]] = []
+    for page in sorted(page_numbers):
+        if runs and runs[-1][-1] == page - 1:
+            runs[-1].append(page)
+        else:
+            runs.append([page])
+    return runs
+
+
+class PdfPages:
+    """The pages of one PDF, filled in by the extractor as its chunks complete."""
+
+    def __init__(self, num_pages: int):
+        self.num_pages = num_pages
+        self._texts: List[Optional[str]] = [None] * num_pages
+        # Pages 0 to _ready - 1 are all in, extracted or failed
+        self._ready = 0
+        self._cond = threading.Condition()
+        self._futures: List[Future] = []
+        self.cancelled = False
+        # The first extraction error, and the pages that hold a placeholder because of one
+        self.error: Optional[BaseException] = None
+        self.failed_pages = 0
+
+    def _fill(self, page_numbers: Sequence[int], texts: Sequence[str]) -> None:
+        with self._cond:
+            for page, text in zip(page_numbers, texts):
+                self._texts[page] = text
+            while self._ready < self.num_pages and self._texts[self._ready] is not None:
+                self._ready += 1
+            self._cond.notify_all()
+
+    def _fail(self, page_numbers: Sequence[int], error: BaseException) -> None:
+        """Fill pages that could not be extracted with a placeholder for each run of them."""
+        with self._cond:
+            if self.error is None:
+                self.error = error
+            self.failed_pages += len(page_numbers)
+            for run in _contiguous_runs(page_numbers):
+                label = f"page {run[0] + 1}" if len(run) == 1 else f"pages {run[0] + 1}–{run[-1] + 1}"
+                # Ends with a form feed, like the text of every page
+                self._fill(run, [f"[{label} could not be extracted: {error}]\n\n\x0c"] + [""] * (len(run) - 1))
+
+    @property
+    def ready_pages(self) -> int:
+        with self._cond:
+            return self._ready
+
+    @property
+    def extracted_pages(self) -> int:
+        with self._cond:
+            return sum(1 for text in self._texts if text is not None) - self.failed_pages
+
+    @property
+    def complete(self) -> bool:
+        """True once every page is in, extracted or as a placeholder."""
+        with self._cond:
+            return self._ready == self.num_pages
+
+    def text(self) -> str:
+        """The text of the pages in so far, up to the first page still missing."""
+        with self._cond:
+            return "".join(self._texts[: self._ready])  # type: ignore[arg-type]
+
+    def wait(self, pages: int, timeout: Optional[float] = None) -> bool:
+        """Wait until the first `pages` pages are in. Returns False on timeout."""
+        pages = min(pages, self.num_pages)
+        with self._cond:
+            return self._cond.wait_for(lambda: self._ready >= pages, timeout)
+
+    def cancel(self) -> None:
+        """Drop the chunks that have not started, when nobody reads the document anymore.
+
+        Chunks still in the extractor's queue are dropped when their turn comes."""
+        self.cancelled = True
+        for future in self._futures:
+            future.cancel()
+
+
+class PdfExtractor:
+    """Process pool and per-page cache for PDF extraction, shared by every browser of the process."""
+
+    def __init__(
+        self,
+        directory: str = ".cache/pdf_pages",
+        size_limit: int = 2 * 1024 * 1024 * 1024,
+        max_workers: Optional[int] = None,
+        first_pages: int = PDF_FIRST_PAGES,
+        chunk_pages: int = PDF_CHUNK_PAGES,
+    ):
+        self.cache = dc.Cache(directory, size_limit=size_limit, eviction_policy="least-recently-used")
+        self.max_workers = max_workers if max_workers is not None else max(1, min(4, (os.cpu_count() or 2) // 2))
+        self.first_pages = first_pages
+        self.chunk_pages = chunk_pages
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Failed chunks are extracted again here, one at a time
+        self._retry_executor: Optional[ThreadPoolExecutor] = None
+        # (priority, order, pages, local_path, sha256, chunk) of the chunks not handed to the pool yet,
+        # first chunks have priority 0 and tail chunks 1
+        self._queue: List[Tuple[int, int, PdfPages, str, str, List[int]]] = []
+        self._order = itertools.count()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.counts = {
+            "documents": 0,
+            "pages_extracted": 0,
+            "pages_cached": 0,
+            "failures": 0,
+            "pages_retried": 0,
+            "pages_failed": 0,
+        }
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # Forking a process that runs threads (Ray actors, the tool executor) is unsafe
+                self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            return self._executor
+
+    def _retries(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._retry_executor is None:
+                self._retry_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-retry")
+            return self._retry_executor
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counts[name] += amount
+
+    @staticmethod
+    def _key(sha256: str, page: int) -> str:
+        from pdfminer import __version__ as pdfminer_version
+
+        return f"{sha256}:{page}:{pdfminer_version}"
+
+    def extract(self, local_path: str, sha256: str) -> PdfPages:
+        """Start extracting a PDF, cached pages are filled in right away."""
+        pages = PdfPages(count_pages(local_path))
+        self._count("documents")
+
+        missing = []
+        for page in range(pages.num_pages):
+            text = self.cache.get(self._key(sha256, page))
+            if text is None:
+                missing.append(page)
+            else:
+                pages._fill([page], [text])
+        self._count("pages_cached", pages.num_pages - len(missing))
+
+        chunks = [missing[: self.first_pages]] if len(missing) > 0 else []
+        for start in range(self.first_pages, len(missing), self.chunk_pages):
+            chunks.append(missing[start : start + self.chunk_pages])
+        with self._lock:
+            for i, chunk in enumerate(chunks):
+                heapq.heappush(self._queue, (0 if i == 0 else 1, next(self._order), pages, local_path, sha256, chunk))
+        self._dispatch()
+        return pages
+
+    def _dispatch(self) -> None:
+        """Hand queued chunks to the pool while it has an idle worker."""
+        pool = self._pool()
+        while True:
+            with self._lock:
+                if self._in_flight >= self.max_workers or len(self._queue) == 0:
+                    return
+                _, _, pages, local_path, sha256, chunk = heapq.heappop(self._queue)
+                if pages.cancelled:
+                    continue
+                self._in_flight += 1
+            try:
+                future = pool.submit(extract_pages, local_path, chunk)
+            except RuntimeError:
+                # The pool shut down with the interpreter
+                with self._lock:
+                    self._in_flight -= 1
+                return
+            pages._futures.append(future)
+            future.add_done_callback(functools.partial(self._finished, pages, local_path, sha256, chunk))
+
+    def _finished(self, pages: PdfPages, local_path: str, sha256: str, chunk: List[int], future: Future) -> None:
+        with self._lock:
+            self._in_flight -= 1
+        try:
+            self._done(pages, local_path, sha256, chunk, future)
+        finally:
+            self._dispatch()
+
+    def _done(self, pages: PdfPages, local_path: str, sha256: str, chunk: List[int], future: Future) -> None:
+        if future.cancelled():
+            return
+        try:
+            texts = future.result()
+            if len(texts) != len(chunk):
+                raise ValueError(f"Expected {len(chunk)} pages from the PDF, got {len(texts)}")
+        except Exception as e:
+            self._count("failures")
+            print(f"Extracting pages {chunk[0] + 1}-{chunk[-1] + 1} of a PDF failed: {e}, retrying them in this process")
+            # Not in this callback, it runs on the thread that collects the pool's results
+            self._retries().submit(self._retry, pages, local_path, sha256, chunk)
+            return
+        self._store(pages, sha256, chunk, texts)
+
+    def _retry(self, pages: PdfPages, local_path: str, sha256: str, chunk: List[int]) -> None:
+        """Extract the pages of a failed chunk one by one, with a placeholder for those that fail again."""
+        failed: List[int] = []
+        error: Optional[BaseException] = None
+        for page in chunk:
+            if pages.cancelled:
+                return
+            self._count("pages_retried")
+            try:
+                texts = extract_pages(local_path, [page])
+                if len(texts) != 1:
+                    raise ValueError(f"Expected 1 page from the PDF, got {len(texts)}")
+            except Exception as e:
+                failed.append(page)
+                error = e
+                continue
+            self._store(pages, sha256, [page], texts)
+        if len(failed) > 0:
+            print(f"Giving up on {len(failed)} pages of a PDF: {error}")
+            self._count("pages_failed", len(failed))
+            pages._fail(failed, error)  # type: ignore[arg-type]
+
+    def _store(self, pages: PdfPages, sha256: str, chunk: List[int], texts: List[str]) -> None:
+        try:
+            for page, text in zip(chunk, texts):
+                self.cache.set(self._key(sha256, page), text)
+        except dc.Timeout as e:
+            print(f"Ignoring error: {e} when caching PDF pages")
+        self._count("pages_extracted", len(texts))
+        pages._fill(chunk, texts)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {**self.counts, "queued_chunks": len(self._queue), "chunks_in_flight": self._in_flight}
+
+
+_shared_extractor: Optional[PdfExtractor] = None
+_shared_extractor_lock = threading.Lock()
+
+
+def get_pdf_extractor(**kwargs: Any) -> PdfExtractor:
+    """Return the extractor shared by everything in this process, creating it with `kwargs` on first use."""
+    global _shared_extractor
+    with _shared_extractor_lock:
+        if _shared_extractor is None:
+            _shared_extractor = PdfExtractor(**kwargs)
+        return _shared_extractor
@@ -0,0 +1,137 @@
+"""Speculative fetching and conversion of the pages a search just returned.
+
+The agent usually visits one of the top search results on its next step, after a
+summarize and a choose_tool round trip. The browser hands the top-k result URLs to the
+prefetcher, which fetches and converts them in a small thread pool while those LLM calls
+run. `visit_page` then picks up the finished (or still running) conversion instead of
+starting from scratch. Pages are only prefetched when they are text and under
+`max_bytes`, and entries that are not visited within `ttl` seconds are dropped.
+"""
+import io
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import urllib3
+
+
+class PrefetchTooLarge(Exception):
+    pass
+
+
+class LimitedReader(io.RawIOBase):
+    """Response.raw wrapper that stops reading once more than `max_bytes` were decoded."""
+
+    def __init__(self, raw: Any, max_bytes: int):
+        self._raw = raw
+        self.max_bytes = max_bytes
+        self.total = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        if isinstance(self._raw, urllib3.response.HTTPResponse):
+            data = self._raw.read(None if size < 0 else size, decode_content=True)
+        else:
+            data = self._raw.read(size)
+        self.total += len(data)
+        if self.total > self.max_bytes:
+            raise PrefetchTooLarge(f"More than {self.max_bytes} bytes")
+        return data
+
+
+class Prefetcher:
+    """Bounded background pool of page conversions, keyed by URL."""
+
+    def __init__(self, max_workers: int = 4, max_entries: int = 64, ttl: float = 300.0, max_bytes: int = 8 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        # url -> (future of (title, text_content), submitted at)
+        self._entries: "OrderedDict[str, Tuple[Future, float]]" = OrderedDict()
+        self.counts = {"submitted": 0, "used": 0, "expired": 0, "failed": 0, "skipped": 0, "visits": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counts[name] += 1
+
+    def _expire(self, now: float) -> None:
+        # Called with the lock held
+        while len(self._entries) > 0:
+            url, (_, submitted_at) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - submitted_at < self.ttl:
+                break
+            future, _ = self._entries.pop(url)
+            future.cancel()
+            self.counts["expired"] += 1
+
+    def submit(self, url: str, fetch: Callable[[str], Optional[Tuple[Optional[str], str]]]) -> None:
+        """Start `fetch(url)` in the background unless the URL is already prefetched.
+
+        `fetch` returns (title, text_content), or None when the page should not be prefetched.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if url in self._entries:
+                return
+            self._entries[url] = (self._executor.submit(self._run, fetch, url), now)
+            self.counts["submitted"] += 1
+
+    def _run(self, fetch: Callable[[str], Optional[Tuple[Optional[str], str]]], url: str):
+        try:
+            result = fetch(url)
+        except Exception as e:
+            self._count("failed")
+            print(f"Prefetch of {url} failed: {e}")
+            return None
+        if result is None:
+            self._count("skipped")
+        return result
+
+    def take(self, url: str, timeout: Optional[float] = None) -> Optional[Tuple[Optional[str], str]]:
+        """Return the prefetched (title, text_content) of `url`, waiting for it if it is still running."""
+        with self._lock:
+            self.counts["visits"] += 1
+            self._expire(time.monotonic())
+            entry = self._entries.pop(url, None)
+        if entry is None:
+            return None
+        try:
+            result = entry[0].result(timeout=timeout)
+        except Exception:
+            return None
+        if result is not None:
+            self._count("used")
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counts = dict(self.counts)
+            pending = len(self._entries)
+        return {
+            **counts,
+            "pending": pending,
+            # Share of prefetches the agent went on to visit, tune k with this
+            "hit_rate": counts["used"] / counts["submitted"] if counts["submitted"] else 0.0,
+            # Share of page visits answered by a prefetch
+            "visit_hit_rate": counts["used"] / counts["visits"] if counts["visits"] else 0.0,
+        }
+
+
+_shared_prefetcher: Optional[Prefetcher] = None
+_shared_prefetcher_lock = threading.Lock()
+
+
+def get_prefetcher(**kwargs: Any) -> Prefetcher:
+    """Return the prefetcher shared by everything in this process, creating it with `kwargs` on first use."""
+    global _shared_prefetcher
+    with _shared_prefetcher_lock:
+        if _shared_prefetcher is None:
+            _shared_prefetcher = Prefetcher(**kwargs)
+        return _shared_prefetcher
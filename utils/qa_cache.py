@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def hash_prompts(*templates: str) -> str:
+    """Fingerprint the prompt templates so that editing a prompt invalidates cached answers."""
+    digest = hashlib.sha256()
+    for template in templates:
+        digest.update(template.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+class QACache:
+    """Final answer cache shared by all actors through one sqlite file.
+
+    Each actor keeps a single connection in WAL mode, so readers never wait on writers.
+    Inserts are buffered and written in one transaction every `flush_every` answers or
+    `flush_interval` seconds, and on `flush()`.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        model: str,
+        prompt_hash: str,
+        flush_every: int = 8,
+        flush_interval: float = 30.0,
+    ):
+        self.model = model
+        self.prompt_hash = prompt_hash
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS qa_answers
+            (key TEXT PRIMARY KEY NOT NULL,
+            model TEXT NOT NULL,
+            prompt_hash TEXT NOT NULL,
+            question TEXT NOT NULL,
+            attachment TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            created_at REAL NOT NULL);"""
+        )
+        self._db.commit()
+
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Tuple[str, str, str, str, str, str, float]] = {}
+        self._last_flush = time.time()
+
+        self.hits = 0
+        self.misses = 0
+        self.lookup_time = 0.0
+        self.writes = 0
+        self.flushes = 0
+
+    def key(self, question: str, attachment: Optional[str] = None) -> str:
+        raw = json.dumps([self.model, self.prompt_hash, question, attachment or ""])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, question: str, attachment: Optional[str] = None) -> Optional[str]:
+        start = time.perf_counter()
+        key = self.key(question, attachment)
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                answer = pending[5]
+            else:
+                row = self._db.execute("SELECT answer FROM qa_answers WHERE key = ?", (key,)).fetchone()
+                answer = None if row is None else row[0]
+
+            self.lookup_time += time.perf_counter() - start
+            if answer is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return answer
+
+    def put(self, question: str, attachment: Optional[str], answer: str) -> None:
+        key = self.key(question, attachment)
+        with self._lock:
+            self._pending[key] = (key, self.model, self.prompt_hash, question, attachment or "", answer, time.time())
+            due = len(self._pending) >= self.flush_every or time.time() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write all buffered answers in a single transaction."""
+        with self._lock:
+            rows: List[Tuple[Any, ...]] = list(self._pending.values())
+            self._last_flush = time.time()
+            if len(rows) == 0:
+                return
+            try:
+                with self._db:
+                    self._db.executemany("INSERT OR REPLACE INTO qa_answers VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            except sqlite3.Error as e:
+                # Keep the answers buffered, the next flush will retry them
+                print(f"Ignoring error: {e} when flushing {len(rows)} cached answers")
+                return
+            self._pending.clear()
+            self.writes += len(rows)
+            self.flushes += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "avg_lookup_ms": 1000 * self.lookup_time / lookups if lookups else 0.0,
+            "writes": self.writes,
+            "flushes": self.flushes,
+            "pending": len(self._pending),
+        }
+
+    def close(self) -> None:
+        self.flush()
+        self._db.close()
@@ -0,0 +1,244 @@
+"""Cluster-wide rate limiting for LLM calls.
+
+A single named Ray actor holds request and token buckets for the whole actor pool. Every
+HTTP request to the LLM provider, from langchain chains and autogen agents alike, asks the
+limiter for a slot before it is sent, so the pool stays just under the provider limits
+instead of every actor backing off on its own after a wave of 429s.
+"""
+import asyncio
+import contextlib
+import contextvars
+import email.utils
+import heapq
+import json
+import time
+from typing import Any, Dict, List, Tuple, Union
+
+import httpx
+import ray
+
+RATE_LIMITER_NAME = "sibyl_llm_rate_limiter"
+
+# Lower values are served first when requests are queued
+STAGE_PRIORITIES = {
+    "choose_tool": 0,
+    "improve_code": 1,
+    "summarize": 2,
+    "answer": 3,
+    "format_answer": 4,
+}
+DEFAULT_STAGE = "answer"
+
+# Completion budget assumed for requests that do not set max_tokens
+DEFAULT_COMPLETION_TOKENS = 1024
+
+_current_stage: contextvars.ContextVar[str] = contextvars.ContextVar("llm_stage", default=DEFAULT_STAGE)
+
+
+@contextlib.contextmanager
+def llm_stage(stage: str):
+    """Tag the LLM requests made inside the block with a pipeline stage."""
+    token = _current_stage.set(stage)
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+
+@ray.remote
+class LLMRateLimiter:
+    """Requests-per-minute and tokens-per-minute buckets shared by every agent."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+
+        self._waiting: List[Tuple[int, int, int, asyncio.Future, float, str]] = []
+        self._seq = 0
+        self._wakeup: Union[asyncio.Event, None] = None
+        self._dispatcher: Union[asyncio.Task, None] = None
+
+        self.num_throttled = 0
+        self.wait_stats: Dict[str, Dict[str, float]] = {}
+
+    async def acquire(self, stage: str, tokens: int) -> float:
+        """Wait for a request slot and `tokens` of budget. Returns the time spent queued."""
+        loop = asyncio.get_running_loop()
+        if self._dispatcher is None:
+            self._wakeup = asyncio.Event()
+            self._dispatcher = loop.create_task(self._dispatch())
+
+        future = loop.create_future()
+        self._seq += 1
+        priority = STAGE_PRIORITIES.get(stage, len(STAGE_PRIORITIES))
+        heapq.heappush(self._waiting, (priority, self._seq, tokens, future, time.monotonic(), stage))
+        self._wakeup.set()
+        return await future
+
+    def report(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Correct the token bucket once the real usage of a request is known."""
+        self._available_tokens = min(
+            float(self.tokens_per_minute), self._available_tokens + estimated_tokens - actual_tokens
+        )
+
+    def throttled(self, retry_after: float) -> None:
+        """The provider answered 429, hold every request until it asks us to retry."""
+        self.num_throttled += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._available_requests = min(
+            float(self.requests_per_minute), self._available_requests + elapsed * self.requests_per_minute / 60
+        )
+        self._available_tokens = min(
+            float(self.tokens_per_minute), self._available_tokens + elapsed * self.tokens_per_minute / 60
+        )
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wakeup.clear()
+            self._refill()
+            delay = None
+            while len(self._waiting) > 0:
+                _, _, tokens, future, enqueued_at, stage = self._waiting[0]
+                # A request larger than the whole budget goes through once the bucket is full
+                tokens = min(tokens, self.tokens_per_minute)
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                    break
+                if self._available_requests < 1 or self._available_tokens < tokens:
+                    missing_requests = max(0.0, 1 - self._available_requests) * 60 / self.requests_per_minute
+                    missing_tokens = max(0.0, tokens - self._available_tokens) * 60 / self.tokens_per_minute
+                    delay = max(missing_requests, missing_tokens, 0.01)
+                    break
+
+                heapq.heappop(self._waiting)
+                self._available_requests -= 1
+                self._available_tokens -= tokens
+                waited = now - enqueued_at
+                stats = self.wait_stats.setdefault(stage, {"requests": 0, "total_wait": 0.0, "max_wait": 0.0})
+                stats["requests"] += 1
+                stats["total_wait"] += waited
+                stats["max_wait"] = max(stats["max_wait"], waited)
+                if not future.done():
+                    future.set_result(waited)
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stats(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            "queue_depth": len(self._waiting),
+            "available_requests": self._available_requests,
+            "available_tokens": self._available_tokens,
+            "throttled": self.num_throttled,
+            "wait": {
+                stage: {**stats, "avg_wait": stats["total_wait"] / stats["requests"]}
+                for stage, stats in self.wait_stats.items()
+            },
+        }
+
+
+def get_rate_limiter(requests_per_minute: int = 500, tokens_per_minute: int = 300000, **options):
+    """Return the shared rate limiter actor, creating it on first use."""
+    return LLMRateLimiter.options(name=RATE_LIMITER_NAME, get_if_exists=True, **options).remote(
+        requests_per_minute, tokens_per_minute
+    )
+
+
+def _estimate_tokens(request: httpx.Request) -> int:
+    # Roughly four bytes per token for the prompt, plus the completion budget
+    completion_tokens = DEFAULT_COMPLETION_TOKENS
+    try:
+        completion_tokens = json.loads(request.content).get("max_tokens") or completion_tokens
+    except Exception:
+        pass
+    return len(request.content) // 4 + completion_tokens
+
+
+def _retry_after(response: httpx.Response) -> float:
+    value = response.headers.get("retry-after")
+    if value is None:
+        return 1.0
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 1.0
+
+
+def _actual_tokens(body: bytes) -> Union[int, None]:
+    try:
+        return json.loads(body)["usage"]["total_tokens"]
+    except Exception:
+        return None
+
+
+class _SharedClientMixin:
+    # autogen deep-copies llm_config, every copy should keep sharing this client
+    def __deepcopy__(self, memo):
+        return self
+
+
+class _RateLimitedClient(_SharedClientMixin, httpx.Client):
+    pass
+
+
+class _RateLimitedAsyncClient(_SharedClientMixin, httpx.AsyncClient):
+    pass
+
+
+def rate_limited_http_clients(limiter, timeout: float = 600.0) -> Tuple[httpx.Client, httpx.AsyncClient]:
+    """Build sync and async httpx clients that wait for the shared limiter before every request.
+
+    Pass them to ChatOpenAI as `http_client` / `http_async_client`, or to autogen configs as
+    `http_client`. Requests are tagged with the stage set by `llm_stage`.
+    """
+
+    def on_request(request: httpx.Request) -> None:
+        tokens = _estimate_tokens(request)
+        request.extensions["sibyl_estimated_tokens"] = tokens
+        ray.get(limiter.acquire.remote(_current_stage.get(), tokens))
+
+    def on_response(response: httpx.Response) -> None:
+        if response.status_code == 429:
+            limiter.throttled.remote(_retry_after(response))
+        elif "text/event-stream" not in response.headers.get("content-type", ""):
+            actual = _actual_tokens(response.read())
+            if actual is not None:
+                limiter.report.remote(response.request.extensions["sibyl_estimated_tokens"], actual)
+
+    async def on_async_request(request: httpx.Request) -> None:
+        tokens = _estimate_tokens(request)
+        request.extensions["sibyl_estimated_tokens"] = tokens
+        await limiter.acquire.remote(_current_stage.get(), tokens)
+
+    async def on_async_response(response: httpx.Response) -> None:
+        if response.status_code == 429:
+            limiter.throttled.remote(_retry_after(response))
+        elif "text/event-stream" not in response.headers.get("content-type", ""):
+            actual = _actual_tokens(await response.aread())
+            if actual is not None:
+                limiter.report.remote(response.request.extensions["sibyl_estimated_tokens"], actual)
+
+    client = _RateLimitedClient(
+        timeout=timeout, event_hooks={"request": [on_request], "response": [on_response]}
+    )
+    async_client = _RateLimitedAsyncClient(
+        timeout=timeout, event_hooks={"request": [on_async_request], "response": [on_async_response]}
+    )
+    return client, async_client
@@ -0,0 +1,233 @@
+"""Retries, backoff and per-host circuit breaking for outgoing HTTP requests.
+
+PooledSession runs every request through `ResilientCaller.call`. Failed idempotent
+requests are retried with exponential backoff and full jitter, honoring Retry-After.
+Once a host fails `failure_threshold` times in a row, its circuit opens and requests
+to it fail immediately for `reset_timeout` seconds. After that a single trial request
+decides whether it closes again.
+"""
+import email.utils
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import requests
+
+# Statuses worth retrying, the server may answer differently a moment later
+RETRY_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+# Only requests that can be sent twice without side effects are retried
+RETRY_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+# Errors that count against the host besides timeouts and connection errors. Others, such as
+# InvalidURL, MissingSchema or InvalidHeader, are about the request and leave the breaker as it was
+HOST_ERRORS = (
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ContentDecodingError,
+    requests.exceptions.TooManyRedirects,
+)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of sending a request to a host whose circuit is open."""
+
+
+def retry_after_seconds(response: requests.Response) -> Optional[float]:
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        max_attempts: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        total_timeout: float = 180.0,
+    ):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        # No retry is started once this much time has passed since the first attempt
+        self.total_timeout = total_timeout
+
+    def delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """Seconds to wait before retry number `attempt` (1-based)."""
+        if response is not None:
+            retry_after = retry_after_seconds(response)
+            if retry_after is not None:
+                return min(retry_after, self.max_delay)
+        # Full jitter: uniform between 0 and the exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Closed, open or half-open state of one host."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release(self) -> None:
+        """Give up the trial slot without an outcome, when the request failed for reasons of its own."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> bool:
+        """Count a failure, returns True when it opened the circuit."""
+        with self._lock:
+            self._failures += 1
+            was_trial = self._trial_in_flight
+            self._trial_in_flight = False
+            if was_trial or (self._opened_at is None and self._failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+
+class ResilientCaller:
+    """Retry policy, circuit breakers and metrics shared by every request of a session."""
+
+    def __init__(
+        self,
+        policy: Optional[RetryPolicy] = None,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+    ):
+        self.policy = policy if policy is not None else RetryPolicy()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self.metrics = {
+            "retries": 0,
+            "timeouts": 0,
+            "connection_errors": 0,
+            "request_errors": 0,
+            "retry_statuses": 0,
+            "circuits_opened": 0,
+            "circuit_rejections": 0,
+            "backoff_seconds": 0.0,
+        }
+
+    def _count(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self.metrics[name] += amount
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self._breakers[host] = breaker
+            return breaker
+
+    def _failed(self, breaker: CircuitBreaker, host: str) -> None:
+        if breaker.record_failure():
+            self._count("circuits_opened")
+            print(f"Circuit opened for {host}, failing fast for {self.reset_timeout}s")
+
+    def call(self, method: str, host: str, send: Callable[[], requests.Response]) -> requests.Response:
+        """Send a request with `send()`, retrying idempotent methods on timeouts, connection errors and RETRY_STATUSES."""
+        breaker = self.breaker(host)
+        retryable = method.upper() in RETRY_METHODS
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            if not breaker.allow():
+                self._count("circuit_rejections")
+                raise CircuitOpenError(f"Circuit open for {host}, not sending the request")
+
+            response = None
+            try:
+                response = send()
+            except requests.exceptions.Timeout as e:
+                self._count("timeouts")
+                self._failed(breaker, host)
+                if not retryable or attempt >= self.policy.max_attempts:
+                    raise
+                error = e
+            except requests.exceptions.ConnectionError as e:
+                self._count("connection_errors")
+                self._failed(breaker, host)
+                if not retryable or attempt >= self.policy.max_attempts:
+                    raise
+                error = e
+            except HOST_ERRORS:
+                # Redirect loops and broken bodies: not retried, but the outcome must be recorded,
+                # a half-open trial that never reports back would keep the host's circuit open for good
+                self._count("request_errors")
+                self._failed(breaker, host)
+                raise
+            except BaseException:
+                # Malformed URLs or headers from the agent say nothing about the host
+                breaker.release()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    breaker.record_success()
+                    return response
+                self._count("retry_statuses")
+                # Only server errors say the host is unhealthy, 429 and 408 are about this client
+                if response.status_code >= 500:
+                    self._failed(breaker, host)
+                else:
+                    breaker.record_success()
+                if not retryable or attempt >= self.policy.max_attempts:
+                    return response
+
+            delay = self.policy.delay(attempt, response)
+            if time.monotonic() - start + delay > self.policy.total_timeout:
+                # Out of time, hand back what the last attempt produced
+                if response is not None:
+                    return response
+                raise error
+            if response is not None:
+                response.close()
+            self._count("retries")
+            self._count("backoff_seconds", delay)
+            time.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            open_circuits = sorted(host for host, breaker in self._breakers.items() if breaker.state != "closed")
+        return {**self.metrics, "open_circuits": open_circuits}
@@ -0,0 +1,307 @@
+"""Search backends behind the browser's `bing:` URIs.
+
+Every provider returns results in the shape of the Bing Web Search API, so the browser
+renders them the same way. `BingSearchProvider` calls the live API. `LocalSearchProvider`
+ranks a local corpus with BM25, for runs that must be deterministic and network-free.
+
+Build or refresh a local index ahead of a run with:
+    python -m utils.search_providers data/search_corpus --index .cache/bm25 --query "test query"
+"""
+import functools
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import diskcache as dc
+import numpy as np
+import requests
+
+from .http_session import get_session
+
+BING_ENDPOINT = "https://api.bing.microsoft.com/v7.0/search"
+
+# Plain files a local corpus may hold, besides .jsonl files of {"url", "title", "text"} records
+LOCAL_CORPUS_EXTENSIONS = (".txt", ".md", ".html", ".htm")
+
+_TOKEN = re.compile(r"\w+")
+
+
+class SearchProvider:
+    def search(self, query: str) -> Dict[str, Any]:
+        """Return results in the Bing Web Search API shape: {"webPages": {"value": [{name, url, snippet}]}}."""
+        raise NotImplementedError()
+
+
+class BingSearchProvider(SearchProvider):
+    """The Bing Web Search API, with results cached on disk by query."""
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        session: Optional[requests.Session] = None,
+        request_kwargs: Optional[Dict[str, Any]] = None,
+        cache_dir: Optional[str] = ".cache/bing",
+    ):
+        self.api_key = api_key
+        self.session = session if session is not None else get_session()
+        self.request_kwargs = request_kwargs
+        self.cache = dc.Cache(cache_dir) if cache_dir is not None else None
+
+    def search(self, query: str) -> Dict[str, Any]:
+        # Check the cache
+        if self.cache is not None:
+            cached = self.cache.get(query)
+            if cached is not None:
+                return cached
+        # Make sure the key was set
+        if self.api_key is None:
+            raise ValueError("Missing Bing API key.")
+
+        # Prepare the request parameters
+        request_kwargs = self.request_kwargs.copy() if self.request_kwargs is not None else {}
+
+        request_kwargs["headers"] = dict(request_kwargs.get("headers") or {})
+        request_kwargs["headers"]["Ocp-Apim-Subscription-Key"] = self.api_key
+
+        request_kwargs["params"] = dict(request_kwargs.get("params") or {})
+        request_kwargs["params"]["q"] = query
+        request_kwargs["params"]["textDecorations"] = False
+        request_kwargs["params"]["textFormat"] = "raw"
+
+        request_kwargs["stream"] = False
+
+        # Make the request, the session retries with backoff and fails fast while Bing is down
+        response = self.session.get(BING_ENDPOINT, **request_kwargs)
+        response.raise_for_status()
+        results = response.json()
+
+        # Cache the results
+        if self.cache is not None:
+            self.cache.set(query, results)
+
+        return results
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+def _read_corpus(corpus_dir: str):
+    """Yield (url, title, text) for every document under `corpus_dir`, in a stable order."""
+    for root, dirs, files in os.walk(corpus_dir):
+        dirs.sort()
+        for fname in sorted(files):
+            path = os.path.join(root, fname)
+            ext = os.path.splitext(fname)[1].lower()
+            if ext == ".jsonl":
+                with open(path, encoding="utf-8") as fh:
+                    for line in fh:
+                        if line.strip() == "":
+                            continue
+                        record = json.loads(line)
+                        yield record["url"], record.get("title") or record["url"], record.get("text", "")
+            elif ext in LOCAL_CORPUS_EXTENSIONS:
+                with open(path, encoding="utf-8", errors="replace") as fh:
+                    text = fh.read()
+                title = os.path.splitext(fname)[0]
+                if ext in (".html", ".htm"):
+                    from bs4 import BeautifulSoup
+
+                    soup = BeautifulSoup(text, "html.parser")
+                    for script in soup(["script", "style"]):
+                        script.extract()
+                    if soup.title is not None and soup.title.string:
+                        title = soup.title.string.strip()
+                    text = soup.get_text(" ")
+                yield "file://" + os.path.abspath(path), title, text
+
+
+def _corpus_fingerprint(corpus_dir: str) -> str:
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(corpus_dir):
+        dirs.sort()
+        for fname in sorted(files):
+            path = os.path.join(root, fname)
+            stat = os.stat(path)
+            digest.update(f"{os.path.relpath(path, corpus_dir)}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+    return digest.hexdigest()
+
+
+class BM25Index:
+    """Okapi BM25 over an inverted index held in numpy arrays.
+
+    Postings are stored term-major: the documents containing term `t` are
+    `doc_ids[indptr[t]:indptr[t + 1]]`, with their term frequencies in `tfs`.
+    """
+
+    def __init__(
+        self,
+        vocabulary: Dict[str, int],
+        indptr: np.ndarray,
+        doc_ids: np.ndarray,
+        tfs: np.ndarray,
+        doc_lengths: np.ndarray,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+
+        num_docs = len(doc_lengths)
+        doc_freqs = np.diff(indptr).astype(np.float64)
+        self.idf = np.log1p((num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        avg_length = float(doc_lengths.mean()) if num_docs > 0 else 1.0
+        self._length_norm = k1 * (1 - b + b * doc_lengths / max(avg_length, 1e-9))
+
+    @classmethod
+    def build(cls, documents: List[List[str]], **kwargs) -> "BM25Index":
+        vocabulary: Dict[str, int] = {}
+        postings: List[Dict[int, int]] = []
+        doc_lengths = np.zeros(len(documents), dtype=np.float32)
+        for doc_id, tokens in enumerate(documents):
+            doc_lengths[doc_id] = len(tokens)
+            counts: Dict[str, int] = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                term = vocabulary.get(token)
+                if term is None:
+                    term = vocabulary[token] = len(postings)
+                    postings.append({})
+                postings[term][doc_id] = count
+
+        indptr = np.zeros(len(postings) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(p) for p in postings])
+        doc_ids = np.fromiter((d for p in postings for d in p), dtype=np.int32, count=int(indptr[-1]))
+        tfs = np.fromiter((c for p in postings for c in p.values()), dtype=np.float32, count=int(indptr[-1]))
+        return cls(vocabulary, indptr, doc_ids, tfs, doc_lengths, **kwargs)
+
+    def top_k(self, query_tokens: List[str], k: int) -> List[Tuple[int, float]]:
+        scores = np.zeros(len(self.doc_lengths), dtype=np.float64)
+        for token in set(query_tokens):
+            term = self.vocabulary.get(token)
+            if term is None:
+                continue
+            start, end = self.indptr[term], self.indptr[term + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.tfs[start:end]
+            scores[docs] += self.idf[term] * tf * (self.k1 + 1) / (tf + self._length_norm[docs])
+
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        # Ties are broken by document order so results are deterministic
+        order = sorted(matched.tolist(), key=lambda d: (-scores[d], d))
+        return [(d, float(scores[d])) for d in order]
+
+    def save(self, path: str) -> None:
+        np.savez(
+            path,
+            indptr=self.indptr,
+            doc_ids=self.doc_ids,
+            tfs=self.tfs,
+            doc_lengths=self.doc_lengths,
+            terms=np.array(sorted(self.vocabulary, key=self.vocabulary.get), dtype=object),
+        )
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> "BM25Index":
+        with np.load(path, allow_pickle=True) as data:
+            vocabulary = {term: i for i, term in enumerate(data["terms"].tolist())}
+            return cls(vocabulary, data["indptr"], data["doc_ids"], data["tfs"], data["doc_lengths"], **kwargs)
+
+
+class LocalSearchProvider(SearchProvider):
+    """BM25 search over a local corpus, with the index persisted next to the documents' metadata.
+
+    The index is rebuilt when the files under `corpus_dir` change. It is written to a
+    temporary file and renamed, so actors that build it at the same time never read a
+    half-written index.
+    """
+
+    def __init__(
+        self,
+        corpus_dir: str,
+        index_dir: str = ".cache/bm25",
+        top_k: int = 10,
+        snippet_chars: int = 300,
+    ):
+        self.corpus_dir = corpus_dir
+        self.index_dir = index_dir
+        self.top_k = top_k
+        self.snippet_chars = snippet_chars
+        self.index, self.documents = self._load_or_build()
+
+    def _load_or_build(self) -> Tuple[BM25Index, List[Dict[str, str]]]:
+        fingerprint = _corpus_fingerprint(self.corpus_dir)
+        index_path = os.path.join(self.index_dir, f"{fingerprint[:16]}.npz")
+        documents_path = os.path.join(self.index_dir, f"{fingerprint[:16]}.documents.json")
+        if os.path.exists(index_path) and os.path.exists(documents_path):
+            with open(documents_path, encoding="utf-8") as fh:
+                return BM25Index.load(index_path), json.load(fh)
+
+        start = time.perf_counter()
+        documents = []
+        tokens = []
+        for url, title, text in _read_corpus(self.corpus_dir):
+            documents.append({"url": url, "name": title, "text": text})
+            tokens.append(tokenize(title + " " + text))
+        index = BM25Index.build(tokens)
+
+        os.makedirs(self.index_dir, exist_ok=True)
+        suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+        index.save(index_path + suffix + ".npz")
+        os.replace(index_path + suffix + ".npz", index_path)
+        with open(documents_path + suffix, "w", encoding="utf-8") as fh:
+            json.dump(documents, fh)
+        os.replace(documents_path + suffix, documents_path)
+        print(f"Built a BM25 index of {len(documents)} documents in {time.perf_counter() - start:.1f}s: {index_path}")
+        return index, documents
+
+    def _snippet(self, text: str, query_tokens: List[str]) -> str:
+        # The window around the first occurrence of any query term
+        text = " ".join(text.split())
+        matches = (re.search(r"\b" + re.escape(token) + r"\b", text, re.IGNORECASE) for token in query_tokens)
+        positions = [m.start() for m in matches if m is not None]
+        start = max(0, min(positions) - self.snippet_chars // 3) if positions else 0
+        snippet = text[start : start + self.snippet_chars]
+        return ("..." if start > 0 else "") + snippet + ("..." if start + self.snippet_chars < len(text) else "")
+
+    def search(self, query: str) -> Dict[str, Any]:
+        query_tokens = tokenize(query)
+        results = []
+        for doc_id, _ in self.index.top_k(query_tokens, self.top_k):
+            document = self.documents[doc_id]
+            results.append(
+                {"name": document["name"], "url": document["url"], "snippet": self._snippet(document["text"], query_tokens)}
+            )
+        return {"_type": "SearchResponse", "queryContext": {"originalQuery": query}, "webPages": {"value": results}}
+
+
+@functools.lru_cache(maxsize=None)
+def get_local_search_provider(corpus_dir: str, index_dir: str = ".cache/bm25", top_k: int = 10) -> LocalSearchProvider:
+    """Return the provider for a corpus, loading its index once per process."""
+    return LocalSearchProvider(corpus_dir, index_dir=index_dir, top_k=top_k)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the BM25 index of a local search corpus")
+    parser.add_argument("corpus_dir")
+    parser.add_argument("--index", default=".cache/bm25")
+    parser.add_argument("--query", help="Run one search against the index and print the results")
+    args = parser.parse_args()
+
+    provider = get_local_search_provider(args.corpus_dir, args.index)
+    if args.query:
+        print(json.dumps(provider.search(args.query), indent=2))
@@ -0,0 +1,177 @@
+"""Markdown tables written straight from rows, for spreadsheets and CSV files.
+
+`TableWriter` takes the rows of a sheet one at a time and keeps only what the Markdown
+needs. It holds the first `max_rows` rows, the last `preview_rows` rows, and a count of
+the value types in every column. A sheet of at most `max_rows` rows is rendered whole.
+A longer sheet gets a summary of its shape and column types, then its head and tail.
+Columns past `max_columns` are left out and the summary says so.
+
+`markdown_table` renders a small table whole, for the tables of documents such as slides.
+"""
+import collections
+import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+TABLE_MAX_ROWS = 500
+TABLE_MAX_COLUMNS = 40
+TABLE_PREVIEW_ROWS = 25
+
+
+def dtype_name(value: Any, parse_numbers: bool = False) -> str:
+    """The summary type of a value. With `parse_numbers`, strings holding a number count as numbers."""
+    if isinstance(value, str):
+        if parse_numbers:
+            for parse, name in ((int, "int"), (float, "float")):
+                try:
+                    parse(value)
+                    return name
+                except ValueError:
+                    pass
+        return "str"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return "datetime"
+    return "str"
+
+
+def format_cell(value: Any) -> str:
+    """A cell as Markdown table text: on one line, with pipes and emphasis characters escaped."""
+    if value is None:
+        return ""
+    if isinstance(value, datetime.datetime):
+        text = value.date().isoformat() if value.time() == datetime.time() else value.isoformat(sep=" ")
+    elif isinstance(value, (datetime.date, datetime.time)):
+        text = value.isoformat()
+    else:
+        text = str(value)
+    text = " ".join(text.split())
+    return text.replace("|", r"\|").replace("*", r"\*").replace("_", r"\_")
+
+
+def markdown_table(rows: Sequence[Sequence[Any]]) -> str:
+    """A whole table as Markdown, its first row as the header. Rows are padded to the widest."""
+    if len(rows) == 0:
+        return ""
+    width = max(len(row) for row in rows)
+    lines = []
+    for i, row in enumerate(rows):
+        cells = [format_cell(value) for value in row]
+        lines.append("| " + " | ".join(cells + [""] * (width - len(cells))) + " |")
+        if i == 0:
+            lines.append("| " + " | ".join(["---"] * width) + " |")
+    return "\n".join(lines)
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or value == ""
+
+
+class TableWriter:
+    """Builds the Markdown of one sheet from its rows. The first non-empty row is the header."""
+
+    def __init__(
+        self,
+        max_rows: int = TABLE_MAX_ROWS,
+        max_columns: int = TABLE_MAX_COLUMNS,
+        preview_rows: int = TABLE_PREVIEW_ROWS,
+        parse_numbers: bool = False,
+    ):
+        self.max_rows = max_rows
+        self.max_columns = max_columns
+        self.preview_rows = preview_rows
+        self.parse_numbers = parse_numbers
+        self.header: Optional[List[str]] = None
+        self.num_rows = 0
+        self.num_columns = 0
+        self._head: List[List[str]] = []
+        self._tail: "collections.deque[Sequence[Any]]" = collections.deque(maxlen=preview_rows)
+        self._dtypes: List[Dict[str, int]] = []
+        # Empty rows are only kept when more data follows them
+        self._blank_rows = 0
+
+    def add(self, row: Sequence[Any]) -> None:
+        end = len(row)
+        while end > 0 and _is_empty(row[end - 1]):
+            end -= 1
+        if end == 0:
+            self._blank_rows += 1
+            return
+        cells = row[: min(end, self.max_columns)]
+        self.num_columns = max(self.num_columns, end)
+        if self.header is None:
+            self.header = [format_cell(value) for value in cells]
+            self._blank_rows = 0
+            return
+
+        for _ in range(self._blank_rows):
+            self._append(())
+        self._blank_rows = 0
+        self._append(cells)
+
+    def _append(self, cells: Sequence[Any]) -> None:
+        self.num_rows += 1
+        while len(self._dtypes) < len(cells):
+            self._dtypes.append({})
+        for counts, value in zip(self._dtypes, cells):
+            if not _is_empty(value):
+                name = dtype_name(value, self.parse_numbers)
+                counts[name] = counts.get(name, 0) + 1
+        if len(self._head) < self.max_rows:
+            self._head.append([format_cell(value) for value in cells])
+        else:
+            self._tail.append(cells)
+
+    def dtypes(self) -> List[str]:
+        names = []
+        for counts in self._dtypes:
+            if len(counts) == 0:
+                names.append("empty")
+            elif len(counts) == 1:
+                names.append(next(iter(counts)))
+            elif set(counts) == {"int", "float"}:
+                names.append("float")
+            else:
+                names.append("mixed")
+        return names
+
+    def markdown(self) -> str:
+        if self.header is None:
+            return ""
+        width = min(self.num_columns, self.max_columns)
+
+        def line(cells: Sequence[str]) -> str:
+            return "| " + " | ".join(list(cells) + [""] * (width - len(cells))) + " |"
+
+        lines = []
+        truncated_rows = self.num_rows > self.max_rows
+        if truncated_rows:
+            # The last rows, topped up from the end of the head when few rows came after it
+            missing = self.preview_rows - len(self._tail)
+            tail = self._head[max(self.preview_rows, len(self._head) - missing) :] if missing > 0 else []
+            tail += [[format_cell(value) for value in cells] for cells in self._tail]
+        if truncated_rows or self.num_columns > width:
+            shown = []
+            if truncated_rows:
+                shown.append(f"the first {self.preview_rows} and last {len(tail)} rows")
+            if self.num_columns > width:
+                shown.append(f"the first {width} columns")
+            lines.append(f"Shape: {self.num_rows} rows x {self.num_columns} columns, showing {' and '.join(shown)}.")
+            dtypes = self.dtypes() + ["empty"] * (width - len(self._dtypes))
+            header = self.header + [""] * (width - len(self.header))
+            lines.append("Columns: " + ", ".join(f"{name or '(unnamed)'} ({dtype})" for name, dtype in zip(header, dtypes)))
+            lines.append("")
+
+        lines.append(line(self.header))
+        lines.append(line(["---"] * width))
+        if truncated_rows:
+            lines.extend(line(cells) for cells in self._head[: self.preview_rows])
+            lines.append(line(["..."] * width))
+            lines.extend(line(cells) for cells in tail)
+        else:
+            lines.extend(line(cells) for cells in self._head)
+        return "\n".join(lines)
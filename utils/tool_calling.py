@@ -0,0 +1,249 @@
+"""Helpers for turning LLM output into a tool call without extra round trips.
+
+`tool_schema` builds OpenAI function-calling schemas from the tool method signatures,
+`repair_json` recovers the JSON object from output that is almost valid (code fences,
+trailing commas, truncated objects, Python literals), `RepairingJsonOutputParser`
+falls back to it whenever the strict parser fails, and `IncrementalJsonObjectParser`
+exposes fields of a streamed JSON answer as soon as each one is complete.
+"""
+import inspect
+import json
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.messages import AIMessage
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.outputs import Generation
+
+_JSON_TYPES = {str: "string", int: "integer", float: "number", bool: "boolean", dict: "object", list: "array"}
+
+# Parameters that are bound by the agent, never chosen by the model
+_BOUND_PARAMETERS = ("self", "browser")
+
+
+def tool_schema(func: Callable, name: Optional[str] = None) -> Dict[str, Any]:
+    """Build an OpenAI tool schema from a function signature and its docstring."""
+    properties: Dict[str, Any] = {}
+    required: List[str] = []
+    for param in inspect.signature(func).parameters.values():
+        if param.name in _BOUND_PARAMETERS:
+            continue
+        properties[param.name] = {"type": _JSON_TYPES.get(param.annotation, "string")}
+        if param.default is inspect.Parameter.empty:
+            required.append(param.name)
+
+    return {
+        "type": "function",
+        "function": {
+            "name": name or func.__name__,
+            "description": inspect.getdoc(func) or "",
+            "parameters": {"type": "object", "properties": properties, "required": required},
+        },
+    }
+
+
+def _close_json(text: str) -> str:
+    """Escape raw newlines inside strings and close any strings, arrays and objects left open."""
+    closers: List[str] = []
+    out: List[str] = []
+    in_string = False
+    escaped = False
+    for ch in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            elif ch == "\n":
+                out.append("\\n")
+                continue
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            closers.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if len(closers) > 0:
+                closers.pop()
+        out.append(ch)
+
+    if in_string:
+        if escaped:
+            out.pop()
+        out.append('"')
+    repaired = "".join(out).rstrip()
+    # A dangling separator or key cannot be completed, drop it
+    repaired = re.sub(r'(,|:|,\s*"[^"]*")\s*$', "", repaired)
+    return repaired + "".join(reversed(closers))
+
+
+def repair_json(text: str) -> Any:
+    """Parse the first JSON object in `text`, repairing common LLM formatting mistakes.
+
+    Raises ValueError when nothing resembling a JSON object can be recovered.
+    """
+    # Strip markdown code fences and any prose around the object
+    m = re.search(r"```(?:json)?\s*(.*?)(?:```|$)", text, re.DOTALL)
+    if m:
+        text = m.group(1)
+    start = text.find("{")
+    if start < 0:
+        raise ValueError(f"No JSON object found in: {text}")
+    end = text.rfind("}")
+    candidates = [text[start : end + 1]] if end > start else []
+    candidates.append(text[start:])
+
+    for candidate in candidates:
+        try:
+            return json.loads(candidate, strict=False)
+        except json.JSONDecodeError:
+            pass
+
+        fixed = _close_json(candidate)
+        fixed = re.sub(r",\s*([}\]])", r"\1", fixed)
+        try:
+            return json.loads(fixed, strict=False)
+        except json.JSONDecodeError:
+            pass
+
+        # Python literals outside of strings
+        pythonic = re.sub(r'("(?:[^"\\]|\\.)*")|\bTrue\b|\bFalse\b|\bNone\b', _json_literal, fixed)
+        try:
+            return json.loads(pythonic, strict=False)
+        except json.JSONDecodeError:
+            pass
+
+    raise ValueError(f"Could not repair JSON: {text}")
+
+
+def _json_literal(m: "re.Match") -> str:
+    if m.group(1) is not None:
+        return m.group(1)
+    return {"True": "true", "False": "false", "None": "null"}[m.group(0)]
+
+
+class RepairingJsonOutputParser(JsonOutputParser):
+    """JsonOutputParser that repairs malformed output instead of failing the call."""
+
+    def parse_result(self, result: List[Generation], *, partial: bool = False) -> Any:
+        try:
+            return super().parse_result(result, partial=partial)
+        except OutputParserException:
+            try:
+                return repair_json(result[0].text)
+            except ValueError as e:
+                raise OutputParserException(str(e), llm_output=result[0].text) from e
+
+
+def parse_tool_call(message: AIMessage) -> Dict[str, Any]:
+    """Convert a native tool-calling response into the ToolChoice dict used by the agent."""
+    if len(message.tool_calls) > 0:
+        tool_call = message.tool_calls[0]
+        return {"reason": message.content or "", "tool": tool_call["name"], "tool_args": tool_call["args"] or {}}
+
+    # The model answered in text instead, it is usually the ToolChoice JSON
+    try:
+        tool_choice = repair_json(message.content)
+    except ValueError as e:
+        raise OutputParserException(str(e), llm_output=message.content) from e
+    if not isinstance(tool_choice, dict) or "tool" not in tool_choice:
+        raise OutputParserException(f"No tool call in: {message.content}", llm_output=message.content)
+    tool_choice.setdefault("tool_args", {})
+    return tool_choice
+
+
+class IncrementalJsonObjectParser:
+    """Parse the top-level fields of a JSON object while its text is still streaming in.
+
+    `values` holds every field whose value is complete, so a caller can act on some fields
+    before the model has finished generating the others. Text before the opening brace
+    (code fences, prose) is skipped. Each character is scanned once across all `feed` calls.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.values: Dict[str, Any] = {}
+        self.done = False
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._key_start: Optional[int] = None
+        self._key: Optional[str] = None
+        self._awaiting_value = False
+        self._value_start: Optional[int] = None
+        self._value_kind: Optional[str] = None
+
+    def feed(self, chunk: str) -> Dict[str, Any]:
+        self.text += chunk
+        text = self.text
+        while self._pos < len(text) and not self.done:
+            i = self._pos
+            ch = text[i]
+            self._pos += 1
+
+            if self._depth == 0:
+                if ch == "{":
+                    self._depth = 1
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        if self._value_kind == "string":
+                            self._complete(i + 1)
+                        elif self._key_start is not None:
+                            self._key = json.loads(text[self._key_start : i + 1], strict=False)
+                            self._key_start = None
+            elif ch == '"':
+                self._in_string = True
+                if self._depth == 1:
+                    if self._awaiting_value:
+                        self._start_value(i, "string")
+                    elif self._key is None:
+                        self._key_start = i
+            elif ch in "{[":
+                if self._depth == 1 and self._awaiting_value:
+                    self._start_value(i, "container")
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    if self._value_kind == "scalar":
+                        self._complete(i)
+                    self.done = True
+                elif self._depth == 1 and self._value_kind == "container":
+                    self._complete(i + 1)
+            elif self._depth == 1:
+                if ch == ":" and self._key is not None and self._value_kind is None:
+                    self._awaiting_value = True
+                elif ch == ",":
+                    if self._value_kind == "scalar":
+                        self._complete(i)
+                elif self._awaiting_value and not ch.isspace():
+                    self._start_value(i, "scalar")
+        return self.values
+
+    def _start_value(self, start: int, kind: str) -> None:
+        self._awaiting_value = False
+        self._value_start = start
+        self._value_kind = kind
+
+    def _complete(self, end: int) -> None:
+        raw = self.text[self._value_start : end].strip()
+        try:
+            value = json.loads(raw, strict=False)
+        except json.JSONDecodeError:
+            try:
+                value = repair_json('{"value": ' + raw + "}")["value"]
+            except (ValueError, KeyError, TypeError):
+                value = raw
+        self.values[self._key] = value
+        self._key = None
+        self._value_start = None
+        self._value_kind = None